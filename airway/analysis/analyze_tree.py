@@ -6,6 +6,7 @@ import numpy as np
 import networkx as nx
 import matplotlib.pyplot as plt
 
+from airway.util.cohort_store import load_cohort_store
 from airway.util.util import get_data_paths_from_args
 
 plt.rcParams.update({"font.size": 4})
@@ -77,13 +78,13 @@ def per_lobe_statistics():
             return 0
 
     for lobe in range(2, 7):
-        paths = list(input_data_path.glob("**/lobe-" + str(lobe) + "*.graphml"))
+        patients = [patient for patient in store.patients if store.has_graph(patient, f"lobe-{lobe}")]
 
         with open(output_data_path / f"lobe-{lobe}.csv", "w", newline="") as f:
             csv_writer = csv.writer(f)
             csv_writer.writerow(["patient", "nodes", "edges", "nodeQuotient", "edgeQuotient"])
-            for path in paths:
-                graph = nx.read_graphml(path)
+            for patient in patients:
+                graph = store.get_graph(patient, f"lobe-{lobe}")
                 csv_writer.writerow(
                     [
                         graph.graph["patient"],
@@ -96,16 +97,11 @@ def per_lobe_statistics():
 
 
 def upper_left_lobe_distance_analysis(plot_path, csv_path):
-    # setup path to lobe.graphml files
-    upper_left_lobe_list = []
-    for pat_dir in sorted(input_data_path.glob("*")):
-        lobe_path = pat_dir / f"lobe-3-{pat_dir.parts[-1]}.graphml"
-        if lobe_path.is_file():
-            upper_left_lobe_list.append(lobe_path)
     # fill a dictionary with lobe graphs
     left_lobe_dict = {}
-    for lobePath in upper_left_lobe_list:
-        left_lobe_dict[lobePath.parts[-2]] = nx.read_graphml(lobePath)
+    for patient in store.patients:
+        if store.has_graph(patient, "lobe-3"):
+            left_lobe_dict[patient] = store.get_graph(patient, "lobe-3")
     lu_count = len(left_lobe_dict)
     print(f"Found {lu_count} upper left lobes for analysis.")
     not_tree_list = []
@@ -287,8 +283,8 @@ def get_classification(l1, l2):
 if __name__ == "__main__":
     output_data_path, input_data_path = get_data_paths_from_args()
 
-    # paths to all trees
-    path_list = [pat_dir / "tree.graphml" for pat_dir in input_data_path.glob("*") if pat_dir.is_dir()]
+    # all trees and lobe graphs of stage-07
+    store = load_cohort_store(input_data_path)
 
     lobe_id_to_string = {
         2: "LeftLowerLobe",
@@ -299,13 +295,13 @@ if __name__ == "__main__":
     }
 
     # list of all patientIDs
-    pat_id_list = [pat_dir.parts[-2] for pat_dir in path_list if pat_dir.parents[0].is_dir()]
+    pat_id_list = store.patients
 
     # load all trees in dictionary (patID -> nx.graph)
     tree_dict = {}
-    for tree_path in path_list:
-        if tree_path.is_file():
-            tree_dict[tree_path.parts[-2]] = nx.read_graphml(tree_path)
+    for patient in pat_id_list:
+        if store.has_graph(patient, "tree"):
+            tree_dict[patient] = store.get_graph(patient, "tree")
     print("loaded trees: " + str(len(tree_dict.keys())))
 
     # analysers
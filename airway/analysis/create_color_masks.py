@@ -1,44 +1,105 @@
 """Creates a color mask for lingula and the other
 
 """
+import heapq
 import random
 import re
-from queue import Queue, PriorityQueue
-from typing import Tuple, Callable, Dict
+from typing import Tuple, Callable, Dict, List
 
 import numpy as np
 import networkx as nx
 
-from airway.util.config_parsers import parse_classification_config
-from airway.util.helper_functions import adjacent, get_coords_in_sphere_at_point
+from airway.util.classification_rules import load_classification_rules
+from airway.util.dtypes import allocate_volume, to_volume_dtype
+from airway.util.helper_functions import NearestNonzeroIndex, get_coords_in_sphere_at_point
 from airway.util.util import get_data_paths_from_args
-
-
-def fill_color_with_priority_queue(node_properties, model, distance_mask, color_mask):
-    queue = PriorityQueue()
+from airway.util.volumes import load_label_mask, load_volume
+
+
+def fill_color_by_distance_level(node_properties, model, distance_mask, color_mask):
+    """Floods the colors of the nodes through the bronchus, starting at the points of the nodes
+
+    Voxels are expanded in order of descending distance (ties by the distance of the parent node, then by index),
+    and each voxel can only be colored if its distance is larger than the parent distance of the node the color
+    came from. All voxels of the same distance are expanded at once on flat indices, voxels colored by more than
+    one voxel of a batch get the color of the first of them in that order.
+    """
+    shape = model.shape
+    flat_color_mask = color_mask.reshape(-1)
+    flat_distance_mask = distance_mask.reshape(-1)
+    fillable = model.reshape(-1) == 1
+    strides = [int(np.prod(shape[axis + 1 :])) for axis in range(3)]
+    # Same order as adjacent()
+    directions = [(axis, step) for axis in range(3) for step in (1, -1)]
+
+    # Batches of (flat indices, parent distances) waiting to be expanded, by distance
+    buckets: Dict[float, List[Tuple[np.ndarray, np.ndarray]]] = {}
+    levels: List[float] = []
+
+    def push(indices, min_dists):
+        for level in np.unique(flat_distance_mask[indices]).tolist():
+            at_level = flat_distance_mask[indices] == level
+            if level not in buckets:
+                buckets[level] = []
+                heapq.heappush(levels, -level)
+            buckets[level].append((indices[at_level], min_dists[at_level]))
+
+    seed_indices, seed_min_dists = [], []
     for node, point, curr_color, radius, parent_dist in node_properties:
-        queue.put((-distance_mask[point], parent_dist, point))
         color_mask[point] = curr_color
-    while not queue.empty():
-        _, min_dist, curr_point = queue.get()
-        for adj in map(tuple, adjacent(curr_point)):
-            if color_mask[adj] == 0 and model[adj] == 1 and min_dist < distance_mask[adj]:
-                queue.put((-distance_mask[adj], min_dist, adj))
-                color_mask[adj] = color_mask[curr_point]
-
-
-def find_legal_point(node, distances):
-    p = get_point(node)
-    queue = Queue()
-    queue.put(p)
-    visited = {p}
-    while not queue.empty():
-        for adj in map(tuple, adjacent(queue.get())):
-            if adj not in visited:
-                if distances[adj] != 0:
-                    return adj
-                visited.add(adj)
-                queue.put(adj)
+        seed_indices.append(np.ravel_multi_index(point, shape))
+        seed_min_dists.append(parent_dist)
+    push(np.array(seed_indices, dtype=np.int64), np.array(seed_min_dists, dtype=float))
+
+    while levels:
+        level = -heapq.heappop(levels)
+        indices = np.concatenate([indices for indices, _ in buckets[level]])
+        min_dists = np.concatenate([min_dists for _, min_dists in buckets.pop(level)])
+        order = np.lexsort((indices, min_dists))
+        indices, min_dists = indices[order], min_dists[order]
+        coords = np.unravel_index(indices, shape)
+
+        candidates, candidate_sources = [], []
+        for axis, step in directions:
+            in_bounds = (coords[axis] + step >= 0) & (coords[axis] + step < shape[axis])
+            sources = np.flatnonzero(in_bounds)
+            adj = indices[sources] + step * strides[axis]
+            legal = fillable[adj] & (flat_color_mask[adj] == 0) & (min_dists[sources] < flat_distance_mask[adj])
+            candidates.append(adj[legal])
+            candidate_sources.append(sources[legal])
+        candidates = np.concatenate(candidates)
+        if len(candidates) == 0:
+            continue
+        # The first source in expansion order wins
+        candidate_sources = np.concatenate(candidate_sources)
+        candidate_order = np.lexsort((candidate_sources, candidates))
+        new_indices, first = np.unique(candidates[candidate_order], return_index=True)
+        winners = candidate_sources[candidate_order][first]
+        flat_color_mask[new_indices] = flat_color_mask[indices[winners]]
+        push(new_indices, min_dists[winners])
+
+
+def relabel_color_mask(color_mask, nodes_visit_order, coarse_nodes_visit_order):
+    """Returns the color mask the flood would create with coarse_nodes_visit_order, given the one of nodes_visit_order
+
+    The flood only depends on the points and parent distances of the nodes, not on their colors, so if every node
+    has its own color in color_mask, every color maps to exactly one color of the coarse mask.
+    """
+    color_lookup_table = np.arange(max(color for _, _, color, _, _ in nodes_visit_order) + 1, dtype=color_mask.dtype)
+    for (_, point, color, _, _), (_, coarse_point, coarse_color, _, _) in zip(
+        nodes_visit_order, coarse_nodes_visit_order
+    ):
+        assert point == coarse_point, "Visit orders must contain the same nodes"
+        color_lookup_table[color] = coarse_color
+    return to_volume_dtype("color_mask", color_lookup_table.take(color_mask))
+
+
+def get_legal_points(tree: nx.Graph, nearest_index: NearestNonzeroIndex) -> Dict[str, Tuple[int, int, int]]:
+    """Returns the point of each node snapped to the nearest voxel which has a distance (i.e. is in the bronchus)"""
+    node_ids = list(tree.nodes)
+    coords = [[tree.nodes[node_id][axis] for axis in "xyz"] for node_id in node_ids]
+    points = nearest_index.snap(np.array(coords, dtype=float))
+    return {node_id: tuple(map(int, point)) for node_id, point in zip(node_ids, points)}
 
 
 def fill_sphere_around_point(
@@ -62,11 +123,12 @@ def get_color_variation(color, variance=0.1):
     return tuple(map(var, color))
 
 
-def get_point(node):
-    return round(node["x"]), round(node["y"]), round(node["z"])
-
-
-def get_nodes_visit_order(tree: nx.Graph, distance_mask: np.ndarray, should_color_node: Callable):
+def get_nodes_visit_order(
+    tree: nx.Graph,
+    distance_mask: np.ndarray,
+    legal_points: Dict[str, Tuple[int, int, int]],
+    should_color_node: Callable,
+):
     # The 0th color is unassigned, the 1st color is just bronchus.
     # The distinction is important because the 0th color can be changed.
     color_hex_codes = [color_hex_to_floats("ffffff")] * 2
@@ -76,10 +138,10 @@ def get_nodes_visit_order(tree: nx.Graph, distance_mask: np.ndarray, should_colo
     nodes_visit_order = []
     for (parent_index, successors) in nx.bfs_successors(tree, first_node):
         parent_node = tree.nodes[parent_index]
-        parent_dist = distance_mask[find_legal_point(parent_node, distance_mask)] + parent_node["group_size"]
+        parent_dist = int(distance_mask[legal_points[parent_index]]) + parent_node["group_size"]
         for s in successors:
             succ_node = tree.nodes[s]
-            point = find_legal_point(succ_node, distance_mask)
+            point = legal_points[s]
             succ_radius = succ_node["group_size"] / 2
             color_id = len(color_hex_codes) if should_color_node(s) else map_node_id_to_color_id[parent_index]
             map_node_id_to_color_id[s] = color_id
@@ -113,11 +175,8 @@ def is_lobe(tree: nx.Graph, node_id: int) -> bool:
     return re.fullmatch(r"[RL](Lower|Middle|Upper)Lobe", tree.nodes[node_id]["split_classification"]) is not None
 
 
-classification_config = parse_classification_config()
-
-
 def is_segment(tree: nx.Graph, node_id: int) -> bool:
-    return classification_config.get(tree.nodes[node_id]["split_classification"], {}).get("clustering_endnode", False)
+    return load_classification_rules().is_clustering_endnode(tree.nodes[node_id]["split_classification"])
 
 
 def main():
@@ -127,28 +186,33 @@ def main():
         distance_mask_path,
         tree_path,
     ) = get_data_paths_from_args(inputs=3)
-    model = np.load(reduced_model_path / "reduced_model.npz")["arr_0"]
-    distance_mask = np.load(distance_mask_path / "distance_mask.npz")["arr_0"]
+    # Only the bronchus is colored, a boolean mask of it is enough
+    model = load_label_mask(reduced_model_path, "reduced_model", 1)
+    distance_mask = load_volume(distance_mask_path, "distance_mask", "distance_mask")
+    nearest_index = NearestNonzeroIndex(distance_mask)
     for gt_suffix in ("", "_gt"):
         tree_graphml_path = tree_path / f"tree{gt_suffix}.graphml"
         if not tree_graphml_path.exists():
             continue
         tree = nx.read_graphml(tree_graphml_path)
+        legal_points = get_legal_points(tree, nearest_index)
 
         def should_color_func(condition: Callable[[nx.Graph, int], bool]) -> Callable:
-            return lambda s: s in get_first_matching_ids(tree, condition)
+            matching_ids = set(get_first_matching_ids(tree, condition))
+            return lambda s: s in matching_ids
 
         print(get_first_matching_ids(tree, is_lobe))
         print(get_first_matching_ids(tree, is_segment))
 
+        # Only the first mask (each node has its own color) is flooded, the others are derived from it
+        node_color_mask, node_visit_order = None, None
         for func, filename in [
             (lambda _: True, f"bronchus_color_mask{gt_suffix}.npz"),
             (should_color_func(is_segment), f"segments{gt_suffix}.npz"),
             (should_color_func(is_lobe), f"lobes{gt_suffix}.npz"),
         ]:
-            color_mask = np.full(model.shape, 0)
             nodes_visit_order, color_hex_codes, map_node_id_to_color_id = get_nodes_visit_order(
-                tree, distance_mask, func
+                tree, distance_mask, legal_points, func
             )
             map_color_id_to_node_id = {value: key for key, value in map_node_id_to_color_id.items()}
             map_color_id_to_classification = {}
@@ -160,11 +224,17 @@ def main():
                 map_color_id_to_classification[c] = classification
             print(color_hex_codes)
 
-            fill_color_with_priority_queue(nodes_visit_order, model, distance_mask, color_mask)
+            if node_color_mask is None:
+                color_mask = allocate_volume("color_mask", model.shape, max_value=len(color_hex_codes) - 1)
+                fill_color_by_distance_level(nodes_visit_order, model, distance_mask, color_mask)
+                node_color_mask, node_visit_order = color_mask, nodes_visit_order
+            else:
+                color_mask = relabel_color_mask(node_color_mask, node_visit_order, nodes_visit_order)
 
             print("Colors:")
-            for color, occ in zip(*np.unique(color_mask, return_counts=True)):
-                print(f"Color {color} appears {occ:,} times in color mask")
+            color_counts = np.bincount(color_mask.reshape(-1))
+            for color in np.flatnonzero(color_counts):
+                print(f"Color {color} appears {color_counts[color]:,} times in color mask")
             np.savez_compressed(
                 output_data_path / filename,
                 color_mask=color_mask,
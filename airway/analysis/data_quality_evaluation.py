@@ -6,7 +6,8 @@ from typing import List
 import networkx as nx
 
 from airway.classification.split_classification import is_valid_tree
-from airway.util.config_parsers import parse_classification_config
+from airway.util.classification_rules import get_compiled_classification_config
+from airway.util.cohort_store import load_cohort_store
 from airway.util.util import get_data_paths_from_args, generate_pdf_report, get_ignored_patients
 
 file_name = "data_quality_evaluation"
@@ -14,10 +15,8 @@ file_name = "data_quality_evaluation"
 
 def get_input():
     output_data_path, tree_input_path, render_path = get_data_paths_from_args(inputs=2)
-    classification_config = parse_classification_config()
-    trees: List[nx.Graph] = []
-    for tree_path in Path(tree_input_path).glob("*/tree.graphml"):
-        trees.append(nx.read_graphml(tree_path))
+    classification_config = get_compiled_classification_config()
+    trees: List[nx.Graph] = load_cohort_store(tree_input_path).get_graphs()
     return output_data_path, trees, classification_config, render_path
 
 
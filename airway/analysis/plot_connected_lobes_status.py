@@ -4,6 +4,7 @@ import networkx as nx
 import numpy as np
 import matplotlib.pyplot as plt
 
+from airway.util.cohort_store import load_cohort_store
 from airway.util.util import get_data_paths_from_args
 
 
@@ -17,16 +18,15 @@ def build_connection_matrix(stage7_path):
     status == 1 -> connected
     status == 2 -> not all lobes available (set for all lobes)
     """
-    patient_dirs = stage7_path.glob("*")
-    patient_dirs = [pat_dir.name for pat_dir in patient_dirs if pat_dir.is_dir()]
+    store = load_cohort_store(stage7_path)
 
     graph_dict = {}
     print(graph_dict)
-    for pat in patient_dirs:
-        graph_files = sorted(list(stage7_path.joinpath(pat).glob("*lobe*.graphml")))
+    for pat in store.patients:
+        graph_names = [name for name in store.get_graph_names(pat) if name.startswith("lobe-")]
         conn_status = []
-        for graph_file in graph_files:
-            lobe_graph = nx.read_graphml(graph_file)
+        for graph_name in graph_names:
+            lobe_graph = store.get_graph(pat, graph_name)
             conn_status.append(int(nx.is_connected(lobe_graph)))
         if len(conn_status) < 5:
             conn_status = [2 for i in range(2, 7)]
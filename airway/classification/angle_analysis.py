@@ -1,12 +1,12 @@
-from collections import defaultdict
-from pathlib import Path
-from typing import List
+import sys
+from typing import Dict, List, Tuple
 
-import networkx as nx
 import yaml
 import numpy as np
 
 from airway.classification.split_classification import cost_exponential_diff_function
+from airway.util.cohort_aggregation import aggregate_cohort
+from airway.util.cohort_store import CohortStore, load_cohort_store
 from airway.util.config_parsers import parse_classification_config
 from airway.util.util import get_data_paths_from_args, get_ignored_patients
 from airway.util.color import Color
@@ -14,40 +14,67 @@ from airway.util.color import Color
 col = Color()
 
 
+# Histogram of the angles between vectors and their reference vector
+HISTOGRAM_BINS = 18
+
+# Whether the vectors of each classification are listed, they are read from the cohort store for every patient
+try:
+    list_vectors = sys.argv[3].lower() == "true"
+    assert sys.argv[3].lower() in ["true", "false"], "given arg is not True or False"
+except IndexError:
+    list_vectors = True
+
+
 def get_input():
     output_data_path, tree_input_path = get_data_paths_from_args(inputs=1)
     classification_config = parse_classification_config()
-    trees: List[nx.Graph] = []
-    ignored_patients = get_ignored_patients()
-    print(ignored_patients)
-    for tree_path in Path(tree_input_path).glob("*/tree.graphml"):
-        if tree_path.parent.name not in ignored_patients:
-            trees.append(nx.read_graphml(tree_path))
-    return output_data_path, trees, classification_config
-
-
-def get_point(node):
-    return np.array([node["x"], node["y"], node["z"]])
-
-
-def analyse_angles(trees, classification_config):
-    map_classification_to_vectors = defaultdict(lambda: [])
-    for tree in trees:
-        successors = dict(nx.bfs_successors(tree, "0"))
-        for parent_id, child_ids in successors.items():
-            parent_node = tree.nodes[parent_id]
-            parent_point = get_point(parent_node)
-            for child_id in child_ids:
-                child_node = tree.nodes[child_id]
-                child_point = get_point(child_node)
-                vec = child_point - parent_point
-                try:
-                    child_classification = child_node["split_classification"]
-                    target_vec = classification_config[child_classification]["vector"]
-                    map_classification_to_vectors[child_classification].append(vec)
-                except KeyError:
-                    pass
-    return map_classification_to_vectors
+    store = load_cohort_store(tree_input_path)
+    return output_data_path, store, classification_config
+
+
+def get_vectors(store: CohortStore, patient: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the classification and the vector from the parent to the node of every node with a parent"""
+    node_rows, _ = store.get_rows(patient)
+    nodes = {column: np.asarray(store.nodes[column][node_rows]) for column in ["node_id", "parent", "x", "y", "z"]}
+    points = np.stack([nodes["x"], nodes["y"], nodes["z"]], axis=1)
+    has_parent = nodes["parent"] != -1
+    row_of_node = {node_id: row for row, node_id in enumerate(nodes["node_id"].tolist())}
+    parent_rows = np.array([row_of_node[parent] for parent in nodes["parent"][has_parent].tolist()], dtype=int)
+    vectors = points[has_parent] - points[parent_rows]
+    classifications = np.asarray(store.nodes["split_classification"][node_rows])[has_parent]
+    return classifications, vectors
+
+
+def analyse_angles(store: CohortStore, patient: str, classification_config):
+    """Contribution of a single patient: sum, count and angle histogram of the vectors of each classification"""
+    if not store.has_graph(patient):
+        return {}
+    classifications, vectors = get_vectors(store, patient)
+    contribution = {}
+    for classification in np.unique(classifications).tolist():
+        if "vector" not in classification_config.get(classification, {}):
+            continue
+        curr_vectors = vectors[classifications == classification]
+        ref_vec = np.array(classification_config[classification]["vector"])
+        angles = np.array([get_angle(vec, ref_vec) for vec in curr_vectors])
+        histogram, _ = np.histogram(angles, bins=HISTOGRAM_BINS, range=(0, np.pi))
+        contribution[classification] = {
+            "sum": curr_vectors.sum(axis=0),
+            "count": len(curr_vectors),
+            "histogram": histogram,
+        }
+    return contribution
+
+
+def get_vectors_by_classification(store: CohortStore, ignored_patients) -> Dict[str, List[np.ndarray]]:
+    """Vectors of all patients for the listing, they are not part of the aggregation, as they grow with the cohort"""
+    vectors_by_classification = {}
+    for patient in store.patients:
+        if patient in ignored_patients or not store.has_graph(patient):
+            continue
+        for classification, vector in zip(*get_vectors(store, patient)):
+            vectors_by_classification.setdefault(classification, []).append(vector)
+    return vectors_by_classification
 
 
 def format_vec(vec):
@@ -66,22 +93,30 @@ def get_formatted_angle(vec, ref_vec):
 
 
 def main():
-    output_path, trees, classification_config = get_input()
-    map_classification_to_vectors = analyse_angles(trees, classification_config)
+    output_path, store, classification_config = get_input()
+    ignored_patients = get_ignored_patients()
+    print(ignored_patients)
+
+    def contribute(curr_store: CohortStore, patient: str):
+        return analyse_angles(curr_store, patient, classification_config)
+
+    vectors = {c: config["vector"] for c, config in classification_config.items() if "vector" in config}
+    aggregation = aggregate_cohort(store, "angle_analysis", contribute, {"vectors": vectors, "bins": HISTOGRAM_BINS})
+    vectors_by_classification = get_vectors_by_classification(store, ignored_patients) if list_vectors else {}
     summary_list = []
-    for classification, vectors in map_classification_to_vectors.items():
-        avg = np.average(vectors, axis=0)
+    for classification, total in aggregation.get_total(excluded_patients=ignored_patients).items():
+        if not total.get("count"):
+            continue
+        avg = np.array(total["sum"]) / total["count"]
         print(f"{col.red(classification)}:")
-        try:
-            ref_vec = classification_config[classification]["vector"]
-            summary_list.append((get_angle(avg, ref_vec), classification, len(vectors)))
-            print(f"angle avg to ref:\t{get_formatted_angle(avg, ref_vec)}")
-            print(f"ref:\t{format_vec(ref_vec)}")
-        except KeyError:
-            ref_vec = None
+        ref_vec = np.array(classification_config[classification]["vector"])
+        summary_list.append((get_angle(avg, ref_vec), classification, total["count"]))
+        print(f"angle avg to ref:\t{get_formatted_angle(avg, ref_vec)}")
+        print(f"ref:\t{format_vec(ref_vec)}")
         print(f"avg:\t{format_vec(avg)}")
-        for vector in sorted(vectors, key=lambda x: get_angle(x, ref_vec)):
-            print(f'\t{format_vec(vector)} {"" if ref_vec is None else get_formatted_angle(vector, ref_vec)}')
+        print(f"histogram ({180 // HISTOGRAM_BINS}° bins):\t{' '.join(map(str, total['histogram']))}")
+        for vector in sorted(vectors_by_classification.get(classification, []), key=lambda x: get_angle(x, ref_vec)):
+            print(f"\t{format_vec(vector)} {get_formatted_angle(vector, ref_vec)}")
         print()
     print("Summary list:")
     print("\n".join(map(lambda x: f"{x[0]/np.pi*180:8.2f}° {x[1]:<12} \t(count={x[2]})", sorted(summary_list))))
@@ -1,13 +1,17 @@
 import subprocess
 import sys
-from collections import defaultdict
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 import re
 
 import networkx as nx
+import numpy as np
 import yaml
 
+from airway.classification.split_classification import add_subtree_hashes_in_tree
+from airway.util.cohort_aggregation import CohortAggregation, aggregate_cohort
+from airway.util.cohort_store import CohortStore, load_cohort_store
 from airway.util.config_parsers import parse_classification_config
 from airway.util.util import get_data_paths_from_args, generate_pdf_report, get_ignored_patients
 
@@ -22,15 +26,11 @@ def get_input():
     for cc_dict in classification_config.values():
         if "clustering_endnode" not in cc_dict:
             cc_dict["clustering_endnode"] = False
-    trees: List[nx.Graph] = []
-    ignored_patients = get_ignored_patients()
-    for tree_path in Path(tree_input_path).glob("*/tree.graphml"):
-        if tree_path.parent.name not in ignored_patients:
-            trees.append(nx.read_graphml(tree_path))
-    return output_data_path, trees, classification_config, render_path
+    store = load_cohort_store(tree_input_path)
+    return output_data_path, store, classification_config, render_path
 
 
-def get_latex_table(cluster_trees: List[Tuple[str, List[nx.Graph]]], patient_count: int):
+def get_latex_table(cluster_trees: List[Tuple[str, List[str]]], patient_count: int):
     table = ""
 
     class LatexBlock:
@@ -68,38 +68,80 @@ def get_latex_table(cluster_trees: List[Tuple[str, List[nx.Graph]]], patient_cou
     return table
 
 
+def get_subtree_hashes(store: CohortStore, patient: str, classification_config) -> Dict[str, int]:
+    """Subtree hash (see split_classification.py) of each node in classify_for, e.g. {"LUpperLobe": 123, ...}"""
+    node_rows, _ = store.get_rows(patient)
+    classifications = np.asarray(store.nodes["split_classification"][node_rows])
+    hashes = np.asarray(store.nodes["subtree_hash"][node_rows])
+    is_start_node = np.isin(classifications, classify_for)
+    if np.all(hashes[is_start_node] != -1):
+        return dict(zip(classifications[is_start_node].tolist(), hashes[is_start_node].tolist()))
+    # Trees classified before the subtree hashes were added to stage-10
+    tree = store.get_graph(patient)
+    add_subtree_hashes_in_tree(tree, dict(nx.bfs_successors(tree, "0")), classification_config)
+    start_nodes = [node for node in tree.nodes.values() if node["split_classification"] in classify_for]
+    return {node["split_classification"]: node["subtree_hash"] for node in start_nodes}
+
+
+def get_clustering(store: CohortStore, classification_config) -> CohortAggregation:
+    """Patients of each cluster as {start_node: {subtree hash: {patient: 1}}}, only new patients are clustered"""
+
+    def contribute(curr_store: CohortStore, patient: str):
+        if not curr_store.has_graph(patient):
+            return {}
+        subtree_hashes = get_subtree_hashes(curr_store, patient, classification_config)
+        return {start_node: {str(subtree_hash): {patient: 1}} for start_node, subtree_hash in subtree_hashes.items()}
+
+    parameters = {"classify_for": classify_for, "classification_config": classification_config, "key": "subtree_hash"}
+    return aggregate_cohort(store, "clustering", contribute, parameters)
+
+
+def find_patients_with_same_structure(store: CohortStore, patient: str, classification: str) -> List[str]:
+    """Returns all patients whose subtree of the given classification (e.g. "LB1+2+3") has the same structure as
+    the one of the given patient, including the patient itself
+    """
+    is_classification = store.select_nodes(split_classification=classification)
+    hashes = np.asarray(store.nodes["subtree_hash"][is_classification])
+    patients = np.asarray(store.nodes["patient"][is_classification])
+    patient_hashes = hashes[(patients == patient) & (hashes != -1)]
+    return sorted(set(patients[np.isin(hashes, patient_hashes)].tolist()))
+
+
 def main():
-    output_path, trees, classification_config, render_path = get_input()
+    output_path, store, classification_config, render_path = get_input()
     print(render_path)
     print(sys.argv)
     if sys.argv[4].lower() == "true":
         subprocess.Popen(["xdg-open", f"{output_path / 'clustering_report.pdf'}"])
         sys.exit()
-    clustering = {c: defaultdict(lambda: []) for c in classify_for}
+    ignored_patients = get_ignored_patients()
+    aggregation = get_clustering(store, classification_config)
+    total = aggregation.get_total(excluded_patients=ignored_patients)
+    patient_count = len(set(aggregation.patients) - ignored_patients)
+
+    @lru_cache(maxsize=None)
+    def get_cluster_names(patient: str) -> Dict[str, str]:
+        tree = store.get_graph(patient)
+        return cluster(tree, dict(nx.bfs_successors(tree, "0")), classification_config)
+
     html_content = ["# Auto-Generated Clustering Report\n"]
     latex_content = []
-    for index, tree in enumerate(trees, 1):
-        successors = dict(nx.bfs_successors(tree, "0"))
-        clusters = cluster(tree, successors, classification_config)
-        print("===", index, tree.graph["patient"], "===")
-        for c, k in clusters.items():
-            if c == "LUpperLobe":
-                print(k)
-        print()
-        for start_node, curr_cluster in clusters.items():
-            clustering[start_node][curr_cluster].append(tree)
-    for start_node, curr_clustering in clustering.items():
+    for start_node in classify_for:
+        # The structure of each cluster is shown using the first patient in it
+        curr_clustering = {}
+        for patients in map(sorted, total.get(start_node, {}).values()):
+            curr_clustering[get_cluster_names(patients[0])[start_node]] = patients
         html_content.append(f"## Clustering of {start_node}\n")
-        sorted_curr_clustering = sorted(curr_clustering.items(), key=lambda k: -len(k[1]))
+        sorted_curr_clustering = sorted(curr_clustering.items(), key=lambda k: (-len(k[1]), k[1][0]))
         if start_node in latex_tables_for:
-            latex_content.append(get_latex_table(sorted_curr_clustering[:3], patient_count=len(trees)))
-        for key, trees_in_cluster in sorted_curr_clustering:
-            patient = trees_in_cluster[0].graph["patient"]
+            latex_content.append(get_latex_table(sorted_curr_clustering[:3], patient_count=patient_count))
+        for key, patients_in_cluster in sorted_curr_clustering:
+            patient = patients_in_cluster[0]
             img_path = Path(render_path) / str(patient) / "bronchus0.png"
             html_content.append(f"![{patient}]({img_path})\n")
             html_content.append(f"### ^ Example patient {patient}\n")
-            percent = f"{len(trees_in_cluster)/len(trees)*100:.1f}%"
-            html_content.append(f"### {len(trees_in_cluster)} ({percent}) patients with this structure:\n")
+            percent = f"{len(patients_in_cluster)/patient_count*100:.1f}%"
+            html_content.append(f"### {len(patients_in_cluster)} ({percent}) patients with this structure:\n")
             html_content.append(key + "\n")
     generate_pdf_report(output_path, "clustering_report", "".join(html_content))
 
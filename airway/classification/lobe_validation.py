@@ -1,9 +1,10 @@
 import re
-from pathlib import Path
-from typing import List
+from typing import Dict
 
-import networkx as nx
+import numpy as np
 
+from airway.util.cohort_aggregation import aggregate_cohort
+from airway.util.cohort_store import CohortStore, load_cohort_store
 from airway.util.config_parsers import parse_array_encoding, parse_classification_config
 from airway.util.util import get_data_paths_from_args, get_ignored_patients
 
@@ -11,42 +12,60 @@ from airway.util.util import get_data_paths_from_args, get_ignored_patients
 def get_input():
     output_data_path, tree_input_path = get_data_paths_from_args()
     classification_config = parse_classification_config()
-    trees: List[nx.Graph] = []
-    for tree_path in Path(tree_input_path).glob("*/tree.graphml"):
-        trees.append(nx.read_graphml(tree_path))
-    return output_data_path, trees, classification_config
+    store: CohortStore = load_cohort_store(tree_input_path)
+    return output_data_path, store, classification_config
+
+
+def get_confusion(store: CohortStore, patient: str, lobe_encoding: Dict[str, int]):
+    """Counts of {classification: {lobe of the segmentation: count}} of all nodes classified as a lobe"""
+    if not store.has_graph(patient):
+        return {}
+    node_rows, _ = store.get_rows(patient)
+    classifications = np.asarray(store.nodes["split_classification"][node_rows])
+    lobes = np.asarray(store.nodes["lobe"][node_rows])
+    is_lobe_node = np.isin(classifications, list(lobe_encoding))
+    pairs, counts = np.unique(
+        np.stack([classifications[is_lobe_node], lobes[is_lobe_node].astype(str)], axis=1), axis=0, return_counts=True
+    )
+    confusion = {}
+    for (classification, lobe), count in zip(pairs.tolist(), counts.tolist()):
+        confusion.setdefault(classification, {})[lobe] = count
+    return {"confusion": confusion}
 
 
 def main():
-    output_path, trees, classification_config = get_input()
+    output_path, store, classification_config = get_input()
     ignored_patients = get_ignored_patients()
     encoding = {re.sub(r"^([RL])[a-z]+", r"\1", k): v for k, v in parse_array_encoding().items()}
     lobe_encoding = {k: v for k, v in encoding.items() if "Lobe" in k}
     decoding = dict(zip(encoding.values(), encoding.keys()))
 
-    no_ignored = []
-    with_ignored = []
-    for index, tree in enumerate(trees, 1):
-        for node_id in tree.nodes:
-            node = tree.nodes[node_id]
-            if node["split_classification"] in lobe_encoding:
-                correctly_classified = node["lobe"] == encoding[node["split_classification"]]
-                if str(tree.graph["patient"]) not in ignored_patients:
-                    no_ignored.append(correctly_classified)
-                    if not correctly_classified:
-                        print(f"Patient {tree.graph['patient']}")
-                        print(f"Mistaken {decoding[node['lobe']]} (Synapse) for {node['split_classification']}\n")
-                with_ignored.append(correctly_classified)
-
-    def show_stats(lis: List[bool]):
-        s = sum(lis)
-        t = len(lis)
+    def contribute(curr_store: CohortStore, patient: str):
+        return get_confusion(curr_store, patient, lobe_encoding)
+
+    aggregation = aggregate_cohort(store, "lobe_validation", contribute, lobe_encoding)
+    for patient in aggregation.patients:
+        if patient in ignored_patients:
+            continue
+        for classification, lobe_counts in aggregation.get_contribution(patient).get("confusion", {}).items():
+            for lobe, count in lobe_counts.items():
+                if int(lobe) != lobe_encoding[classification]:
+                    for _ in range(count):
+                        print(f"Patient {patient}")
+                        print(f"Mistaken {decoding[int(lobe)]} (Synapse) for {classification}\n")
+
+    def show_stats(total):
+        confusion = total.get("confusion", {})
+        s = sum(
+            count for c, lobes in confusion.items() for lobe, count in lobes.items() if int(lobe) == lobe_encoding[c]
+        )
+        t = sum(count for lobes in confusion.values() for count in lobes.values())
         print(f"{s}/{t} = {s / t:%}")
 
     print("Without ignored patients:")
-    show_stats(no_ignored)
+    show_stats(aggregation.get_total(excluded_patients=ignored_patients))
     print("With ignored patients:")
-    show_stats(with_ignored)
+    show_stats(aggregation.total)
 
 
 if __name__ == "__main__":
@@ -1,29 +1,46 @@
 import re
-from pathlib import Path
 from typing import List, Tuple, Set, Dict
 
 import networkx as nx
 import yaml
 
+from airway.util.cohort_aggregation import aggregate_cohort
+from airway.util.cohort_store import CohortStore, load_cohort_store
 from airway.util.config_parsers import parse_array_encoding, parse_classification_config
 from airway.util.util import get_data_paths_from_args, get_ignored_patients
 
 
 def get_input():
     output_data_path, tree_input_path = get_data_paths_from_args()
-    trees: List[List[nx.Graph]] = []
-    for tree_path in Path(tree_input_path).glob("*"):
-        pair = []
-        for name in ["tree.graphml", "tree_gt.graphml"]:
-            if (tree_path / name).exists():
-                pair.append(nx.read_graphml(tree_path / name))
-        trees.append(pair)
+    store = load_cohort_store(tree_input_path)
     classification_config = parse_classification_config()
-    return output_data_path, trees, classification_config
+    return output_data_path, store, classification_config
+
+
+def validate_segments(tree_pair: List[nx.Graph], clustering_endnodes: Set[str], children: Dict[str, Set[str]]):
+    """Contribution of a single patient: count of correctly classified and of all segment-like nodes"""
+    tree, tree_gt = tree_pair * 2 if len(tree_pair) == 1 else tree_pair
+    # Ignore some nodes as otherwise segments may be counted twice (e.g.: LB7+8, LB7, and LB8)
+    ignored_nodes: Set[str] = set()
+    correct = total = 0
+    for node_id in tree_gt.nodes:
+        node_gt = tree_gt.nodes[node_id]
+        node = tree.nodes[node_id]
+
+        sc = node["split_classification"]
+        sc_gt = node_gt.get("split_classification_gt", "")
+        if sc_gt == "":
+            sc_gt = sc
+
+        if sc_gt in clustering_endnodes and sc_gt not in ignored_nodes:
+            ignored_nodes |= children.get(sc_gt, set())
+            correct += sc_gt == sc
+            total += 1
+    return {"correct": correct, "total": total}
 
 
 def main():
-    output_path, trees, classification_config = get_input()
+    output_path, store, classification_config = get_input()
     ignored_patients = get_ignored_patients()
     clustering_endnodes = {
         name for name, config in classification_config.items() if config.get("clustering_endnode", False)
@@ -33,40 +50,27 @@ def main():
     }
     print(len(clustering_endnodes), "segment-like nodes", clustering_endnodes)
 
-    no_ignored = []
-    with_ignored = []
-    for index, tree_pair in enumerate(trees, 1):
-        tree, tree_gt = tree_pair * 2 if len(tree_pair) == 1 else tree_pair
-        # Ignore some nodes as otherwise segments may be counted twice (e.g.: LB7+8, LB7, and LB8)
-        ignored_nodes: Set[str] = set()
-        # print(f"\nPatient {tree.graph['patient']}")
-        for node_id in tree_gt.nodes:
-            node_gt = tree_gt.nodes[node_id]
-            node = tree.nodes[node_id]
-
-            sc = node["split_classification"]
-            sc_gt = node_gt.get("split_classification_gt", "")
-            if sc_gt == "":
-                sc_gt = sc
-
-            if sc_gt in clustering_endnodes and sc_gt not in ignored_nodes:
-                ignored_nodes |= children.get(sc_gt, set())
-                correctly_classified = sc_gt == sc
-                if str(tree.graph["patient"]) not in ignored_patients:
-                    no_ignored.append(correctly_classified)
-                with_ignored.append(correctly_classified)
-
-    def show_stats(lis: List[bool]):
-        s = sum(lis)
-        t = len(lis)
+    def contribute(curr_store: CohortStore, patient: str):
+        tree_pair = [
+            curr_store.get_graph(patient, name) for name in ["tree", "tree_gt"] if curr_store.has_graph(patient, name)
+        ]
+        return validate_segments(tree_pair, clustering_endnodes, children) if tree_pair else {}
+
+    parameters = {"clustering_endnodes": sorted(clustering_endnodes)}
+    parameters["children"] = {name: sorted(curr_children) for name, curr_children in children.items()}
+    aggregation = aggregate_cohort(store, "segment_validation", contribute, parameters)
+
+    def show_stats(total):
+        s = total.get("correct", 0)
+        t = total.get("total", 0)
         print(f"{s}/{t} = {s/t:%}")
-        no_ignored_count = len(trees) - len(ignored_patients)
+        no_ignored_count = len(aggregation.patients) - len(ignored_patients)
         print(f"{t/no_ignored_count} segments per patient")
 
     print("Without ignored patients:")
-    show_stats(no_ignored)
+    show_stats(aggregation.get_total(excluded_patients=ignored_patients))
     # print("With ignored patients:")
-    # show_stats(with_ignored)
+    # show_stats(aggregation.total)
 
 
 if __name__ == "__main__":
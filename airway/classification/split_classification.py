@@ -1,39 +1,262 @@
 """ Classify splits in graphml tree
 """
-import copy
+import hashlib
 import itertools
 import math
 import sys
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
 from queue import PriorityQueue
 from typing import Any, Dict, List, Tuple, Optional
 
 import numpy as np
 import networkx as nx
 
-from airway.util.config_parsers import parse_classification_config
+from airway.util.classification_rules import ClassificationRules, load_classification_rules
+from airway.util.cohort_store import add_graphs_to_cohort_store
 from airway.util.util import get_data_paths_from_args
 
-trees_thrown_out = 0
-global_angles = []
-
 
 def get_inputs():
     output_data_path, tree_input_path = get_data_paths_from_args(inputs=1)
-    classification_config = parse_classification_config()
+    rules = load_classification_rules()
     tree = nx.read_graphml(tree_input_path / "tree.graphml")
     output_path = output_data_path / "tree.graphml"
-    return output_path, tree, classification_config
+    # Budget of the search as set in stage_configs.yaml, 0 means unlimited
+    try:
+        budget = SearchBudget(max_expansions=int(sys.argv[3]), max_seconds=float(sys.argv[4]))
+    except IndexError:
+        budget = SearchBudget()
+    # Number of processes used to classify independent subtrees (e.g. the lungs) of a single patient
+    try:
+        workers = int(sys.argv[5])
+    except IndexError:
+        workers = 1
+    return output_path, tree, rules, budget, workers
 
 
 def get_point(node):
     return np.array([node["x"], node["y"], node["z"]])
 
 
+class AngleStatistics:
+    """Opt-in instrumentation for the angles evaluated during the search
+
+    Only a fixed size histogram and running sums are kept, so memory does not grow with the search space.
+    """
+
+    def __init__(self, bins: int = 180):
+        self.bin_edges = np.linspace(0, math.pi, bins + 1)
+        self.histogram = np.zeros(bins, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, angles: np.ndarray):
+        angles = np.ravel(angles)
+        self.histogram += np.histogram(angles, bins=self.bin_edges)[0]
+        self.count += angles.size
+        self.total += float(np.sum(angles))
+
+    def merge(self, other: "AngleStatistics"):
+        self.histogram += other.histogram
+        self.count += other.count
+        self.total += other.total
+
+    def __str__(self):
+        if self.count == 0:
+            return "No angles evaluated"
+        mean_degrees = self.total / self.count / math.pi * 180
+        return f"{self.count:,} angles evaluated, mean angle: {mean_degrees:.2f}°"
+
+
+def get_unit_vectors(vectors: np.ndarray) -> np.ndarray:
+    """Normalizes each row of vectors to length 1, rows of length 0 are left as 0"""
+    vectors = np.asarray(vectors, dtype=float).reshape(-1, 3)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms != 0)
+
+
+def get_angle_matrix(unit_vectors: np.ndarray, target_unit_vectors: np.ndarray) -> np.ndarray:
+    """Returns the angle (radians) between each unit vector (rows) and each target unit vector (columns)"""
+    return np.arccos(np.clip(unit_vectors @ target_unit_vectors.T, -1, 1))
+
+
+def get_cost_matrix(angle_matrix: np.ndarray, exp=2, div=math.pi / 3) -> np.ndarray:
+    return (angle_matrix / div) ** exp
+
+
 def cost_exponential_diff_function(curr_vec: np.array, target_vec: np.array, exp=2, div=math.pi / 3):
-    angle_pre_arccos = (curr_vec @ target_vec) / (np.linalg.norm(curr_vec) * np.linalg.norm(target_vec))
-    angle_radians = np.arccos(np.clip(angle_pre_arccos, -1, 1))
-    global_angles.append(angle_radians)
-    return (angle_radians / div) ** exp
+    angle_radians = get_angle_matrix(get_unit_vectors(curr_vec), get_unit_vectors(target_vec))[0, 0]
+    return get_cost_matrix(angle_radians, exp, div)
+
+
+class SearchBudget:
+    """Limits the search in classify_tree by expansions and/or wall-clock seconds, 0 means unlimited"""
+
+    def __init__(self, max_expansions: int = 0, max_seconds: float = 0):
+        self.max_expansions = max_expansions
+        self.max_seconds = max_seconds
+        self.start_time = time.monotonic()
+
+    def is_exhausted(self, statistics: "SearchStatistics") -> bool:
+        if self.max_expansions and statistics.expansions >= self.max_expansions:
+            return True
+        return bool(self.max_seconds) and time.monotonic() - self.start_time >= self.max_seconds
+
+
+class SearchStatistics:
+    """Counters of a classify_tree search, these are written into the graph attributes of the output tree"""
+
+    def __init__(self):
+        self.expansions = 0
+        self.queue_peak = 0
+        self.trees_thrown_out = 0
+        self.budget_exhausted = False
+
+    def merge(self, other: "SearchStatistics"):
+        self.expansions += other.expansions
+        self.queue_peak = max(self.queue_peak, other.queue_peak)
+        self.trees_thrown_out += other.trees_thrown_out
+        self.budget_exhausted |= other.budget_exhausted
+
+    def add_to_graph(self, tree: nx.Graph):
+        tree.graph["search_expansions"] = self.expansions
+        tree.graph["search_queue_peak"] = self.queue_peak
+        tree.graph["search_trees_thrown_out"] = self.trees_thrown_out
+        tree.graph["search_budget_exhausted"] = self.budget_exhausted
+
+
+# When the budget is exhausted at most this many tree variations in the queue are completed greedily
+MAX_GREEDY_COMPLETIONS = 10
+
+
+def get_cost_with_permutations(
+    curr_tree: nx.Graph,
+    curr_node_id: str,
+    successors: Dict[str, List[str]],
+    classification_config: Dict[str, Dict[str, Any]],
+    rules: ClassificationRules,
+    angle_statistics: AngleStatistics = None,
+) -> List[Tuple[float, List[Tuple[str, Optional[str]]], Dict[str, float]]]:
+    """Returns every permutation of classifications for the children of curr_node_id, sorted by cost
+
+    Each entry is the cost of the permutation, a list of (child_id, classification) pairs, and the cost of
+    each child which has a vector.
+    """
+    curr_node = curr_tree.nodes[curr_node_id]
+    curr_classification = curr_node["split_classification"]
+    curr_node_point = get_point(curr_node)
+
+    # Save which classifications have already been used so no invalid trees are created unnecessarily
+    curr_classifications_used = rules.get_bits(
+        curr_tree.nodes[index]["split_classification"] for index in curr_tree.nodes
+    )
+
+    # If there are more children than in the config then extend list to account for all of them
+    children_in_rules: List[Optional[str]] = [
+        child
+        for child in classification_config[curr_classification]["children"]
+        if not rules.bits[child] & curr_classifications_used
+    ]
+    # The ids as strings of nodes which succeed current node
+    successor_ids: List[str] = successors.get(curr_node_id, [])
+    adjust_for_unaccounted_children: int = len(successor_ids) - len(children_in_rules)
+    children_in_rules.extend([None] * adjust_for_unaccounted_children)
+
+    # Cost for each child (rows) and each classification (columns, see "vector_index") in a single matmul
+    child_vectors = [get_point(curr_tree.nodes[child_id]) - curr_node_point for child_id in successor_ids]
+    angle_matrix = get_angle_matrix(get_unit_vectors(child_vectors), rules.unit_vectors)
+    cost_matrix = get_cost_matrix(angle_matrix, 1, 1)
+    if angle_statistics is not None and successor_ids:
+        vector_indices = [
+            classification_config[c]["vector_index"]
+            for c in set(children_in_rules)
+            if "vector" in classification_config.get(c, {})
+        ]
+        angle_statistics.add(angle_matrix[:, vector_indices])
+
+    # Defines list of all permutations of children including their cost
+    # e.g. [(34.3, [('3', 'Bronchus')], {'3': 34.3}) cost and the permutation where the node id specifies which
+    # classification should be used
+    cost_with_perm: List[Tuple[float, List[Tuple[str, Optional[str]]], Dict[str, float]]] = []
+    for perm in set(itertools.permutations(children_in_rules, r=len(successor_ids))):
+        successors_with_permutations: List[Tuple[str, Optional[str]]] = list(zip(successor_ids, perm))
+
+        # Check with the bitsets of each child and all of its descendants whether any of them share descendants
+        permutation_shares_descendants = False
+        permutation_bits = 0
+        for _, p in successors_with_permutations:
+            if p is not None:
+                subtree_bits = classification_config[p]["subtree_bits"] if p in classification_config else rules.bits[p]
+                permutation_shares_descendants |= bool(permutation_bits & subtree_bits)
+                permutation_bits |= subtree_bits
+        if permutation_shares_descendants:
+            continue
+
+        # Then check whether all children config rules have vectors defined, if not just take the best
+        perm_cost = 0
+        do_all_classifications_have_vectors = any(
+            classification in classification_config and "vector" in classification_config.get(classification, {})
+            for _, classification in successors_with_permutations
+        )
+
+        # Calculate cost of current permutation
+        child_costs: Dict[str, float] = {}
+        if do_all_classifications_have_vectors:
+            for row, (child_id, classification) in enumerate(successors_with_permutations):
+                if "vector" in classification_config.get(classification, {}):
+                    child_costs[child_id] = float(
+                        cost_matrix[row, classification_config[classification]["vector_index"]]
+                    )
+                    perm_cost += child_costs[child_id]
+        cost_with_perm.append((perm_cost, successors_with_permutations, child_costs))
+
+        # Only add first permutation if not all children have vectors
+        if not do_all_classifications_have_vectors:
+            # print("Break since not all classifications have vectors")
+            break
+
+    # Sort by cost, so we evaluate low cost first
+    cost_with_perm.sort(key=lambda k: k[0])
+    return cost_with_perm
+
+
+def get_permutation_tree(
+    curr_tree: nx.Graph, successors_with_permutations: List[Tuple[str, Optional[str]]], child_costs: Dict[str, float]
+) -> nx.Graph:
+    perm_tree = curr_tree.copy()
+    for child_id, classification in successors_with_permutations:
+        if classification is not None:
+            perm_tree.nodes[child_id]["split_classification"] = classification
+    for child_id, child_cost in child_costs.items():
+        perm_tree.nodes[child_id]["cost"] = child_cost
+    return perm_tree
+
+
+def complete_tree_greedily(
+    tree: nx.Graph,
+    next_node_id_list: List[str],
+    cost: float,
+    successors: Dict[str, List[str]],
+    classification_config: Dict[str, Dict[str, Any]],
+    rules: ClassificationRules,
+) -> Tuple[float, nx.Graph]:
+    """Classifies all remaining nodes by always taking the cheapest permutation, used when the budget is exhausted"""
+    next_node_id_list = list(next_node_id_list)
+    while next_node_id_list:
+        curr_node_id = next_node_id_list.pop(0)
+        cost_with_perm = get_cost_with_permutations(tree, curr_node_id, successors, classification_config, rules)
+        if not cost_with_perm:
+            continue
+        perm_cost, successors_with_permutations, child_costs = cost_with_perm[0]
+        tree = get_permutation_tree(tree, successors_with_permutations, child_costs)
+        cost += perm_cost
+        next_node_id_list.extend(
+            child_id
+            for child_id, classification in successors_with_permutations
+            if classification in classification_config
+        )
+    return cost, tree
 
 
 def classify_tree(
@@ -42,6 +265,11 @@ def classify_tree(
     classification_config: Dict[str, Dict[str, Any]],
     starting_node="0",
     starting_cost=0,
+    rules: ClassificationRules = None,
+    angle_statistics: AngleStatistics = None,
+    budget: SearchBudget = None,
+    statistics: SearchStatistics = None,
+    executor: Executor = None,
 ):
     """
     Creates every valid classification for a tree based on the rules in classification.yaml
@@ -50,8 +278,21 @@ def classify_tree(
         starting_* - function was called with these parameters
         curr_* - node which is temporarily considered root node in while loop
         child_* - nodes and their attributes which are children of curr
+
+    The angle cost of every (child, classification) pair of a node is computed once as a matrix,
+    permutations then only look up their entries. Pass angle_statistics to record the evaluated angles.
+
+    If a budget is given and it is exhausted, the cheapest tree variations in the queue are completed
+    greedily and the best valid one is returned (or the best invalid one if none is valid). This is
+    recorded in statistics.budget_exhausted.
+
+    If an executor is given, the children of the first take_best node with multiple children (i.e. the left
+    and right lung) are classified concurrently as independent subproblems, see classify_subtrees_in_parallel.
     """
-    global trees_thrown_out
+    if rules is None:
+        rules = load_classification_rules()
+    if statistics is None:
+        statistics = SearchStatistics()
 
     # queue contains the tree currently being worked on, and the current steps to work on
     tree_variations_queue = PriorityQueue()
@@ -63,110 +304,90 @@ def classify_tree(
     # While there are any tree variations in queue iterate over them
     while not tree_variations_queue.empty():
         curr_cost, curr_tree, next_node_id_list = tree_variations_queue.get()
-
-        # Save which classifications have already been used so no invalid trees are created unnecessarily
-        curr_classifications_used = {curr_tree.nodes[index]["split_classification"] for index in curr_tree.nodes}
+        statistics.expansions += 1
+
+        if budget is not None and budget.is_exhausted(statistics):
+            statistics.budget_exhausted = True
+            candidates = [(curr_cost, curr_tree, next_node_id_list)]
+            while not tree_variations_queue.empty() and len(candidates) < MAX_GREEDY_COMPLETIONS:
+                candidates.append(tree_variations_queue.get())
+            completed_trees = sorted(
+                (
+                    complete_tree_greedily(tree, node_ids, cost, successors, classification_config, rules)
+                    for cost, tree, node_ids in candidates
+                ),
+                key=lambda k: k[0],
+            )
+            for cost, tree in completed_trees:
+                if is_valid_tree(tree, classification_config, successors, starting_node, rules):
+                    return [(cost, tree)]
+            return completed_trees[:1]
 
         # If there is a tree variation which has no next nodes in list, then return it if it is a valid tree.
         # Sine tree variations is a priority queue this must be the best possible (lowest cost) tree
         if len(next_node_id_list) == 0:
-            if is_valid_tree(curr_tree, classification_config, successors, starting_node):
+            if is_valid_tree(curr_tree, classification_config, successors, starting_node, rules):
                 return [(curr_cost, curr_tree)]
             else:
-                trees_thrown_out += 1
+                statistics.trees_thrown_out += 1
                 continue
 
         # Divide next node list into curr node id, and rest which still need to be checked
         (curr_node_id, *rest_node_ids) = next_node_id_list
         curr_node = curr_tree.nodes[curr_node_id]
         curr_classification = curr_node["split_classification"]
-        curr_node_point = get_point(curr_node)
 
         # Only handle if current classification (i.e. Bronchus/RB3, etc) is actually in classification config
         if curr_classification in classification_config:
-
-            # If there are more children than in the config then extend list to account for all of them
-            children_in_rules: List[Optional[str]] = [
-                child
-                for child in classification_config[curr_classification]["children"]
-                if child not in curr_classifications_used
-            ]
-            # The ids as strings of nodes which succeed current node
-            successor_ids: List[str] = successors.get(curr_node_id, [])
-            adjust_for_unaccounted_children: int = len(successor_ids) - len(children_in_rules)
-            children_in_rules.extend([None] * adjust_for_unaccounted_children)
-
-            # Defines list of all permutations of children including their cost
-            # e.g. [(34.3, [('3', 'Bronchus')]) cost and the permutation where the node id specifies which
-            # classification should be used
-            cost_with_perm: List[Tuple[int, List[Tuple[str, str]]]] = []
-            for perm in set(itertools.permutations(children_in_rules, r=len(successor_ids))):
-                successors_with_permutations: List[Tuple[str, str]] = list(zip(successor_ids, perm))
-
-                # Create a list of all descendants for each children, this then can be used to check whether any
-                # of them share descendants when this list has non unique members
-                descendant_list = sum(
-                    [
-                        list(classification_config.get(p, {}).get("deep_descendants", set()))
-                        + ([] if p is None else [p])
-                        for _, p in successors_with_permutations
-                    ],
-                    [],
-                )
-                permutation_shares_descendants = len(descendant_list) != len(set(descendant_list))
-                if permutation_shares_descendants:
-                    continue
-
-                # Then check whether all children config rules have vectors defined, if not just take the best
-                perm_cost = curr_cost
-                do_all_classifications_have_vectors = any(
-                    classification in classification_config
-                    and "vector" in classification_config.get(classification, {})
-                    for _, classification in successors_with_permutations
-                )
-
-                # Calculate cost of current permutation
-                if do_all_classifications_have_vectors:
-                    for child_id, classification in successors_with_permutations:
-                        child_node = curr_tree.nodes[child_id]
-                        child_point = get_point(child_node)
-                        vec = child_point - curr_node_point
-                        if classification in classification_config:
-                            target_vec = classification_config[classification]["vector"]
-                            child_node["cost"] = float(cost_exponential_diff_function(vec, target_vec, 1, 1))
-                            perm_cost += child_node["cost"]
-                cost_with_perm.append((perm_cost, successors_with_permutations))
-
-                # Only add first permutation if not all children have vectors
-                if not do_all_classifications_have_vectors:
-                    # print("Break since not all classifications have vectors")
-                    break
-
-            # Sort by cost, so we evaluate low cost first
-            cost_with_perm.sort(key=lambda k: k[0])
+            cost_with_perm = get_cost_with_permutations(
+                curr_tree, curr_node_id, successors, classification_config, rules, angle_statistics
+            )
 
             # If cost_with_perm is not empty
             if cost_with_perm:
-                for perm_cost, successors_with_permutations in cost_with_perm:
+                for perm_cost, successors_with_permutations, child_costs in cost_with_perm:
                     # print("successors with permutations:", successors_with_permutations)
-                    perm_tree = curr_tree.copy()
-                    for child_id, classification in successors_with_permutations:
-                        if classification is not None:
-                            perm_tree.nodes[child_id]["split_classification"] = classification
+                    perm_cost += curr_cost
+                    perm_tree = get_permutation_tree(curr_tree, successors_with_permutations, child_costs)
                     next_nodes = rest_node_ids.copy() + [
                         child_id
                         for child_id, classification in successors_with_permutations
                         if classification in classification_config
                     ]
                     take_best = classification_config[curr_node["split_classification"]]["take_best"]
-                    if take_best:
+                    if take_best and executor is not None and len(successors[curr_node_id]) > 1:
+                        perm_cost, perm_tree = classify_subtrees_in_parallel(
+                            executor,
+                            perm_tree,
+                            successors,
+                            classification_config,
+                            successors[curr_node_id],
+                            perm_cost + cost_hack,
+                            rules=rules,
+                            angle_statistics=angle_statistics,
+                            budget=budget,
+                            statistics=statistics,
+                        )
+                        for child_node_id in successors[curr_node_id]:
+                            next_nodes.remove(child_node_id)
+                    elif take_best:
                         for child_node_id in successors[curr_node_id]:
                             perm_cost, perm_tree = classify_tree(
-                                perm_tree, successors, classification_config, child_node_id, perm_cost + cost_hack
+                                perm_tree,
+                                successors,
+                                classification_config,
+                                child_node_id,
+                                perm_cost + cost_hack,
+                                rules=rules,
+                                angle_statistics=angle_statistics,
+                                budget=budget,
+                                statistics=statistics,
+                                executor=executor,
                             )[0]
                             next_nodes.remove(child_node_id)
                     cost_hack += 0.000001
                     tree_variations_queue.put((perm_cost + cost_hack, perm_tree, next_nodes))
+                    statistics.queue_peak = max(statistics.queue_peak, tree_variations_queue.qsize())
                     if take_best:
                         break
                     # print("Breaking for node", node['split_classification'], "since it is specified as take_best")
@@ -177,12 +398,56 @@ def classify_tree(
     raise Exception("Sacrebleu! Only invalid trees are possible!")
 
 
+def _classify_subtree(tree, successors, classification_config, starting_node, search_kwargs):
+    """Runs in a worker process, the statistics are returned as they cannot be shared with the parent process"""
+    search_kwargs["statistics"] = SearchStatistics()
+    if search_kwargs["angle_statistics"] is not None:
+        search_kwargs["angle_statistics"] = AngleStatistics(len(search_kwargs["angle_statistics"].histogram))
+    cost, tree = classify_tree(tree, successors, classification_config, starting_node, **search_kwargs)[0]
+    return cost, tree, search_kwargs["statistics"], search_kwargs["angle_statistics"]
+
+
+def classify_subtrees_in_parallel(
+    executor: Executor,
+    tree: nx.Graph,
+    successors: Dict[str, List[str]],
+    classification_config: Dict[str, Dict[str, Any]],
+    starting_nodes: List[str],
+    starting_cost: float,
+    **search_kwargs,
+) -> Tuple[float, nx.Graph]:
+    """Classifies the subtrees below each starting node concurrently and merges them into a single tree
+
+    The subtrees of a take_best node are independent: they are searched separately anyway, and the
+    classifications of the left and right lung never overlap. The workers do not use an executor themselves,
+    and each of them gets the full budget.
+    """
+    statistics = search_kwargs["statistics"]
+    angle_statistics = search_kwargs["angle_statistics"]
+    worker_kwargs = {**search_kwargs, "executor": None}
+    futures = [
+        executor.submit(_classify_subtree, tree, successors, classification_config, starting_node, worker_kwargs)
+        for starting_node in starting_nodes
+    ]
+    merged_tree = tree.copy()
+    merged_cost = starting_cost
+    for future in futures:
+        subtree_cost, subtree, subtree_statistics, subtree_angle_statistics = future.result()
+        merge_tree_into(merged_tree, subtree)
+        merged_cost += subtree_cost
+        statistics.merge(subtree_statistics)
+        if angle_statistics is not None:
+            angle_statistics.merge(subtree_angle_statistics)
+    return merged_cost, merged_tree
+
+
 def merge_tree_into(tree_into, tree_other):
     for node_id in tree_into.nodes:
         node = tree_into.nodes[node_id]
         other_node = tree_other.nodes[node_id]
         if node["split_classification"][0] == "c":
             node["split_classification"] = other_node["split_classification"]
+            node["cost"] = other_node["cost"]
 
 
 def is_valid_tree(
@@ -190,8 +455,11 @@ def is_valid_tree(
     classification_config: Dict[str, Dict[str, Any]],
     successors: Dict[str, List[str]],
     start_node_id: str = "0",
+    rules: ClassificationRules = None,
 ):
-    required_descendants = set()
+    if rules is None:
+        rules = load_classification_rules()
+    required_descendants = 0
     have_appeared = set()
 
     def recursive_is_valid_tree(current_id):
@@ -204,11 +472,12 @@ def is_valid_tree(
             return False
         have_appeared.add(classification)
 
-        # Remember required descendants for subtree
-        required_descendants.discard(classification)
-        curr_descendants = set()
+        # Remember required descendants (as bitset) for subtree, labels which are only referenced in the config
+        # (e.g. as descendants) have a bit too
+        required_descendants &= ~rules.bits.get(classification, 0)
+        curr_descendants = 0
         if classification in classification_config:
-            curr_descendants = set(classification_config[classification].get("descendants", []))
+            curr_descendants = classification_config[classification]["descendant_bits"]
         required_descendants |= curr_descendants
 
         # Recursively iterate over each node and require each node to be valid
@@ -217,10 +486,13 @@ def is_valid_tree(
                 return False
 
         # Tree is valid only if all descendants have been removed in the recursive steps above
-        if not required_descendants.isdisjoint(curr_descendants):
+        if required_descendants & curr_descendants:
+            required_names, curr_names = [
+                set(rules.get_labels(bits)) for bits in (required_descendants, curr_descendants)
+            ]
             print(
-                f"Invalid because {required_descendants} is required as descendant, but is not available."
-                f" Descendants: {curr_descendants} for node {classification}"
+                f"Invalid because {required_names} is required as descendant, but is not available."
+                f" Descendants: {curr_names} for node {classification}"
             )
             return False
         return True
@@ -228,6 +500,37 @@ def is_valid_tree(
     return recursive_is_valid_tree(start_node_id)
 
 
+def select_classified_tree(
+    all_trees: List[Tuple[float, nx.Graph]],
+    classification_config: Dict[str, Dict[str, Any]],
+    successors: Dict[str, List[str]],
+    statistics: SearchStatistics,
+    rules: ClassificationRules = None,
+) -> nx.Graph:
+    """Returns the cheapest valid tree returned by classify_tree (the cheapest invalid one if none is valid)
+
+    How the tree was found is written into its graph attributes: search_result is optimal or best_found (if the
+    budget was exhausted) for valid trees, invalid or partial for invalid ones, along with the search statistics.
+    """
+    all_trees = sorted(all_trees, key=lambda x: x[0])
+    print(f"All trees: {len(all_trees)}")
+    validated_trees = [
+        (cost, curr_tree)
+        for cost, curr_tree in all_trees
+        if is_valid_tree(curr_tree, classification_config, successors, rules=rules)
+    ]
+    print(f"Valid trees: {len(validated_trees)}")
+    try:
+        classified_tree = validated_trees[0][1]
+        classified_tree.graph["search_result"] = "best_found" if statistics.budget_exhausted else "optimal"
+    except IndexError:
+        print("ERROR: Could not create valid tree! Using invalid tree instead.", file=sys.stderr)
+        classified_tree = all_trees[0][1]
+        classified_tree.graph["search_result"] = "partial" if statistics.budget_exhausted else "invalid"
+    statistics.add_to_graph(classified_tree)
+    return classified_tree
+
+
 def show_classification_vectors(tree, successors):
     for node_id, children_ids in successors.items():
         node = tree.nodes[node_id]
@@ -243,31 +546,6 @@ def show_classification_vectors(tree, successors):
     return tree
 
 
-def add_deep_descendants_to_classification_config(classification_config):
-    def recursive_get(classification):
-        if classification not in classification_config:
-            return []
-        cc = classification_config[classification]
-        dd = cc["deep_descendants"]
-        dd += cc.get("descendants", [])
-        for child in cc["children"]:
-            dd += recursive_get(child)
-        cc["deep_descendants"] = list(set(dd))
-        return dd
-
-    recursive_get("Trachea")
-
-
-def add_defaults_to_classification_config(classification_config):
-    defaults = {"children": [], "deep_descendants": [], "descendants": [], "take_best": False}
-    for cid in classification_config:
-        for key, val in defaults.items():
-            classification_config[cid][key] = classification_config[cid].get(key, copy.deepcopy(val))
-    for cid in classification_config:
-        if "vector" in classification_config[cid]:
-            classification_config[cid]["vector"] = np.array(classification_config[cid]["vector"])
-
-
 def add_default_split_classification_id_to_tree(tree: nx.Graph):
     for node in tree.nodes:
         tree.nodes[node]["split_classification_gt"] = ""
@@ -308,39 +586,75 @@ def add_colors_in_tree(tree, classification_config):
             pass
 
 
+def get_subtree_hash(classification: str, child_hashes: List[int]) -> int:
+    """Order independent (AHU style) hash of a classification and the hashes of its children
+
+    hashlib is used instead of hash(), as the latter differs between processes. The hash has 63 bits, so it can be
+    saved as signed 64 bit integer.
+    """
+    encoding = f"{classification}({','.join(map(str, sorted(child_hashes)))})"
+    return int.from_bytes(hashlib.sha1(encoding.encode()).digest()[:8], "big") >> 1
+
+
+def add_subtree_hashes_in_tree(tree, successors, classification_config):
+    """Adds the attribute subtree_hash to each classified node
+
+    Two nodes have the same hash if their subtrees have the same structure of classifications, as shown by the
+    clustering (stage-11): unclassified nodes are left out and subtrees end at clustering end nodes.
+    """
+
+    def recursive_add_hash(curr_id):
+        child_hashes = [recursive_add_hash(child_id) for child_id in successors.get(curr_id, [])]
+        classification = tree.nodes[curr_id]["split_classification"]
+        if classification not in classification_config:
+            return None
+        if classification_config[classification].get("clustering_endnode", False):
+            child_hashes = []
+        subtree_hash = get_subtree_hash(classification, [h for h in child_hashes if h is not None])
+        tree.nodes[curr_id]["subtree_hash"] = subtree_hash
+        return subtree_hash
+
+    recursive_add_hash("0")
+
+
 def main():
-    output_path, tree, classification_config = get_inputs()
+    output_path, tree, rules, budget, workers = get_inputs()
+    classification_config = rules.to_classification_config()
     successors = dict(nx.bfs_successors(tree, "0"))
-    add_defaults_to_classification_config(classification_config)
     add_default_split_classification_id_to_tree(tree)
-    add_deep_descendants_to_classification_config(classification_config)
     add_cost_by_level_in_tree(tree, successors)
     print("\n".join(map(str, classification_config.items())))
-    all_trees = classify_tree(tree, successors, classification_config)
+    statistics = SearchStatistics()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            all_trees = classify_tree(
+                tree,
+                successors,
+                classification_config,
+                rules=rules,
+                budget=budget,
+                statistics=statistics,
+                executor=executor,
+            )
+    else:
+        all_trees = classify_tree(
+            tree, successors, classification_config, rules=rules, budget=budget, statistics=statistics
+        )
     # print(f"All trees: {len(all_trees)}")
-    all_trees.sort(key=lambda x: x[0])
-    validated_trees = []
-    print(f"Invalid trees thrown out: {trees_thrown_out}")
-    print(f"All trees: {len(all_trees)}")
-    for cost, curr_tree in all_trees:
-        if is_valid_tree(curr_tree, classification_config, successors):
-            validated_trees.append((cost, curr_tree))
-    print(f"Valid trees: {len(validated_trees)}")
+    print(f"Expansions: {statistics.expansions}, queue peak: {statistics.queue_peak}")
+    print(f"Invalid trees thrown out: {statistics.trees_thrown_out}")
+    if statistics.budget_exhausted:
+        print("WARNING: Search budget exhausted, the classification is the best one found so far")
     # for curr_cost, curr_tree in validated_trees:
     #     all_classifications = get_all_classifications_in_tree(curr_tree, successors)
     #     print(f"Cost={curr_cost:.2f}, {'B1+2 is in tree' if 'LB1+2' in all_classifications else ''}")
     # print('\n'.join(map(lambda a: f"{a[0]}: {a[1]}", validated_trees_with_cost)))
-
-    try:
-        classified_tree = validated_trees[0][1]
-    except IndexError:
-        print("ERROR: Could not create valid tree! Using invalid tree instead.", file=sys.stderr)
-        classified_tree = all_trees[0][1]
+    classified_tree = select_classified_tree(all_trees, classification_config, successors, statistics, rules)
     add_colors_in_tree(classified_tree, classification_config)
+    add_subtree_hashes_in_tree(classified_tree, successors, classification_config)
     show_classification_vectors(classified_tree, successors)
     nx.write_graphml(classified_tree, output_path)
-
-    # print("Angles found: ", ' '.join(map(lambda x: f"{x/math.pi*180:.2f}°", sorted(global_angles))))
+    add_graphs_to_cohort_store(output_path.parent, {"tree": classified_tree})
 
 
 if __name__ == "__main__":
@@ -3,7 +3,9 @@ from queue import Queue
 import networkx as nx
 import numpy as np
 
+from airway.util.dtypes import allocate_volume
 from airway.util.util import get_data_paths_from_args
+from airway.util.volumes import load_volume, load_volume_metadata, save_volume, save_volume_statistics
 from airway.util.helper_functions import adjacent
 
 
@@ -56,7 +58,11 @@ def get_point(node):
 
 def main():
     output_data_path, reduced_model_data_path, tree_data_path = get_data_paths_from_args(inputs=2)
-    model = np.zeros(np.load(reduced_model_data_path / "reduced_model.npz")["arr_0"].shape)
+    # The shape is saved with the statistics of the reduced model, older reduced models are loaded for it
+    shape = load_volume_metadata(reduced_model_data_path, "reduced_model").get("shape")
+    if shape is None:
+        shape = load_volume(reduced_model_data_path, "reduced_model").shape
+    model = allocate_volume("model", shape)
     tree = nx.read_graphml(tree_data_path / "tree.graphml")
     for parent_id, child_ids in nx.bfs_successors(tree, "0"):
         parent_node = tree.nodes[parent_id]
@@ -65,8 +71,9 @@ def main():
             child_point = get_point(tree.nodes[child_id])
             fill_line(model, parent_point, child_point, max(2, parent_node["group_size"] / 2))
 
-    print(*zip(*np.unique(model, return_counts=True)))
-    np.savez_compressed(output_data_path / "model.npz", model)
+    save_volume(output_data_path, "model", model)
+    statistics = save_volume_statistics(output_data_path, "model", model)
+    print(*((int(label), count) for label, count in statistics["label_counts"].items()))
 
 
 if __name__ == "__main__":
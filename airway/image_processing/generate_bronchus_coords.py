@@ -1,36 +1,32 @@
 import numpy as np
 
+from airway.util.helper_functions import get_labelled_coords, get_outer_shell
 from airway.util.util import get_data_paths_from_args
+from airway.util.volumes import load_label_mask, load_volume
 
 output_data_path, input_data_path = get_data_paths_from_args()
 
-reduced_data_file = input_data_path / "reduced_model.npz"
-data = np.load(reduced_data_file)["arr_0"]
+data = load_volume(input_data_path, "reduced_model", "model")
 
-model = np.append(np.where(data == 1), ([data[data == 1]]), axis=0)
+# All coordinates are saved as rows x, y, z and label with dtype uint16, see get_labelled_coords()
+bronchus = load_label_mask(input_data_path, "reduced_model", 1, volume=data)
+model = get_labelled_coords(data, bronchus)
 print(f"Model size: {len(model[0]):,}")
 np.savez_compressed(output_data_path / "bronchus_coords", model)
 
-model_adjacency_sum = np.sum([np.roll(data, i, axis=ax) for i in [-1, 1] for ax in [0, 1, 2]], axis=0)
-model_outer_shell_only = np.where(np.logical_and(data == 1, model_adjacency_sum != 6))
-model_outer_shell_only = np.append(
-    model_outer_shell_only, [data[np.logical_and(data == 1, model_adjacency_sum != 6)]], axis=0
-)
+# Bronchus voxels with at least one neighbour which is not bronchus
+model_outer_shell_only = get_labelled_coords(data, get_outer_shell(bronchus))
 print(f"Outer shell model size: {len(model_outer_shell_only[0]):,}")
-np.savez_compressed(output_data_path / "bronchus_coords_outer_shell", np.array(model_outer_shell_only))
+np.savez_compressed(output_data_path / "bronchus_coords_outer_shell", model_outer_shell_only)
 
 # full_model = np.where(data >= 1)
 # full_model = np.append(full_model, [data[data >= 1]], axis=0)
 # print(len(full_model[0]))
 # np.savez_compressed(os.path.join(target_data_path, "full_lung_coords"), np.array(full_model))
 
-
-model_adjacency_sum = np.sum([np.roll(np.clip(data, 0, 1), i, axis=ax) for i in [-1, 1] for ax in [0, 1, 2]], axis=0)
-full_model_outer_shell = np.where(np.logical_and(data >= 1, model_adjacency_sum != 6))
-full_model_outer_shell = np.append(
-    full_model_outer_shell, [data[np.logical_and(data >= 1, model_adjacency_sum != 6)]], axis=0
-)
+# Voxels of any label with at least one empty neighbour
+full_model_outer_shell = get_labelled_coords(data, get_outer_shell(data >= 1))
 print(f"Full outer shell model size: {len(full_model_outer_shell[0]):,}")
-np.savez_compressed(output_data_path / "full_lung_outer_shell_coords", np.array(full_model_outer_shell))
+np.savez_compressed(output_data_path / "full_lung_outer_shell_coords", full_model_outer_shell)
 
 print(f"Writing coordinates to {output_data_path}\n")
@@ -1,7 +1,17 @@
 import sys
 from pathlib import Path
 
-import numpy as np
+from airway.util.volumes import (
+    BRONCHUS_ROI_NAME,
+    get_bounding_box,
+    load_bounding_box,
+    load_label_counts,
+    load_volume,
+    save_label_masks,
+    save_volume,
+    save_volume_metadata,
+    save_volume_statistics,
+)
 
 try:
     output_data_path = Path(sys.argv[1])
@@ -10,65 +20,79 @@ except IndexError:
     print("ERROR: No patient data path supplied")
     sys.exit(1)
 
-
-def print_model_description(model):
-    total_sum = np.sum(model)
-    print(f"Total sum: {total_sum:,}")
-    print(f"Total pixels in model: {np.product(np.array(model.shape)):,}")
-    return total_sum
+# Volume format of the reduced model, see volumes.py
+try:
+    volume_format = sys.argv[3]
+except IndexError:
+    volume_format = "npz"
+# Whether the mask of each label of the reduced model is saved bit-packed too, see save_label_masks()
+try:
+    packed_masks = sys.argv[4].lower() == "true"
+    assert sys.argv[4].lower() in ["true", "false"], "given arg is not True or False"
+except IndexError:
+    packed_masks = False
 
 
-model = np.load(input_data_path / "model.npz")["arr_0"]
-model = model.astype(np.uint8)
+model = load_volume(input_data_path, "model", "model")
 print(model)
 
-unique, counts = np.unique(model, return_counts=True)
+# Label counts are saved by stage-01, older models are counted here
+label_counts = load_label_counts(input_data_path, "model", model)
 print("\nOccurrences:")
-for u, c in zip(unique, counts):
-    print(f"\tType {u} appeared {c:,} times")
+for label, count in sorted(label_counts.items()):
+    print(f"\tType {label} appeared {count:,} times")
 
-assert len(unique) != 1, f"It looks like the the model only contains {unique[0]}s, aborting!"
+assert len(label_counts) != 1, f"It looks like the the model only contains {next(iter(label_counts))}s, aborting!"
 
 print("{} images loaded".format(len(model)))
 
-print("Printing sum as validation as only 0-layers are being removed the sum should not change.")
-print("Before reduction:")
-old_total_sum = print_model_description(model)
-
 # Axis description:
 #      0: top to bottom
 #      1: front to back
 #      2: left to right
 
-print("\nReducing model: ", end="")
-print(model.shape, end=" ")
-
-for axis in [0, 1, 2]:
-    sums = np.sum(np.sum(model, axis=axis), axis=(axis + 1) % 2)
-
-    # Track all =0 layers from front from that axis
-    remove_front_index = 0
-    while sums[remove_front_index] == 0:
-        remove_front_index += 1
-
-    # Track all =0 layers from back from that axis
-    remove_back_index = len(sums) - 1
-    while sums[remove_back_index] == 0:
-        remove_back_index -= 1
-
-    # Remove those layers
-    model = np.delete(
-        model, list(range(remove_front_index - 1)) + list(range(remove_back_index + 2, len(sums))), axis=(axis + 1) % 3
-    )
-    validation_sums = np.sum(np.sum(model, axis=axis), axis=(axis + 1) % 2)
-    print(" -> ", model.shape, end=" ")
+# Only empty layers are removed, keeping one around the non-empty voxels (the bounding boxes of the labels are saved
+# by stage-01, for older models the box is searched here)
+box = load_bounding_box(input_data_path, "model", margin=1)
+lower, upper = get_bounding_box(model) if box is None else box
+original_shape = model.shape
+model = model[tuple(slice(low, up) for low, up in zip(lower, upper))].copy()
+print(f"\nReducing model: {original_shape} -> {model.shape} (offset={lower.tolist()})")
 
 assert all(a > 2 for a in model.shape), f"Model is empty! shape={model.shape}"
 
-print("\n\nAfter reduction:")
-curr_total_sum = print_model_description(model)
+save_volume(output_data_path, "reduced_model", model, volume_format)
+# Statistics of the reduced model for the later stages, with its offset inside the model (and with that the DICOM
+# images)
+statistics = save_volume_statistics(
+    output_data_path, "reduced_model", model, offset=lower.tolist(), original_shape=list(original_shape)
+)
 
-if curr_total_sum == old_total_sum:
-    np.savez_compressed(output_data_path / "reduced_model", model)
-else:
+# Validate that only empty voxels were removed, every other label has to have as many voxels as before
+reduced_label_counts = {int(label): count for label, count in statistics["label_counts"].items()}
+if any(reduced_label_counts.get(label, 0) != count for label, count in label_counts.items() if label != 0):
     raise Exception("It seems like the script removed actual data from the model; this should not happen!")
+
+if packed_masks:
+    labels = save_label_masks(output_data_path, "reduced_model", model, volume_format=volume_format)
+    print(f"Saved packed masks of the labels {labels}")
+else:
+    # Masks saved by an earlier run do not belong to this reduced model
+    save_volume_metadata(output_data_path, "reduced_model", packed_masks=[])
+
+# Tight box around the bronchus only, used by the tree extraction stages instead of the whole reduced model
+bronchus_box = load_bounding_box(output_data_path, "reduced_model", 1, margin=1)
+if bronchus_box is not None:
+    bronchus_lower, bronchus_upper = bronchus_box
+    bronchus_box = tuple(slice(low, up) for low, up in zip(bronchus_lower, bronchus_upper))
+    bronchus_model = (model[bronchus_box] == 1).astype(model.dtype)
+    print(f"Bronchus region of interest: {bronchus_model.shape} (offset={bronchus_lower.tolist()})")
+    save_volume(output_data_path, BRONCHUS_ROI_NAME, bronchus_model, volume_format)
+    # Offset of the bronchus region of interest inside the reduced model
+    save_volume_statistics(
+        output_data_path,
+        BRONCHUS_ROI_NAME,
+        bronchus_model,
+        offset=bronchus_lower.tolist(),
+        original_shape=list(model.shape),
+    )
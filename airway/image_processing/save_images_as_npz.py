@@ -2,26 +2,158 @@
 """
 
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import pydicom
+from scipy import ndimage
 
 from airway.util.config_parsers import parse_array_encoding
+from airway.util.dtypes import get_volume_dtype
 from airway.util.util import get_data_paths_from_args
+from airway.util.volumes import make_volume_statistics, save_volume_metadata
 
 # Process arguments supplied
 output_data_path, input_data_path = get_data_paths_from_args()
 
 dir_names_to_id = parse_array_encoding()
 
+# Number of threads decoding the images, all cores by default
+try:
+    workers = int(sys.argv[3])
+except IndexError:
+    workers = None
+# Whether the model is compressed into model.npz (as expected by stage-02) or left uncompressed in model.npy
+try:
+    compress = sys.argv[4].lower() == "true"
+    assert sys.argv[4].lower() in ["true", "false"], "given arg is not True or False"
+except IndexError:
+    compress = True
+
+
+def read_slice(
+    model: np.ndarray, index: int, image_paths: List[Tuple[Path, int]]
+) -> Tuple[List[Tuple[int, int]], np.ndarray, List[Optional[Tuple[slice, slice]]]]:
+    """Decodes the images of slice index of every type (in the order given) into model[index]
+
+    Returns the pixel count of each type and the non-empty pixel count of the slice after adding that type, as well
+    as the number of pixels of each value and the bounding box of each non-zero value of the finished slice.
+    """
+    counts = []
+    for image_path, lobe_id in image_paths:
+        # Read the data and save the pixel_array which will have a
+        # shape of around (700, 512, 512), the 512s being consistent.
+        im = pydicom.dcmread(image_path).pixel_array
+
+        # Due to the image using -10000 as "no value" and values between
+        # -1000 and 0 as "value" we can normalize the image by adding
+        # 10000 to every value. Then clipping every value to 0 and lobe_id.
+        # Then we add this matrix to the model. This causes all pixels
+        # of that type to have that id. This being implemented in
+        # completely in numpy speeds it up at least ten-fold. Note
+        # that in case later types are at the same coordinates these
+        # will be overwritten.
+        im = np.clip(np.add(im, 10000), 0, lobe_id)
+        model[index][im == lobe_id] = im[im == lobe_id]
+
+        # This if else part adds the bronchus. But it tries to also
+        # label the bronchus depending on which lobe they are in. The
+        # problem with this approach was that the lobes do not share
+        # any coordinates with the bronchus, therefore this did not
+        # label any of the bronchus. So it is not in use for now.
+        # if folder == 'Bronchus':
+        #     im = np.clip(np.add(im, 10000), 0, lobe_id)
+        #     model[index] = np.add(model[index], im)
+        # else:
+        #     im = np.clip(np.add(im, 10000), 1, lobe_id)
+        #     model[index] = np.multiply(model[index], im)
+
+        counts.append((np.sum(im) // lobe_id, np.count_nonzero(model[index])))
+    max_label = max(dir_names_to_id.values())
+    return (
+        counts,
+        np.bincount(model[index].reshape(-1), minlength=max_label + 1),
+        ndimage.find_objects(model[index], max_label=max_label),
+    )
+
 
-def save_images_as_npz(raw_data_path, processed_data_path):
+def merge_slice_bounding_boxes(
+    boxes_per_slice: List[List[Optional[Tuple[slice, slice]]]],
+) -> Dict[int, Tuple[List[int], List[int]]]:
+    """Returns the bounding box of each label in the model from the bounding boxes of each label in each slice"""
+    bounding_boxes = {}
+    for index, slice_boxes in enumerate(boxes_per_slice):
+        for label, boxes in enumerate(slice_boxes, start=1):
+            if boxes is None:
+                continue
+            lower = [index, boxes[0].start, boxes[1].start]
+            upper = [index + 1, boxes[0].stop, boxes[1].stop]
+            if label in bounding_boxes:
+                lower = np.minimum(bounding_boxes[label][0], lower).tolist()
+                upper = np.maximum(bounding_boxes[label][1], upper).tolist()
+            bounding_boxes[label] = (lower, upper)
+    return bounding_boxes
+
+
+def save_images_as_npz(raw_data_path, processed_data_path, workers=None, compress=True):
     """Saves a 3D numpy matrix of the model to $processed_data_path
 
     The matrix has 0 for empty space and dir_names_to_id for each
     type given.
+
+    The slices are decoded in a thread pool with the given number of
+    workers (all cores if None), each slice is written by a single
+    thread, one type after the other, so later types still overwrite
+    earlier ones.
+
+    The slices are streamed into model.npy, which is memory mapped, and
+    all statistics are collected per slice, so the whole model is never
+    held in memory. With compress the model is then compressed into
+    model.npz (in chunks) and model.npy is removed.
     """
 
+    # Create folders if they do not exist
+    if not processed_data_path.exists():
+        os.makedirs(processed_data_path)
+
+    # Image files of each type, sorted by their slice index (types without images, e.g. Empty, are skipped)
+    image_files_per_type = {}
+    for folder, lobe_id in dir_names_to_id.items():
+        image_files = sorted((raw_data_path / folder).glob("*"), key=lambda f: int(f.name.replace("IMG", "")))
+        if image_files:
+            image_files_per_type[folder] = (image_files, lobe_id)
+    # Each slice is decoded from the image with its index of every type, so all types need the same number of images
+    slice_counts = {folder: len(image_files) for folder, (image_files, _) in image_files_per_type.items()}
+    if len(set(slice_counts.values())) != 1:
+        sys.exit(f"ERROR: The types in {raw_data_path} have different numbers of images: {slice_counts}")
+    num_slices = next(iter(slice_counts.values()))
+    npy_path = processed_data_path / "model.npy"
+    model = np.lib.format.open_memmap(
+        npy_path,
+        mode="w+",
+        dtype=get_volume_dtype("model", max_value=max(dir_names_to_id.values())),
+        shape=(num_slices, 512, 512),
+    )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        slice_statistics = list(
+            executor.map(
+                lambda index: read_slice(
+                    model,
+                    index,
+                    [(image_files[index], lobe_id) for image_files, lobe_id in image_files_per_type.values()],
+                ),
+                range(num_slices),
+            )
+        )
+    counts_per_slice, histograms, boxes_per_slice = zip(*slice_statistics)
+    # Pixel count of each type and the non-empty voxel count after adding that type
+    counts = dict(zip(image_files_per_type, np.sum(counts_per_slice, axis=0).tolist()))
+    histogram = np.sum(histograms, axis=0)
+
     # s is just a debug value to print out the sum of all the lobes.
     # Useful in case some of the bronchus do overlap with some of
     # the lungs. The sums should be equal, if not something is amiss.
@@ -31,75 +163,36 @@ def save_images_as_npz(raw_data_path, processed_data_path):
     # analysis
     overlapping_coords = []
 
-    # Iterate over each type, adding each layer on top of the model
-    # with the corresponding id marked in that position.
-    for folder, lobe_id in dir_names_to_id.items():
-        abs_folder_path = raw_data_path / folder
-        image_files = sorted(abs_folder_path.glob("*"), key=lambda f: int(f.name.replace("IMG", "")))
-        curr_sum = 0
-
-        # Initialize model. Note that we do this in this unusual location
-        # instead of outside the loop because the count of the images_files
-        # is not known before the loop. Therefore this should only be
-        # initialized on the first run of the loop.
-        if total_sum == 0:
-            model = np.zeros((len(image_files), 512, 512), dtype=np.int8)
-
-        for index, image_name in enumerate(image_files):
-            image_path = abs_folder_path / image_name
-
-            # Read the data and save the pixel_array which will have a
-            # shape of around (700, 512, 512), the 512s being consistent.
-            im = pydicom.dcmread(image_path).pixel_array
-
-            # Due to the image using -10000 as "no value" and values between
-            # -1000 and 0 as "value" we can normalize the image by adding
-            # 10000 to every value. Then clipping every value to 0 and lobe_id.
-            # Then we add this matrix to the model. This causes all pixels
-            # of that type to have that id. This being implemented in
-            # completely in numpy speeds it up at least ten-fold. Note
-            # that in case later types are at the same coordinates these
-            # will be overwritten.
-            im = np.clip(np.add(im, 10000), 0, lobe_id)
-            model[index][im == lobe_id] = im[im == lobe_id]
-
-            # This if else part adds the bronchus. But it tries to also
-            # label the bronchus depending on which lobe they are in. The
-            # problem with this approach was that the lobes do not share
-            # any coordinates with the bronchus, therefore this did not
-            # label any of the bronchus. So it is not in use for now.
-            # if folder == 'Bronchus':
-            #     im = np.clip(np.add(im, 10000), 0, lobe_id)
-            #     model[index] = np.add(model[index], im)
-            # else:
-            #     im = np.clip(np.add(im, 10000), 1, lobe_id)
-            #     model[index] = np.multiply(model[index], im)
-
-            curr_sum += np.sum(im) // lobe_id
+    nonzero_count = 0
+    for folder in dir_names_to_id:
+        curr_sum, nonzero_count = counts.get(folder, (0, nonzero_count))
         print(f"{folder} pixel count:\t {curr_sum:,}")
         total_sum += curr_sum
-        if total_sum != np.count_nonzero(model):
-            overlapping_coords.append((folder, total_sum - np.count_nonzero(model)))
-
-    # Create folders if they do not exist
-    if not processed_data_path.exists():
-        os.makedirs(processed_data_path)
+        if total_sum != nonzero_count:
+            overlapping_coords.append((folder, total_sum - nonzero_count))
 
-    unique, counts = np.unique(model, return_counts=True)
     print("\nOccurrences:")
-    for u, c in zip(unique, counts):
-        print(f"\tType {u} appeared {c:,} times")
+    for u in np.flatnonzero(histogram):
+        print(f"\tType {u} appeared {histogram[u]:,} times")
 
     # Print sums of the model for easier debugging
-    print(
-        f"Non-empty voxels:\t {np.count_nonzero(model):,} "
-        f"out of {np.size(model):,} total voxels (shape={np.shape(model)})"
-    )
+    non_empty_voxels = np.size(model) - histogram[0]
+    print(f"Non-empty voxels:\t {non_empty_voxels:,} out of {np.size(model):,} total voxels (shape={np.shape(model)})")
     # print("Model sum: %d" % np.sum(model))
-    # Save as numpy binary file to given location
-    np.savez_compressed(processed_data_path / "model", model)
+    model.flush()
+    # Saved for stage-02, so that it can validate its reduced model without counting the whole model again
+    save_volume_metadata(
+        processed_data_path,
+        "model",
+        **make_volume_statistics(model.shape, model.dtype, histogram, merge_slice_bounding_boxes(boxes_per_slice)),
+    )
+    if compress:
+        # Save as numpy binary file to given location, numpy writes the memory mapped model in chunks
+        np.savez_compressed(processed_data_path / "model", model)
+        del model
+        npy_path.unlink()
 
-    if total_sum != np.count_nonzero(model):
+    if total_sum != non_empty_voxels:
         print("\nWARNING: It seems like some coords overlap with other coords, meaning some data has been lost.")
         # Adjust for incorrect calculation since overlapping_coords only remembers total difference
         print("\tNumber of overlapping coordinates:")
@@ -110,4 +203,4 @@ def save_images_as_npz(raw_data_path, processed_data_path):
 
 
 if __name__ == "__main__":
-    save_images_as_npz(input_data_path, output_data_path)
+    save_images_as_npz(input_data_path, output_data_path, workers=workers, compress=compress)
@@ -12,17 +12,40 @@ it adds the points which haven't been added yet on that face and also adds the f
 Then it saves everything into a .obj file with the format of [patient_it].obj. This file can
 be imported into blender, 3D printed, visualized and many other nice things.
 """
-from collections import defaultdict
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Set, Tuple
+from random import Random
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
 from typing import Dict
 
 import numpy as np
-from skimage.morphology import skeletonize
+from skimage.measure import marching_cubes
 
+from airway.obj_generation.glb import quads_to_triangles, write_glb
+from airway.util.dtypes import to_volume_dtype
+from airway.util.helper_functions import NearestNonzeroIndex
+from airway.util.skeleton import get_skeleton
 from airway.util.util import get_data_paths_from_args
+from airway.util.volumes import load_label_counts, load_volume
 from airway.analysis.create_color_masks import color_hex_to_floats
 
+# Directions in which faces are searched, as (axis, pos_or_neg)
+DIRECTIONS = [(axis, pos_or_neg) for axis in range(3) for pos_or_neg in [-1, 1]]
+# Offsets of the 4 corners of a face in the two axes along the face (in half-voxel units)
+FACE_CORNER_OFFSETS = np.array([(1, 1), (-1, 1), (-1, -1), (1, -1)])
+
+
+class MeshOutput(NamedTuple):
+    """Mesh written by generate_objs(), see generate_obj() for the meaning of the fields"""
+
+    output_data_path: Path
+    accepted_types: Set[int]
+    color_mask: Optional[np.ndarray] = None
+    color_to_rgb_tuple: Dict[int, Tuple[float, float, float]] = {}
+    # Name of the material of each color id in the .mtl/.glb files, consumers of the meshes match on these names
+    material_name_format: str = "mat{}"
+
 
 def generate_obj(
     output_data_path: Path,
@@ -32,6 +55,9 @@ def generate_obj(
     color_to_rgb_tuple: Dict[int, Tuple[float, float, float]] = {},
     rot_mat: np.ndarray = None,
     num_decimal_digits: int = 2,
+    mesh_formats: Sequence[str] = ("obj",),
+    surface: str = "voxel",
+    step_size: int = 1,
 ):
     """Saves a .obj obj_file given the model, the accepted types and a name
 
@@ -52,79 +78,149 @@ def generate_obj(
     groups of colors/materials which will be added by this script
 
     rot_mat is a rotation matrix. Each point p=(x,y,z) is rotated by rot_mat @ p or left unchanged if None
-    """
 
-    occurrences = np.unique(model)
-    if not all(t in occurrences for t in accepted_types):
-        return
+    mesh_formats are the formats which are written: "obj" (with a .mtl file) and/or "glb" (binary glTF, saved next
+    to the .obj file with the .glb suffix)
 
-    output_data_path = Path(output_data_path)
+    surface is how the surface is meshed: "voxel" adds a quad for each face of a voxel, "greedy" merges coplanar
+    faces of the same material into rectangles (a lot fewer faces, but with T-junctions, so it should not be
+    smoothed) and "marching_cubes" creates a smooth triangle surface, where step_size > 1 gives coarser levels of
+    detail
+    """
+    generate_objs(
+        model,
+        [MeshOutput(Path(output_data_path), accepted_types, color_mask, color_to_rgb_tuple)],
+        rot_mat=rot_mat,
+        num_decimal_digits=num_decimal_digits,
+        mesh_formats=mesh_formats,
+        surface=surface,
+        step_size=step_size,
+    )
 
-    print(f"Generating {output_data_path} with accepted types of {accepted_types}")
 
-    vertices = {}
-    faces: Dict[int, List[List[int]]] = defaultdict(list)
+def generate_objs(
+    model: np.ndarray,
+    outputs: Sequence[MeshOutput],
+    rot_mat: np.ndarray = None,
+    num_decimal_digits: int = 2,
+    mesh_formats: Sequence[str] = ("obj",),
+    surface: str = "voxel",
+    step_size: int = 1,
+    workers: int = 1,
+    labels: Optional[Iterable[int]] = None,
+):
+    """Saves several meshes of the same model, see generate_obj() for the arguments
 
-    model = np.pad(np.copy(model), 1)
-    if color_mask is not None:
-        color_mask = np.pad(color_mask, 1)
-    if accepted_types:
-        for remove in set(np.unique(model)) - accepted_types - {0}:
-            model[model == remove] = 0
-
-    index = 1
-    # Iterate over each axis and pos/neg directions, then roll the model over, afterwards subtracting these.
-    # This causes there to be only -1 and 1 values where there is air, meaning there a face should be added.
-    # Though we only look at the 1 values, since these are actually in the model (the others are outside, which means
-    # their color map will be wrong)
-    for axis in range(3):
-        for pos_or_neg in [-1, 1]:
-            diff = np.roll(model, -pos_or_neg, axis=axis)
-            model_diff = np.where(model > diff)
-            coords = []
-            for d1, d2 in [(0.5, 0.5), (-0.5, 0.5), (-0.5, -0.5), (0.5, -0.5)]:
-                coords.append(list(map(lambda t: t.astype(float), np.copy(model_diff))))
-                coords[-1][axis] += pos_or_neg / 2
-                coords[-1][(axis + 1) % 3] += d1
-                coords[-1][(axis + 2) % 3] += d2
-
-            # Example shape after transpose: (11523, 4, 3) - face_coords is an array of faces,
-            # each face is a list of 4 points with 3 coordinates.
-            faces_coords = np.transpose(coords, axes=(2, 0, 1))
-            vertex_coords = np.transpose(model_diff)
-            for vertex_coord, face_coords in zip(vertex_coords, faces_coords):
-                curr_face = []
-                for face_coord in map(tuple, face_coords):
-                    if face_coord not in vertices:
-                        vertices[face_coord] = index
-                        index += 1
-                    curr_face.append(vertices[face_coord])
-                material = color_mask[tuple(vertex_coord)] if color_mask is not None else 0
-                faces[material].append(curr_face)
-                # assert len(faces[material][-1]) == 4, f"ERROR: Wrong number of points on face {faces[material][-1]}"
-
-    print(f"Vertex count : {len(vertices):,}")
-    print(f"Face count : {sum(map(len, faces.values())):,}")
-
-    # make to numpy for easier usage later
-    vertices = np.array([np.array(v) for v in vertices])
-    vertices = normalize(vertices, model.shape, rot_mat=rot_mat)
-
-    # Write vertices and faces to obj_file
+    The faces of all outputs are found in a single sweep over the padded model (see get_face_voxels()), afterwards
+    the outputs are meshed and written one by one, or in a thread pool with the given number of workers. Outputs
+    whose accepted types do not all occur in the model are skipped, labels are the labels which occur in the model
+    (e.g. from its statistics, see load_label_counts()), they are counted if None.
+    """
+    model = np.pad(model, 1)
+    if model.dtype == bool:
+        model = model.view(np.uint8)
+    if labels is None:
+        labels = np.flatnonzero(np.bincount(model.reshape(-1))).tolist()
+    occurrences = set(labels)
+    outputs = [output for output in outputs if all(t in occurrences for t in output.accepted_types)]
+    for output in outputs:
+        print(f"Generating {output.output_data_path} with accepted types of {output.accepted_types}")
+
+    if surface == "marching_cubes":
+        face_voxels_per_output = [None] * len(outputs)
+    else:
+        assert surface in ["voxel", "greedy"], f"Unknown surface {surface}"
+        face_voxels_per_output = get_face_voxels(model, [output.accepted_types for output in outputs])
+
+    def generate(output: MeshOutput, face_voxels: List[np.ndarray]):
+        if surface == "marching_cubes":
+            labels = get_label_lookup_table(output.accepted_types, int(model.max()))[model]
+            color_mask = None if output.color_mask is None else np.pad(output.color_mask, 1)
+            vertices, faces, face_materials = get_smooth_faces(labels, color_mask, step_size=step_size)
+        else:
+            # The color mask is not padded, so it is indexed with the voxel coordinates minus the padding
+            vertices, faces, face_materials = get_faces_from_voxels(
+                face_voxels, model.shape, output.color_mask, color_mask_offset=-1, greedy=surface == "greedy"
+            )
+            vertices = vertices / 2
+        print(f"Vertex count : {len(vertices):,}")
+        print(f"Face count : {len(faces):,}")
+        vertices = normalize(vertices, model.shape, rot_mat=rot_mat)
+        write_mesh(output, vertices, faces, face_materials, num_decimal_digits, mesh_formats)
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(generate, outputs, face_voxels_per_output))
+    else:
+        for output, face_voxels in zip(outputs, face_voxels_per_output):
+            generate(output, face_voxels)
+
+
+def write_mesh(
+    output: MeshOutput,
+    vertices: np.ndarray,
+    faces: np.ndarray,
+    face_materials: np.ndarray,
+    num_decimal_digits: int = 2,
+    mesh_formats: Sequence[str] = ("obj",),
+):
+    """Groups the faces by material and writes the mesh in all of the given formats"""
+    output_data_path = output.output_data_path
+    color_to_rgb_tuple = output.color_to_rgb_tuple
+
+    # Materials in order of their first face, faces grouped by material
+    materials, first_faces, material_of_face = np.unique(face_materials, return_index=True, return_inverse=True)
+    material_order = np.argsort(first_faces)
+    material_rank = np.empty_like(material_order)
+    material_rank[material_order] = np.arange(len(material_order))
+    face_order = np.argsort(material_rank[material_of_face], kind="stable")
+    material_face_counts = np.bincount(material_of_face, minlength=len(materials))[material_order]
+    faces_per_material = np.split(faces[face_order], np.cumsum(material_face_counts)[:-1])
+    materials = materials[material_order].tolist()
+    material_names = [output.material_name_format.format(material) for material in materials]
+
+    # Own random generator per mesh, so that the colors do not depend on other meshes written concurrently
+    random = Random(output_data_path.parent.name)
+
+    def ran():
+        return random.uniform(0, 1)
+
+    material_colors = [
+        color_to_rgb_tuple[material] if material in color_to_rgb_tuple else (ran(), ran(), ran())
+        for material in materials
+    ]
+
+    if "obj" in mesh_formats:
+        write_obj(output_data_path, vertices, material_names, material_colors, faces_per_material, num_decimal_digits)
+    if "glb" in mesh_formats:
+        # Each vertex is colored like the first face it belongs to
+        _, first_corners = np.unique(faces.reshape(-1), return_index=True)
+        vertex_colors = np.array(material_colors, dtype=float)[
+            material_rank[material_of_face[first_corners // faces.shape[1]]]
+        ]
+        triangles_per_material = [
+            quads_to_triangles(faces_with_material) if faces.shape[1] == 4 else faces_with_material
+            for faces_with_material in faces_per_material
+        ]
+        primitives = list(zip(material_names, material_colors, triangles_per_material))
+        write_glb(output_data_path.with_suffix(".glb"), output_data_path.stem, vertices, primitives, vertex_colors)
+
+
+def write_obj(
+    output_data_path: Path,
+    vertices: np.ndarray,
+    material_names: List[str],
+    material_colors: List[Tuple[float, float, float]],
+    faces_per_material: List[np.ndarray],
+    num_decimal_digits: int = 2,
+):
+    """Writes the .obj file and its .mtl file, faces are 0-based vertex indices (of quads or triangles)"""
     material_path = output_data_path.with_suffix(".mtl")
     with open(material_path, "w") as mat_file:
-        import random
-
-        random.seed(output_data_path.parent.name)
-
-        def ran():
-            return random.uniform(0, 1)
-
-        for material in faces:
-            mat_file.write(f"newmtl mat{material}\n")
+        for material_name, rgb in zip(material_names, material_colors):
+            mat_file.write(f"newmtl {material_name}\n")
             mat_file.write("Ns 96.078431\n")
             mat_file.write("Ka 1.000000 1.000000 1.000000\n")
-            rgb = color_to_rgb_tuple[material] if material in color_to_rgb_tuple else (ran(), ran(), ran())
             mat_file.write(f"Kd {' '.join(map(str, rgb))}\n")
             mat_file.write("Ks 0.500000 0.500000 0.500000\n")
             mat_file.write("Ke 0.000000 0.000000 0.000000\n")
@@ -136,15 +232,170 @@ def generate_obj(
         obj_file.write(f"mtllib {material_path.name}\n")
         obj_file.write("# Vertices\n")
         # original was [[0, 0, -1], [-1, 0, 0], [0, 1, 0]]
-        vertexformat = f"v {{:.{num_decimal_digits}f}} {{:.{num_decimal_digits}f}} {{:.{num_decimal_digits}f}}\n"
-        for x, y, z in vertices:
-            obj_file.write(vertexformat.format(x, y, z))
+        vertex_format = f"v %.{num_decimal_digits}f %.{num_decimal_digits}f %.{num_decimal_digits}f\n"
+        obj_file.write(format_rows(vertex_format, vertices))
 
         obj_file.write("\n# Faces\n")
-        for material, faces_with_material in faces.items():
-            obj_file.write(f"usemtl mat{material}\n")
-            for a, b, c, d in faces_with_material:
-                obj_file.write(f"f {a} {b} {c} {d}\n")
+        for material_name, faces_with_material in zip(material_names, faces_per_material):
+            obj_file.write(f"usemtl {material_name}\n")
+            face_format = "f" + " %d" * faces_with_material.shape[1] + "\n"
+            obj_file.write(format_rows(face_format, faces_with_material + 1))
+
+
+def format_rows(row_format: str, array: np.ndarray) -> str:
+    """Formats all rows of the 2D array at once, which is a lot faster than formatting (or np.savetxt) per row"""
+    return (row_format * len(array)) % tuple(array.ravel().tolist())
+
+
+def get_label_lookup_table(accepted_types: Set[int], max_label: int) -> np.ndarray:
+    """Returns a lookup table which maps every label up to max_label to itself if accepted and to 0 otherwise"""
+    lookup_table = np.arange(max_label + 1)
+    if accepted_types:
+        lookup_table[~np.isin(lookup_table, list(accepted_types))] = 0
+    return lookup_table
+
+
+def get_face_voxels(model: np.ndarray, label_sets: Sequence[Set[int]]) -> List[List[np.ndarray]]:
+    """Returns the coordinates of the voxels with a face in each of the 6 directions (see DIRECTIONS) per label set
+
+    A voxel has a face towards its neighbour when its label is larger than the label of the neighbour, where labels
+    not in the label set count as 0 (an empty label set accepts all labels). The model is rolled over only once per
+    direction for all label sets: only voxels whose label differs from their neighbour can have a face, these are
+    then checked for each label set with a lookup table.
+    """
+    lookup_tables = [get_label_lookup_table(labels, int(model.max())) for labels in label_sets]
+    face_voxels = [[] for _ in label_sets]
+    flat_model = model.reshape(-1)
+    for axis, pos_or_neg in DIRECTIONS:
+        neighbours = np.roll(model, -pos_or_neg, axis=axis)
+        candidates = np.flatnonzero(model != neighbours)
+        labels, neighbour_labels = flat_model[candidates], neighbours.reshape(-1)[candidates]
+        for lookup_table, voxels in zip(lookup_tables, face_voxels):
+            is_face = lookup_table[labels] > lookup_table[neighbour_labels]
+            voxels.append(np.transpose(np.unravel_index(candidates[is_face], model.shape)))
+    return face_voxels
+
+
+def get_boundary_faces(
+    model: np.ndarray, color_mask: np.ndarray = None, greedy: bool = False
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the vertices, faces and face materials of the surface of all non-zero voxels of the model
+
+    See get_faces_from_voxels(), the model must not have non-zero voxels on its border.
+    """
+    [face_voxels] = get_face_voxels(model, [set()])
+    return get_faces_from_voxels(face_voxels, model.shape, color_mask, greedy=greedy)
+
+
+def get_faces_from_voxels(
+    face_voxels: List[np.ndarray],
+    shape: Tuple[int, ...],
+    color_mask: np.ndarray = None,
+    color_mask_offset: int = 0,
+    greedy: bool = False,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the vertices, faces and face materials given the voxels with a face in each direction
+
+    Vertices are integer coordinates in half-voxel units (i.e. twice the voxel coordinates), numbered in the order in
+    which they first appear in a face. Faces are the 0-based vertex indices of their 4 corners, their material is the
+    value of the color mask at the voxel they belong to plus color_mask_offset (or 0 without a color mask). With
+    greedy, coplanar faces of the same material are merged into rectangles (see merge_coplanar_faces()).
+    """
+    corners, materials = [], []
+    for (axis, pos_or_neg), direction_voxels in zip(DIRECTIONS, face_voxels):
+        if color_mask is None:
+            face_materials = np.zeros(len(direction_voxels), dtype=int)
+        else:
+            face_materials = color_mask[tuple((direction_voxels + color_mask_offset).T)]
+        # Size of each face along the two axes of the face, in voxels
+        extents = np.ones((len(direction_voxels), 2), dtype=int)
+        if greedy:
+            direction_voxels, extents, face_materials = merge_coplanar_faces(direction_voxels, face_materials, axis)
+        face_corners = np.repeat(2 * direction_voxels[:, np.newaxis, :], 4, axis=1)
+        face_corners[:, :, axis] += pos_or_neg
+        for along, (offsets, extent) in enumerate(zip(FACE_CORNER_OFFSETS.T, extents.T), start=1):
+            # Corners on the far side are moved to the end of the (merged) face
+            far_side_offsets = (offsets > 0) * 2 * (extent[:, np.newaxis] - 1)
+            face_corners[:, :, (axis + along) % 3] += offsets + far_side_offsets
+        corners.append(face_corners)
+        materials.append(face_materials)
+    vertices, faces = number_vertices(np.concatenate(corners), 2 * np.array(shape) + 1)
+    return vertices, faces, np.concatenate(materials)
+
+
+def number_vertices(corners: np.ndarray, shape: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Deduplicates the integer corners (shape (faces, corners per face, 3)) of all faces
+
+    Corners are deduplicated by a single integer key (their flat index in the given shape), vertices are numbered in
+    order of their first appearance. Returns the vertices and the faces as vertex indices.
+    """
+    flat_corners = corners.reshape(-1, 3)
+    corner_keys = np.ravel_multi_index(tuple(flat_corners.T), tuple(shape))
+    _, first_corners, corner_ids = np.unique(corner_keys, return_index=True, return_inverse=True)
+    vertex_order = np.argsort(first_corners)
+    vertex_ids = np.empty_like(vertex_order)
+    vertex_ids[vertex_order] = np.arange(len(vertex_order))
+    vertices = flat_corners[first_corners[vertex_order]]
+    faces = vertex_ids[corner_ids].reshape(corners.shape[:2])
+    return vertices, faces
+
+
+def _get_group_starts(keys: Sequence[np.ndarray], positions: np.ndarray) -> np.ndarray:
+    """Returns where a new group starts in sorted rows, i.e. where any key changes or the position is not consecutive"""
+    starts = np.ones(len(positions), dtype=bool)
+    starts[1:] = positions[1:] != positions[:-1] + 1
+    for key in keys:
+        starts[1:] |= key[1:] != key[:-1]
+    return starts
+
+
+def merge_coplanar_faces(
+    face_voxels: np.ndarray, face_materials: np.ndarray, axis: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Greedily merges adjacent faces of the same material and direction into rectangles
+
+    All faces point along axis, the two axes along the faces are (axis + 1) % 3 and (axis + 2) % 3. First runs of
+    consecutive faces along the second of them are merged, then runs with the same start, length and material in
+    consecutive rows are merged. Returns the first voxel, the extents along both axes and the material of each
+    rectangle.
+    """
+    u, v = (axis + 1) % 3, (axis + 2) % 3
+    order = np.lexsort((face_voxels[:, v], face_voxels[:, u], face_voxels[:, axis], face_materials))
+    face_voxels, face_materials = face_voxels[order], face_materials[order]
+    run_starts = np.flatnonzero(
+        _get_group_starts([face_materials, face_voxels[:, axis], face_voxels[:, u]], face_voxels[:, v])
+    )
+    run_lengths = np.diff(np.append(run_starts, len(face_voxels)))
+    run_voxels, run_materials = face_voxels[run_starts], face_materials[run_starts]
+
+    order = np.lexsort((run_voxels[:, u], run_voxels[:, v], run_lengths, run_voxels[:, axis], run_materials))
+    run_voxels, run_lengths, run_materials = run_voxels[order], run_lengths[order], run_materials[order]
+    rectangle_starts = np.flatnonzero(
+        _get_group_starts([run_materials, run_voxels[:, axis], run_lengths, run_voxels[:, v]], run_voxels[:, u])
+    )
+    rectangle_heights = np.diff(np.append(rectangle_starts, len(run_voxels)))
+    extents = np.stack([rectangle_heights, run_lengths[rectangle_starts]], axis=1)
+    return run_voxels[rectangle_starts], extents, run_materials[rectangle_starts]
+
+
+def get_smooth_faces(
+    model: np.ndarray, color_mask: np.ndarray = None, step_size: int = 1
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the vertices (in voxel units), triangles and triangle materials of the marching cubes surface
+
+    step_size is the step size of marching cubes in voxels, larger step sizes result in coarser surfaces with
+    fewer triangles. The material of a triangle is the value of the color mask at the non-zero voxel closest to it.
+    """
+    # Pad by the step size so that the surface is closed even if the last steps do not reach the border
+    mask = np.pad(model > 0, step_size).astype(np.float32)
+    vertices, faces, _, _ = marching_cubes(mask, level=0.5, step_size=step_size, allow_degenerate=False)
+    vertices -= step_size
+    if color_mask is None:
+        face_materials = np.zeros(len(faces), dtype=int)
+    else:
+        closest_voxels = NearestNonzeroIndex(model).snap(vertices[faces].mean(axis=1))
+        face_materials = color_mask[tuple(closest_voxels.T)]
+    return vertices, faces, face_materials
 
 
 def normalize(vertices: np.ndarray, reference_shape: np.ndarray, rot_mat: np.ndarray = None):
@@ -161,6 +412,22 @@ def normalize(vertices: np.ndarray, reference_shape: np.ndarray, rot_mat: np.nda
 
 def main():
     output_data_path, input_data_path, distance_mask_path, color_mask_path = get_data_paths_from_args(inputs=3)
+    # Mesh formats as set in stage_configs.yaml, comma separated (e.g. obj,glb)
+    try:
+        mesh_formats = sys.argv[5].split(",")
+    except IndexError:
+        mesh_formats = ["obj", "glb"]
+    # Surface of the meshes (voxel, greedy or marching_cubes) and step size of marching cubes, see generate_obj()
+    try:
+        surface = sys.argv[6]
+        step_size = int(sys.argv[7])
+    except IndexError:
+        surface, step_size = "voxel", 1
+    # Number of meshes which are generated and written concurrently
+    try:
+        workers = int(sys.argv[8])
+    except IndexError:
+        workers = 1
 
     original_color_tuples = {
         index: color_hex_to_floats(color)
@@ -169,15 +436,15 @@ def main():
         )
     }
 
-    model = np.load(input_data_path / "reduced_model.npz")["arr_0"]
+    model = load_volume(input_data_path, "reduced_model", "model")
     print(f"Loaded model with shape {model.shape}")
 
-    distance_mask = np.load(distance_mask_path / "distance_mask.npz")["arr_0"]
+    distance_mask = load_volume(distance_mask_path, "distance_mask", "distance_mask")
     print(f"Loaded color mask with shape {distance_mask.shape}")
 
     try:
         color_mask_npz = np.load(color_mask_path / "bronchus_color_mask.npz")
-        bronchus_color_mask = color_mask_npz["color_mask"]
+        bronchus_color_mask = to_volume_dtype("color_mask", color_mask_npz["color_mask"])
         bronchus_color_codes = color_mask_npz["color_codes"]
         print(bronchus_color_codes)
         print(f"Loaded color mask with shape {bronchus_color_mask.shape}")
@@ -193,23 +460,27 @@ def main():
 
     rot_mat = np.array([[0, 0, -1], [-1, 0, 0], [0, 1, 0]])
 
-    print("Running skeletonize on model")
-    # Remove lobe coordinates from model by clipping everything
-    # between 0 and 2, then modulo everything by 2 to remove 2s
-    skeleton = skeletonize(np.clip(model, 0, 2) % 2)
-    generate_obj(output_data_path / "skeleton.obj", set(), skeleton, rot_mat=rot_mat)
+    # Skeleton of the bronchus saved by stage-03 (next to the distance mask)
+    skeleton = get_skeleton(distance_mask_path, model)
+    generate_obj(output_data_path / "skeleton.obj", set(), skeleton, rot_mat=rot_mat, mesh_formats=mesh_formats)
     # generate_obj(output_data_path / "bav.obj", {1, 7, 8}, model)
-    generate_obj(
-        output_data_path / "bronchus.obj",
-        {1},
+    # The faces of all meshes of the model are found in one sweep over it, see generate_objs()
+    generate_objs(
         model,
-        color_mask=bronchus_color_mask,
-        color_to_rgb_tuple=color_codes,
+        [
+            MeshOutput(output_data_path / "bronchus.obj", {1}, bronchus_color_mask, color_codes),
+            # Distances used to be floats, their materials keep the names mat0.0, mat1.0, ...
+            MeshOutput(output_data_path / "distance_mask.obj", {1}, distance_mask, material_name_format="mat{:.1f}"),
+            MeshOutput(output_data_path / "veins.obj", {7}, color_to_rgb_tuple={0: (0, 0, 1)}),
+            MeshOutput(output_data_path / "arteries.obj", {8}, color_to_rgb_tuple={0: (1, 0, 0)}),
+        ],
         rot_mat=rot_mat,
+        mesh_formats=mesh_formats,
+        surface=surface,
+        step_size=step_size,
+        workers=workers,
+        labels=load_label_counts(input_data_path, "reduced_model", model),
     )
-    generate_obj(output_data_path / "distance_mask.obj", {1}, model, color_mask=distance_mask, rot_mat=rot_mat)
-    generate_obj(output_data_path / "veins.obj", {7}, model, color_to_rgb_tuple={0: (0, 0, 1)}, rot_mat=rot_mat)
-    generate_obj(output_data_path / "arteries.obj", {8}, model, color_to_rgb_tuple={0: (1, 0, 0)}, rot_mat=rot_mat)
     # generate_obj(output_data_path / "lung.obj", set(), model, color_mask=model,
     #              color_to_rgb_tuple=original_color_tuples, rot_mat=rot_mat)
 
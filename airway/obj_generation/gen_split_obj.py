@@ -1,12 +1,16 @@
 """Module to generate .obj file from splits (places cubes where splits are)
 """
+import sys
 from pathlib import Path
+from typing import Sequence
 
 import networkx as nx
 import numpy as np
 
 from airway.obj_generation.gen_obj import normalize
+from airway.obj_generation.glb import MODE_LINES, write_glb
 from airway.util.util import get_data_paths_from_args
+from airway.util.volumes import load_volume
 
 
 def gen_split_obj(
@@ -14,6 +18,7 @@ def gen_split_obj(
     graph,
     model_shape: np.ndarray,
     rot_mat: np.ndarray = None,
+    mesh_formats: Sequence[str] = ("obj",),
 ):
     edge_vertices = []
 
@@ -40,6 +45,16 @@ def gen_split_obj(
             j = i + 1
             file.write(f"l {j} {j + 1}\n")
 
+    if "glb" in mesh_formats:
+        lines = np.arange(len(edge_vertices)).reshape(-1, 2)
+        write_glb(
+            target_data_path.with_suffix(".glb"),
+            target_data_path.stem,
+            edge_vertices,
+            [("", None, lines)],
+            mode=MODE_LINES,
+        )
+
 
 def main():
     (
@@ -48,18 +63,31 @@ def main():
         post_composition_data_path,
         reduced_model_data_path,
     ) = get_data_paths_from_args(inputs=3)
+    # Mesh formats as set in stage_configs.yaml, comma separated (e.g. obj,glb)
+    try:
+        mesh_formats = sys.argv[5].split(",")
+    except IndexError:
+        mesh_formats = ["obj", "glb"]
 
     rot_mat = np.array([[0, 0, -1], [-1, 0, 0], [0, 1, 0]])
-    model = np.load(reduced_model_data_path / "reduced_model.npz")["arr_0"]
+    model = load_volume(reduced_model_data_path, "reduced_model")
 
     if not output_data_path.exists():
         output_data_path.mkdir(parents=True, exist_ok=True)
 
     graph = nx.read_graphml(post_composition_data_path / "tree.graphml")
-    gen_split_obj(output_data_path / "splits_no_post_processing.obj", graph, rot_mat=rot_mat, model_shape=model.shape)
+    gen_split_obj(
+        output_data_path / "splits_no_post_processing.obj",
+        graph,
+        rot_mat=rot_mat,
+        model_shape=model.shape,
+        mesh_formats=mesh_formats,
+    )
 
     graph = nx.read_graphml(post_processing_data_path / "tree.graphml")
-    gen_split_obj(output_data_path / "splits.obj", graph, rot_mat=rot_mat, model_shape=model.shape)
+    gen_split_obj(
+        output_data_path / "splits.obj", graph, rot_mat=rot_mat, model_shape=model.shape, mesh_formats=mesh_formats
+    )
 
 
 if __name__ == "__main__":
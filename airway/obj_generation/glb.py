@@ -0,0 +1,146 @@
+"""Binary glTF 2.0 (.glb) export of the meshes of stage-60 and stage-61
+
+The .glb files contain the same geometry as the .obj files, but are written straight from numpy buffers, which is a
+lot faster than formatting text and loads much faster (e.g. with Blender's glTF importer). All primitives of a mesh
+share one vertex buffer, each material is a primitive of its own with the material color as base color. Vertices get
+the color of the material of the first face they belong to as vertex color.
+"""
+import json
+import struct
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Constants of the glTF 2.0 specification
+GLB_MAGIC = b"glTF"
+GLB_VERSION = 2
+GLB_CHUNK_JSON = b"JSON"
+GLB_CHUNK_BIN = b"BIN\0"
+COMPONENT_UNSIGNED_BYTE = 5121
+COMPONENT_UNSIGNED_SHORT = 5123
+COMPONENT_UNSIGNED_INT = 5125
+COMPONENT_FLOAT = 5126
+TARGET_ARRAY_BUFFER = 34962
+TARGET_ELEMENT_ARRAY_BUFFER = 34963
+MODE_LINES = 1
+MODE_TRIANGLES = 4
+
+# Primitive of a mesh: name of its material, rgb color of the material (or None) and vertex indices
+Primitive = Tuple[str, Optional[Tuple[float, float, float]], np.ndarray]
+
+
+def quads_to_triangles(quads: np.ndarray) -> np.ndarray:
+    """Splits each quad (a, b, c, d) into the triangles (a, b, c) and (a, c, d)"""
+    return np.asarray(quads)[:, [0, 1, 2, 0, 2, 3]].reshape(-1, 3)
+
+
+class _GlbBuffer:
+    """Binary chunk of a .glb file with its buffer views and accessors"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.buffer_views: List[Dict[str, Any]] = []
+        self.accessors: List[Dict[str, Any]] = []
+
+    def add_accessor(self, array: np.ndarray, component_type: int, target: int, **attributes) -> int:
+        # Every buffer view starts 4 byte aligned, as required for all component types used here
+        self.data.extend(b"\0" * (-len(self.data) % 4))
+        self.buffer_views.append(
+            {"buffer": 0, "byteOffset": len(self.data), "byteLength": array.nbytes, "target": target}
+        )
+        self.data.extend(array.tobytes())
+        accessor_type = "SCALAR" if array.ndim == 1 else f"VEC{array.shape[1]}"
+        self.accessors.append(
+            {
+                "bufferView": len(self.buffer_views) - 1,
+                "componentType": component_type,
+                "count": len(array),
+                "type": accessor_type,
+                **attributes,
+            }
+        )
+        return len(self.accessors) - 1
+
+
+def write_glb(
+    path: Path,
+    name: str,
+    vertices: np.ndarray,
+    primitives: Sequence[Primitive],
+    vertex_colors: np.ndarray = None,
+    mode: int = MODE_TRIANGLES,
+):
+    """Writes a .glb file with a single mesh (and node) with the given name
+
+    vertices has shape (n, 3), the indices of each primitive have shape (m, 3) for triangles or (m, 2) for lines.
+    vertex_colors are rgb floats in [0, 1] with shape (n, 3).
+    """
+    buffer = _GlbBuffer()
+    positions = np.ascontiguousarray(vertices, dtype="<f4")
+    attributes = {
+        "POSITION": buffer.add_accessor(
+            positions,
+            COMPONENT_FLOAT,
+            TARGET_ARRAY_BUFFER,
+            min=positions.min(axis=0).tolist() if len(positions) else [0.0] * 3,
+            max=positions.max(axis=0).tolist() if len(positions) else [0.0] * 3,
+        )
+    }
+    if vertex_colors is not None:
+        rgba = np.full((len(vertex_colors), 4), 255, dtype=np.uint8)
+        rgba[:, :3] = np.round(np.clip(vertex_colors, 0, 1) * 255)
+        attributes["COLOR_0"] = buffer.add_accessor(rgba, COMPONENT_UNSIGNED_BYTE, TARGET_ARRAY_BUFFER, normalized=True)
+
+    # The largest value of the index type must not be used as index
+    if len(positions) < np.iinfo(np.uint16).max:
+        index_dtype, index_component_type = "<u2", COMPONENT_UNSIGNED_SHORT
+    else:
+        index_dtype, index_component_type = "<u4", COMPONENT_UNSIGNED_INT
+    materials, mesh_primitives = [], []
+    for material_name, rgb, indices in primitives:
+        primitive = {
+            "attributes": attributes,
+            "indices": buffer.add_accessor(
+                np.ascontiguousarray(indices, dtype=index_dtype).reshape(-1),
+                index_component_type,
+                TARGET_ELEMENT_ARRAY_BUFFER,
+            ),
+            "mode": mode,
+        }
+        if rgb is not None:
+            primitive["material"] = len(materials)
+            materials.append(
+                {
+                    "name": material_name,
+                    "doubleSided": True,
+                    "pbrMetallicRoughness": {
+                        "baseColorFactor": [*map(float, rgb), 1.0],
+                        "metallicFactor": 0.0,
+                        "roughnessFactor": 0.5,
+                    },
+                }
+            )
+        mesh_primitives.append(primitive)
+
+    gltf = {
+        "asset": {"version": "2.0", "generator": "Airway"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"name": name, "mesh": 0}],
+        "meshes": [{"name": name, "primitives": mesh_primitives}],
+        "buffers": [{"byteLength": len(buffer.data)}],
+        "bufferViews": buffer.buffer_views,
+        "accessors": buffer.accessors,
+    }
+    if materials:
+        gltf["materials"] = materials
+
+    json_chunk = json.dumps(gltf, separators=(",", ":")).encode()
+    json_chunk += b" " * (-len(json_chunk) % 4)
+    bin_chunk = bytes(buffer.data) + b"\0" * (-len(buffer.data) % 4)
+    length = 12 + 8 + len(json_chunk) + 8 + len(bin_chunk)
+    with open(path, "wb") as file:
+        file.write(GLB_MAGIC + struct.pack("<II", GLB_VERSION, length))
+        file.write(struct.pack("<I", len(json_chunk)) + GLB_CHUNK_JSON + json_chunk)
+        file.write(struct.pack("<I", len(bin_chunk)) + GLB_CHUNK_BIN + bin_chunk)
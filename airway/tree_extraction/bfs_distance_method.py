@@ -1,24 +1,31 @@
 import math
 import queue
+import sys
 from typing import Tuple, Dict
 
 import numpy as np
-from skimage.morphology import skeletonize
 
+from airway.util.dtypes import allocate_volume
 from airway.util.helper_functions import adjacent
+from airway.util.skeleton import compute_skeleton, save_skeleton
 from airway.util.util import get_data_paths_from_args
+from airway.util.volumes import load_bronchus_roi, save_volume, save_volume_statistics
 
 Coordinate = Tuple[int, int, int]
 
 output_data_path, input_data_path = get_data_paths_from_args()
 
-patient_data_file = input_data_path / "reduced_model.npz"
-
 distance_to_coords_file = output_data_path / "map_distance_to_coords"
 coord_to_distance_file = output_data_path / "map_coord_to_distance.txt"
 coord_to_previous_file = output_data_path / "map_coord_to_previous.txt"
 coord_to_next_count_file = output_data_path / "map_coord_to_next_count.txt"
-distance_mask_path = output_data_path / "distance_mask"
+
+# Skeletonization in tiles of this many layers (0 for the whole volume) with this many processes
+try:
+    skeleton_tile_size = int(sys.argv[3])
+    skeleton_workers = int(sys.argv[4])
+except IndexError:
+    skeleton_tile_size, skeleton_workers = 0, 1
 
 
 def find_first_voxel(model):
@@ -43,24 +50,14 @@ def find_first_voxel(model):
             return list(best)
 
 
-model = np.load(patient_data_file)["arr_0"]
-model[model != 1] = 0
-# import sys
-# print(np.unique(model, return_counts=True))
-
-# Skeletonize model
-skeleton = skeletonize(model)
-skeleton[skeleton != 0] = 1
-# print(np.unique(model, return_counts=True))
-# sys.exit(0)
-# print(np.count_nonzero(model))
-
-print(f"Model loaded with shape {skeleton.shape}")
-
-first_voxel = find_first_voxel(skeleton)
+def to_reduced_model(roi_volume: np.ndarray, dtype: np.dtype, roi_offset, reduced_model_shape) -> np.ndarray:
+    """Returns the volume of the bronchus region of interest placed in a volume of the shape of the reduced model"""
+    volume = np.zeros(reduced_model_shape, dtype=dtype)
+    volume[tuple(slice(low, low + size) for low, size in zip(roi_offset, roi_volume.shape))] = roi_volume
+    return volume
 
 
-def traverse_skeleton():
+def traverse_skeleton(skeleton: np.ndarray, first_voxel, roi_offset):
     bfs_queue = queue.Queue()
 
     bfs_queue.put((np.array(first_voxel), 0))
@@ -97,19 +94,22 @@ def traverse_skeleton():
                     next_count += 1
         coord_to_next_count[tuple(curr)] = next_count
 
-    np_dist_to_coords = np.array(distance_to_coords, dtype=object)
+    # Coordinates are saved as coordinates in the reduced model
+    np_dist_to_coords = np.array(
+        [[coord + roi_offset for coord in coords] for coords in distance_to_coords], dtype=object
+    )
     # print(np_dist_to_coords)
     np.savez_compressed(distance_to_coords_file, np_dist_to_coords)
     print(f"Writing distance to coords with shape: {np_dist_to_coords.shape}")
 
     for dictionary, filename in [
         (visited, coord_to_distance_file),
-        (coord_to_previous, coord_to_previous_file),
+        ({coord: previous + roi_offset for coord, previous in coord_to_previous.items()}, coord_to_previous_file),
         (coord_to_next_count, coord_to_next_count_file),
     ]:
         with open(filename, "w") as curr_file:
             for coord, dist in dictionary.items():
-                x, y, z = coord
+                x, y, z = np.add(coord, roi_offset)
                 curr_file.write(f"{x}, {y}, {z}: {dist}\n")
     return visited
 
@@ -119,9 +119,11 @@ def distance(c1: Coordinate, c2: Coordinate):
     return np.linalg.norm(np.array(c1) - np.array(c2))
 
 
-def get_distance_in_model_from_skeleton(visited: Dict[Coordinate, int]):
+def get_distance_in_model_from_skeleton(
+    visited: Dict[Coordinate, int], model: np.ndarray, roi_offset, reduced_model_shape
+):
 
-    distance_mask: np.ndarray = np.zeros(model.shape)
+    distance_mask: np.ndarray = allocate_volume("distance_mask", model.shape, max_value=max(visited.values()))
     origin: Dict[Coordinate, Coordinate] = {}
     bfs_queue = queue.Queue()
     for coord, dist in visited.items():
@@ -139,14 +141,39 @@ def get_distance_in_model_from_skeleton(visited: Dict[Coordinate, int]):
                 bfs_queue.put(adj)
                 distance_mask[adj] = distance_mask[curr]
                 origin[adj] = origin[curr]
-    np.savez_compressed(distance_mask_path, distance_mask)
-    print(*map(str, zip(*np.unique(distance_mask, return_counts=True))))
+    # Voxels outside of the region of interest are not in the bronchus, so their distance is 0 like before
+    distance_mask = to_reduced_model(distance_mask, distance_mask.dtype, roi_offset, reduced_model_shape)
+    save_volume(output_data_path, "distance_mask", distance_mask)
+    statistics = save_volume_statistics(output_data_path, "distance_mask", distance_mask)
+    print(*(str((int(distance), count)) for distance, count in statistics["label_counts"].items()))
     return distance_mask
 
 
 def main():
-    visited = traverse_skeleton()
-    distance_mask = get_distance_in_model_from_skeleton(visited)
+    # Everything is computed in the bronchus region of interest and converted to the reduced model when saving
+    model, roi_offset, reduced_model_shape = load_bronchus_roi(input_data_path)
+    model[model != 1] = 0
+    # import sys
+    # print(np.unique(model, return_counts=True))
+
+    # Skeletonize model, the skeleton is saved so that later stages do not have to skeletonize again. This happens in
+    # main(), as the processes of the tiles import this script again if they are started with spawn.
+    skeleton = compute_skeleton(model, tile_size=skeleton_tile_size, workers=skeleton_workers).astype(np.uint8)
+    save_skeleton(
+        output_data_path,
+        to_reduced_model(skeleton, bool, roi_offset, reduced_model_shape),
+        to_reduced_model(model, model.dtype, roi_offset, reduced_model_shape),
+        tile_size=skeleton_tile_size,
+    )
+    # print(np.unique(model, return_counts=True))
+    # sys.exit(0)
+    # print(np.count_nonzero(model))
+
+    print(f"Model loaded with shape {skeleton.shape}")
+
+    first_voxel = find_first_voxel(skeleton)
+    visited = traverse_skeleton(skeleton, first_voxel, roi_offset)
+    distance_mask = get_distance_in_model_from_skeleton(visited, model, roi_offset, reduced_model_shape)
 
 
 if __name__ == "__main__":
@@ -5,6 +5,7 @@ import numpy as np
 import networkx as nx
 
 from airway.util.util import get_data_paths_from_args
+from airway.util.volumes import load_label_counts, load_volume
 
 
 def get_value_from_model(coord, reduced_model):
@@ -203,11 +204,12 @@ def main():
         print(reduced_model_data_path)
         sys.exit("ERROR: stage-02 needed")
 
-    reduced_model = np.load(reduced_model_data_path / "reduced_model.npz")["arr_0"]
-    print(np.unique(reduced_model))
+    reduced_model = load_volume(reduced_model_data_path, "reduced_model", "model")
+    labels = sorted(load_label_counts(reduced_model_data_path, "reduced_model", reduced_model))
+    print(labels)
     reduced_model[reduced_model >= 7] = 0
     # Remove all voxels 7, 8 and 9 since these are veins/arteries and not useful in classification
-    print(np.unique(reduced_model))
+    print(sorted({label if label < 7 else 0 for label in labels}))
 
     np_coord = np.load(coord_file_path)["arr_0"]
     np_edges = np.load(edges_file_path)["arr_0"]
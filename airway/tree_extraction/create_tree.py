@@ -21,10 +21,10 @@ import numpy as np
 
 from airway.util.helper_functions import adjacent, find_radius_via_sphere
 from airway.util.util import get_data_paths_from_args
+from airway.util.volumes import load_bronchus_roi
 
 output_data_path, input_data_path, reduced_model_data_path = get_data_paths_from_args(inputs=2)
 
-REDUCED_MODEL = reduced_model_data_path / "reduced_model.npz"
 DISTANCE_TO_COORDS_FILE = input_data_path / "map_distance_to_coords.npz"
 MAP_COORD_TO_PREVIOUS_FILE = input_data_path / "map_coord_to_previous.txt"
 MAP_COORD_TO_NEXT_COUNT_FILE = input_data_path / "map_coord_to_next_count.txt"
@@ -34,7 +34,8 @@ FINAL_EDGES_FILE = output_data_path / "final_edges"
 EDGE_ATTRIBUTES_FILE = output_data_path / "edge_attributes"
 COORD_ATTRIBUTES_FILE = output_data_path / "coord_attributes"
 
-model = np.load(REDUCED_MODEL)["arr_0"]
+# Only the bronchus is needed, coordinates in the reduced model minus the offset are coordinates in it
+model, roi_offset, _ = load_bronchus_roi(reduced_model_data_path)
 print(model.shape)
 
 
@@ -218,7 +219,7 @@ for group_id in minimal_tree:
     xs.append(c[0])
     ys.append(c[1])
     zs.append(c[2])
-    group_area[group_id] = find_radius_via_sphere(c, {1}, model) * 2
+    group_area[group_id] = find_radius_via_sphere(c, {1}, model, offset=roi_offset) * 2
     group_diameter[group_id] = (group_area[group_id] / 2) ** 2 * math.pi
     group_attr.append(np.array([group_diameter[group_id], group_area[group_id], group_id[0]], dtype=object))
 
@@ -4,6 +4,7 @@ import networkx as nx
 
 from airway.tree_extraction.compose_tree import erase_level_from_graph
 from airway.tree_extraction.post_processing import load_graph
+from airway.util.cohort_store import add_graphs_to_cohort_store
 from airway.util.util import get_data_paths_from_args
 
 
@@ -20,6 +21,7 @@ def erase_orphaned_nodes(view):
 # creating subtrees for each lobe based on the lobe attribute
 def create_subtrees(graph, patient, target_path):
     # line will be written to csv file(patID, lobe2..6 if graph is connected)
+    lobe_graphs = {}
 
     # closure
     def filter_for_lobe(node):
@@ -36,6 +38,8 @@ def create_subtrees(graph, patient, target_path):
         lobe_graph = erase_level_from_graph(lobe_graph, 4)
         print(lobe_graph.number_of_nodes())
         nx.write_graphml(lobe_graph, target_path / f"lobe-{curr_lobe}-{patient}.graphml")
+        lobe_graphs[f"lobe-{curr_lobe}"] = lobe_graph
+    return lobe_graphs
 
 
 # ============================================================================
@@ -69,7 +73,8 @@ def main():
     nx.write_graphml(graph, output_data_path / "tree.graphml")
 
     # Store subtrees and connection statistics
-    create_subtrees(graph, patient, output_data_path)
+    lobe_graphs = create_subtrees(graph, patient, output_data_path)
+    add_graphs_to_cohort_store(output_data_path, {"tree": graph, **lobe_graphs})
 
 
 if __name__ == "__main__":
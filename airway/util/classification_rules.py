@@ -0,0 +1,221 @@
+"""Compiled version of classification.yaml
+
+Parsing the YAML and recursively computing the descendants of each classification is done once, the result
+is saved as a .npz file in the cache directory, keyed by the hash of the YAML file. Every label (including
+labels which are only referenced as children) gets an integer id, sets of labels are represented as
+bitsets (python ints) so that label-set operations in the search are bitwise.
+"""
+import copy
+import hashlib
+import os
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Iterable, List
+
+import numpy as np
+
+from airway.util.config_parsers import get_dict_from_yaml
+from airway.util.const import CACHE_PATH, CLASSIFICATION_CONFIG_PATH
+
+# Increase this whenever the compiled format changes, so that old cache files are not used anymore
+RULES_FORMAT_VERSION = 1
+
+
+def add_deep_descendants_to_classification_config(classification_config):
+    def recursive_get(classification):
+        if classification not in classification_config:
+            return []
+        cc = classification_config[classification]
+        dd = cc["deep_descendants"]
+        dd += cc.get("descendants", [])
+        for child in cc["children"]:
+            dd += recursive_get(child)
+        cc["deep_descendants"] = list(set(dd))
+        return dd
+
+    recursive_get("Trachea")
+
+
+def add_defaults_to_classification_config(classification_config):
+    defaults = {"children": [], "deep_descendants": [], "descendants": [], "take_best": False}
+    for cid in classification_config:
+        for key, val in defaults.items():
+            classification_config[cid][key] = classification_config[cid].get(key, copy.deepcopy(val))
+    for vector_index, cid in enumerate(classification_config):
+        if "vector" in classification_config[cid]:
+            classification_config[cid]["vector"] = np.array(classification_config[cid]["vector"])
+            classification_config[cid]["vector_index"] = vector_index
+
+
+def compile_classification_rules(classification_config: Dict[str, Dict[str, Any]]) -> Dict[str, np.ndarray]:
+    """Converts the parsed classification.yaml into arrays which can be saved with np.savez"""
+    classification_config = copy.deepcopy(classification_config)
+    add_defaults_to_classification_config(classification_config)
+    add_deep_descendants_to_classification_config(classification_config)
+
+    # Defined labels first (in the order of the YAML), then labels which are only referenced
+    labels = list(classification_config)
+    for config in classification_config.values():
+        for label in config["children"] + config["descendants"]:
+            if label not in labels:
+                labels.append(label)
+    label_ids = {label: label_id for label_id, label in enumerate(labels)}
+    count = len(labels)
+
+    def label_matrix(key: str) -> np.ndarray:
+        matrix = np.zeros((count, count), dtype=bool)
+        for label, config in classification_config.items():
+            matrix[label_ids[label], [label_ids[other] for other in config[key]]] = True
+        return matrix
+
+    # Children are saved as flat list with offsets, as their order is significant
+    children_indices = [
+        label_ids[child] for label in labels for child in classification_config.get(label, {}).get("children", [])
+    ]
+    children_offsets = np.cumsum(
+        [0] + [len(classification_config.get(label, {}).get("children", [])) for label in labels]
+    )
+
+    vectors = np.zeros((count, 3))
+    has_vector = np.zeros(count, dtype=bool)
+    colors = np.full(count, "", dtype="<U6")
+    for label, config in classification_config.items():
+        if "vector" in config:
+            vectors[label_ids[label]] = config["vector"]
+            has_vector[label_ids[label]] = True
+        if "color" in config:
+            colors[label_ids[label]] = str(config["color"])
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit_vectors = np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms != 0)
+
+    def flags(key: str) -> np.ndarray:
+        return np.array([bool(classification_config.get(label, {}).get(key, False)) for label in labels])
+
+    return {
+        "labels": np.array(labels),
+        "defined": np.array([label in classification_config for label in labels]),
+        "children_indices": np.array(children_indices, dtype=np.int32),
+        "children_offsets": children_offsets.astype(np.int32),
+        "descendants": label_matrix("descendants"),
+        "deep_descendants": label_matrix("deep_descendants"),
+        "take_best": flags("take_best"),
+        "clustering_endnode": flags("clustering_endnode"),
+        "has_vector": has_vector,
+        "vectors": vectors,
+        "unit_vectors": unit_vectors,
+        "colors": colors,
+    }
+
+
+def _bits_from_rows(matrix: np.ndarray) -> List[int]:
+    packed = np.packbits(matrix, axis=1, bitorder="little")
+    return [int.from_bytes(row.tobytes(), "little") for row in packed]
+
+
+class ClassificationRules:
+    """Label ids, bitsets, vectors and colors of all classifications
+
+    Bit i of a bitset corresponds to the label with id i, i.e. labels[i].
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.labels: List[str] = [str(label) for label in arrays["labels"]]
+        self.label_ids: Dict[str, int] = {label: label_id for label_id, label in enumerate(self.labels)}
+        self.defined = arrays["defined"]
+        offsets = arrays["children_offsets"]
+        self.children: List[List[int]] = [
+            arrays["children_indices"][start:end].tolist() for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+        self.take_best = arrays["take_best"]
+        self.clustering_endnode = arrays["clustering_endnode"]
+        self.has_vector = arrays["has_vector"]
+        self.vectors = arrays["vectors"]
+        self.unit_vectors = arrays["unit_vectors"]
+        self.colors: List[str] = [str(color) for color in arrays["colors"]]
+
+        self.bits: Dict[str, int] = {label: 1 << label_id for label, label_id in self.label_ids.items()}
+        self.descendant_bits = _bits_from_rows(arrays["descendants"])
+        self.deep_descendant_bits = _bits_from_rows(arrays["deep_descendants"])
+        self.children_bits = [sum(1 << child for child in children) for children in self.children]
+
+    def get_bits(self, labels: Iterable[str]) -> int:
+        """Returns the bitset of the given labels, unknown labels (e.g. "c5") are ignored"""
+        bits = 0
+        for label in labels:
+            bits |= self.bits.get(label, 0)
+        return bits
+
+    def get_labels(self, bits: int) -> List[str]:
+        return [label for label_id, label in enumerate(self.labels) if bits >> label_id & 1]
+
+    def is_clustering_endnode(self, label: str) -> bool:
+        return label in self.label_ids and bool(self.clustering_endnode[self.label_ids[label]])
+
+    def to_classification_config(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the classification config as dict with all defaults and descendants filled in
+
+        Next to the keys of classification.yaml each classification has its label_id (which is also its
+        vector_index) and the bitsets label_bit, children_bits, descendant_bits and subtree_bits (the
+        classification itself and all of its deep descendants).
+        """
+        classification_config = {}
+        for label_id, label in enumerate(self.labels):
+            if not self.defined[label_id]:
+                continue
+            config = {
+                "children": [self.labels[child] for child in self.children[label_id]],
+                "descendants": self.get_labels(self.descendant_bits[label_id]),
+                "deep_descendants": self.get_labels(self.deep_descendant_bits[label_id]),
+                "take_best": bool(self.take_best[label_id]),
+                "clustering_endnode": bool(self.clustering_endnode[label_id]),
+                "label_id": label_id,
+                "label_bit": 1 << label_id,
+                "children_bits": self.children_bits[label_id],
+                "descendant_bits": self.descendant_bits[label_id],
+                "subtree_bits": 1 << label_id | self.deep_descendant_bits[label_id],
+            }
+            if self.has_vector[label_id]:
+                config["vector"] = self.vectors[label_id].copy()
+                config["vector_index"] = label_id
+            if self.colors[label_id]:
+                config["color"] = self.colors[label_id]
+            classification_config[label] = config
+        return classification_config
+
+
+def _save_atomically(path: Path, arrays: Dict[str, np.ndarray]):
+    """Many processes may compile the rules at once, so the file is written to a temporary file first"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    file_descriptor, temp_path = tempfile.mkstemp(dir=path.parent, suffix=".npz")
+    try:
+        with os.fdopen(file_descriptor, "wb") as temp_file:
+            np.savez(temp_file, **arrays)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+@lru_cache(maxsize=None)
+def load_classification_rules(config_path: Path = CLASSIFICATION_CONFIG_PATH) -> ClassificationRules:
+    """Loads the compiled rules for the given classification.yaml, compiling and caching them if necessary"""
+    config_bytes = Path(config_path).read_bytes()
+    digest = hashlib.sha256(config_bytes + str(RULES_FORMAT_VERSION).encode()).hexdigest()[:16]
+    cache_path = CACHE_PATH / f"classification-{digest}.npz"
+    try:
+        with np.load(cache_path) as npz:
+            return ClassificationRules(dict(npz))
+    except (OSError, ValueError, KeyError):
+        pass
+    arrays = compile_classification_rules(get_dict_from_yaml(Path(config_path)))
+    try:
+        _save_atomically(cache_path, arrays)
+    except OSError:
+        print(f"WARNING: Could not cache compiled classification rules in {cache_path}")
+    return ClassificationRules(arrays)
+
+
+def get_compiled_classification_config() -> Dict[str, Dict[str, Any]]:
+    """Same as parse_classification_config(), but with defaults, descendants and bitsets (see ClassificationRules)"""
+    return load_classification_rules().to_classification_config()
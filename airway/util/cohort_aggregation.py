@@ -0,0 +1,185 @@
+"""Incremental aggregation of per patient results for the cohort stages
+
+A cohort stage reduces every patient to a contribution, which is a nested dict with numbers or lists of numbers
+(counts, sums, histograms) as leaves. The total of all contributions is what the report is rendered from. Total and
+contributions are saved next to the cohort store (see cohort_store.py), so when a stage is run again only patients
+whose shard changed are folded in (after subtracting their previous contribution), instead of reducing the whole
+cohort again. Each contribution has its own file, so folding in a patient does not rewrite the others.
+"""
+import copy
+import json
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional
+
+import numpy as np
+
+from airway.util.cohort_store import CohortStore, append_json_lines, read_json_lines, save_atomically, save_json_lines
+
+# Increase this whenever the format changes, so that old aggregations are reduced again
+COHORT_AGGREGATION_FORMAT_VERSION = 3
+
+
+def add_contribution(total: Dict[str, Any], contribution: Dict[str, Any], sign: int = 1):
+    """Adds (or subtracts with sign=-1) the contribution to the total in place
+
+    Leaves which are zero after subtracting are removed, so contributions keyed by patient (e.g. {patient: 1}) can
+    be removed again.
+    """
+    for key, value in contribution.items():
+        if isinstance(value, dict):
+            add_contribution(total.setdefault(key, {}), value, sign)
+            if not total[key]:
+                del total[key]
+        else:
+            summed = np.add(total.get(key, 0), np.multiply(sign, value))
+            if sign < 0 and not np.any(summed):
+                total.pop(key, None)
+            else:
+                total[key] = summed.tolist()
+
+
+class CohortAggregation:
+    """Total of a single aggregation, the contributions of the patients are loaded when they are needed"""
+
+    def __init__(self, path: Path, total: Dict[str, Any], shard_mtimes: Dict[str, float]):
+        self.path = path
+        self.total = total
+        self.shard_mtimes = shard_mtimes
+
+    @property
+    def patients(self):
+        return sorted(self.shard_mtimes)
+
+    def get_contribution(self, patient: str) -> Dict[str, Any]:
+        return _load_contribution(self.path, patient, self.shard_mtimes[patient])
+
+    def get_total(self, excluded_patients: Iterable[str] = ()) -> Dict[str, Any]:
+        """Returns the total without the contributions of the given patients (e.g. the ignored ones)"""
+        total = copy.deepcopy(self.total)
+        for patient in set(excluded_patients) & set(self.shard_mtimes):
+            add_contribution(total, self.get_contribution(patient), sign=-1)
+        return total
+
+
+def _get_contribution_path(path: Path, patient: str) -> Path:
+    return path / "contributions" / f"{patient}.json"
+
+
+def _load_contribution(path: Path, patient: str, shard_mtime: float) -> Optional[Dict[str, Any]]:
+    """Returns None if the contribution is missing or was created from another shard than the one of the total"""
+    try:
+        with _get_contribution_path(path, patient).open("r") as file:
+            saved = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return saved["contribution"] if saved.get("shard_mtime") == shard_mtime else None
+
+
+def _load_state(path: Path, parameters: Any) -> Optional[Dict[str, Any]]:
+    """Returns the total and the shard mtime of each patient in it, None if the saved state can not be continued"""
+    try:
+        with (path / "total.json").open("r") as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        return None
+    entries = read_json_lines(path / "log.jsonl")
+    if (
+        state.get("version") != COHORT_AGGREGATION_FORMAT_VERSION
+        or state.get("parameters") != parameters
+        or entries is None
+        or len(entries) != state.get("log_length")
+    ):
+        return None
+    state["shard_mtimes"] = {}
+    for entry in entries:
+        if entry.get("removed"):
+            state["shard_mtimes"].pop(entry["patient"], None)
+        else:
+            state["shard_mtimes"][entry["patient"]] = entry["shard_mtime"]
+    return state
+
+
+def aggregate_cohort(
+    store: CohortStore,
+    name: str,
+    contribute: Callable[[CohortStore, str], Dict[str, Any]],
+    parameters: Any = None,
+) -> CohortAggregation:
+    """Folds every new or changed patient of the store into the saved aggregation with the given name
+
+    contribute(store, patient) returns the contribution of a single patient. parameters must be JSON serializable
+    and contain everything the contributions depend on (e.g. parts of the classification config), if they change
+    all patients are reduced again.
+
+    The aggregation is saved in <store>/aggregations/<name>/: the contribution of each patient in its own file, the
+    total in total.json and the patients in the total in an append-only log, so folding in a patient only writes
+    its contribution, a line of the log and the total.
+    """
+    path = store.path / "aggregations" / name
+    parameters = json.loads(json.dumps(parameters))
+    state = _load_state(path, parameters)
+    is_new = state is None
+    if is_new:
+        state = {"total": {}, "shard_mtimes": {}, "log_length": 0}
+    total, shard_mtimes = state["total"], state["shard_mtimes"]
+
+    removed_patients = sorted(set(shard_mtimes) - set(store.patients))
+    changed_patients = [
+        patient for patient in store.patients if shard_mtimes.get(patient) != store.shard_mtimes[patient]
+    ]
+    for patient in removed_patients + [patient for patient in changed_patients if patient in shard_mtimes]:
+        previous_contribution = _load_contribution(path, patient, shard_mtimes[patient])
+        if previous_contribution is None:
+            # The contribution was replaced by a run which did not finish, so it can not be subtracted from the total
+            print(f"Aggregating {name} of all patients again")
+            (path / "total.json").unlink()
+            return aggregate_cohort(store, name, contribute, parameters)
+        add_contribution(total, previous_contribution, sign=-1)
+
+    entries = []
+    for patient in removed_patients:
+        del shard_mtimes[patient]
+        entries.append({"patient": patient, "removed": True})
+    contributions = {}
+    for patient in changed_patients:
+        # Numpy arrays and scalars in the contribution are converted to lists and python numbers
+        contribution = json.loads(json.dumps(contribute(store, patient), default=lambda value: value.tolist()))
+        add_contribution(total, contribution)
+        contributions[patient] = contribution
+        shard_mtimes[patient] = store.shard_mtimes[patient]
+        entries.append({"patient": patient, "shard_mtime": shard_mtimes[patient]})
+
+    if entries or is_new:
+        (path / "contributions").mkdir(parents=True, exist_ok=True)
+        for patient, contribution in contributions.items():
+            saved = {"shard_mtime": shard_mtimes[patient], "contribution": contribution}
+            save_atomically(_get_contribution_path(path, patient), lambda file: file.write(json.dumps(saved).encode()))
+        removed_paths = [_get_contribution_path(path, patient) for patient in removed_patients]
+        if is_new:
+            # Contributions of an earlier aggregation which are not part of the new total
+            removed_paths = [
+                contribution_path
+                for contribution_path in (path / "contributions").glob("*.json")
+                if contribution_path.stem not in shard_mtimes
+            ]
+        for removed_path in removed_paths:
+            removed_path.unlink()
+        log_length = state["log_length"] + len(entries)
+        if is_new or log_length > 2 * len(shard_mtimes):
+            # The log only keeps the latest entry of each patient
+            entries = [
+                {"patient": patient, "shard_mtime": shard_mtime} for patient, shard_mtime in shard_mtimes.items()
+            ]
+            save_json_lines(path / "log.jsonl", entries)
+            log_length = len(entries)
+        else:
+            append_json_lines(path / "log.jsonl", entries)
+        # The total is written last, if a run does not finish the length of the log does not match the total
+        saved_state = {
+            "version": COHORT_AGGREGATION_FORMAT_VERSION,
+            "parameters": parameters,
+            "total": total,
+            "log_length": log_length,
+        }
+        save_atomically(path / "total.json", lambda file: file.write(json.dumps(saved_state).encode()))
+    return CohortAggregation(path, total, shard_mtimes)
@@ -0,0 +1,513 @@
+"""Columnar store of all trees of a stage, used by the cohort stages instead of parsing every GraphML file
+
+The store of a stage lives in <data>/cohort_store/<stage>/ (outside of the stage directory, so it is not mistaken
+for a patient). Every patient has a shard (shards/<patient>.npz) containing the node, edge and graph tables of all
+its GraphML files (tree.graphml, tree_gt.graphml, lobe-2-<patient>.graphml, ...). Shards are written directly by
+stage-07 and stage-10 and are otherwise created from GraphML files which are newer than the shard.
+
+The rows of all shards are stored in a single file per column (columns-*/<table>.<column>.bin), which is loaded with
+memory mapping. The rows of a new or changed shard are appended to the columns and recorded in an append-only log
+(log.jsonl), so updating the store only reads and writes the rows of the changed patients. The columns are only
+created from all shards again once most of their rows are outdated.
+
+Node ids are expected to be integers (as created by stage-05), they are converted back to strings when a graph is
+rebuilt. The attributes listed in NODE_COLUMNS and EDGE_COLUMNS have their own column, which can be queried. All other
+attributes (e.g. group_sizes), values equal to the missing value of their column (e.g. lobe=-1) and values of another
+type than their column are stored as JSON in the attributes column of their row instead, so rebuilt graphs have the
+same attributes as the GraphML files. In the own column of an attribute these values look like missing values.
+"""
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import networkx as nx
+import numpy as np
+
+# Increase this whenever the format changes, so that old shards are created again
+COHORT_STORE_FORMAT_VERSION = 4
+
+# Attribute name -> (dtype, value used if the attribute is missing)
+NODE_COLUMNS = {
+    "x": (np.float64, np.nan),
+    "y": (np.float64, np.nan),
+    "z": (np.float64, np.nan),
+    "lobe": (np.int32, -1),
+    "level": (np.int32, -1),
+    "group_size": (np.int32, -1),
+    "group": (np.int32, -1),
+    "successor_count": (np.int32, -1),
+    "split_classification": (np.str_, ""),
+    "split_classification_gt": (np.str_, ""),
+    "cost": (np.float64, np.nan),
+    "color": (np.str_, ""),
+    "subtree_hash": (np.int64, -1),
+}
+EDGE_COLUMNS = {
+    "weight": (np.float64, np.nan),
+}
+TABLES = {
+    "nodes": ["patient", "graph", "node_id", "parent", "attributes", *NODE_COLUMNS],
+    "edges": ["patient", "graph", "source", "target", "attributes", *EDGE_COLUMNS],
+    "graphs": ["patient", "graph", "attributes", "node_start", "node_stop", "edge_start", "edge_stop"],
+}
+
+
+def get_cohort_store_path(stage_path: Path) -> Path:
+    """Returns the path of the store of the given stage, e.g. <data>/stage-10 -> <data>/cohort_store/stage-10"""
+    stage_path = Path(stage_path)
+    return stage_path.parent / "cohort_store" / stage_path.name
+
+
+def get_graph_name(graphml_path: Path, patient: str) -> str:
+    """tree.graphml -> tree, lobe-2-<patient>.graphml -> lobe-2"""
+    name = graphml_path.stem
+    suffix = f"-{patient}"
+    return name[: -len(suffix)] if name.endswith(suffix) else name
+
+
+def _is_missing(value, missing) -> bool:
+    return value != value if missing != missing else value == missing
+
+
+def _fits_column(value, dtype, missing) -> bool:
+    """Whether the value can be restored from a column with the given dtype and missing value"""
+    if _is_missing(value, missing):
+        return False
+    if dtype is np.str_:
+        return isinstance(value, str)
+    if isinstance(value, (bool, np.bool_)):
+        return False
+    if dtype is np.float64:
+        return isinstance(value, (int, float, np.integer, np.floating))
+    return isinstance(value, (int, np.integer))
+
+
+def _to_json(value):
+    return value.item() if isinstance(value, np.generic) else str(value)
+
+
+def _add_attributes(columns: Dict[str, List], table: str, table_columns: Dict, attributes: Dict):
+    """Appends the attributes of a node or edge to the columns of the table, the others to its attributes column"""
+    other_attributes = {key: value for key, value in attributes.items() if key not in table_columns}
+    for column, (dtype, missing) in table_columns.items():
+        value = attributes.get(column, missing)
+        if column in attributes and not _fits_column(value, dtype, missing):
+            other_attributes[column] = value
+            value = missing
+        columns[f"{table}.{column}"].append(value)
+    columns[f"{table}.attributes"].append(json.dumps(other_attributes, default=_to_json) if other_attributes else "")
+
+
+def _get_parents(graph: nx.Graph) -> Dict[str, int]:
+    """Parent of each node when traversing each component from its node with the lowest level"""
+    parents = {}
+    for component in nx.connected_components(graph):
+        root = min(component, key=lambda node: (graph.nodes[node].get("level", 0), int(node)))
+        parents[root] = -1
+        parents.update({child: int(parent) for child, parent in nx.bfs_predecessors(graph, root)})
+    return parents
+
+
+def get_tables(patient: str, graphs: Dict[str, nx.Graph]) -> Dict[str, np.ndarray]:
+    """Converts the graphs of a single patient into the columns of the node, edge and graph tables"""
+    columns: Dict[str, List] = {f"{table}.{column}": [] for table, names in TABLES.items() for column in names}
+    for name, graph in sorted(graphs.items()):
+        parents = _get_parents(graph)
+        columns["graphs.node_start"].append(len(columns["nodes.node_id"]))
+        columns["graphs.edge_start"].append(len(columns["edges.source"]))
+        for node_id, attributes in graph.nodes(data=True):
+            columns["nodes.node_id"].append(int(node_id))
+            columns["nodes.parent"].append(parents[node_id])
+            _add_attributes(columns, "nodes", NODE_COLUMNS, attributes)
+        for source, target, attributes in graph.edges(data=True):
+            columns["edges.source"].append(int(source))
+            columns["edges.target"].append(int(target))
+            _add_attributes(columns, "edges", EDGE_COLUMNS, attributes)
+        columns["graphs.node_stop"].append(len(columns["nodes.node_id"]))
+        columns["graphs.edge_stop"].append(len(columns["edges.source"]))
+        graph_attributes = {k: v for k, v in graph.graph.items() if k not in ["node_default", "edge_default"]}
+        columns["graphs.attributes"].append(json.dumps(graph_attributes, default=str))
+        columns["graphs.graph"].append(name)
+        columns["graphs.patient"].append(patient)
+        node_count = graph.number_of_nodes()
+        columns["nodes.graph"] += [name] * node_count
+        columns["nodes.patient"] += [patient] * node_count
+        edge_count = graph.number_of_edges()
+        columns["edges.graph"] += [name] * edge_count
+        columns["edges.patient"] += [patient] * edge_count
+
+    dtypes = {
+        **{f"nodes.{column}": dtype for column, (dtype, _) in NODE_COLUMNS.items()},
+        **{f"edges.{column}": dtype for column, (dtype, _) in EDGE_COLUMNS.items()},
+    }
+    tables = {}
+    for key, values in columns.items():
+        if key.endswith((".patient", ".graph", ".attributes")):
+            dtype = np.str_
+        else:
+            dtype = dtypes.get(key, np.int32)
+        tables[key] = np.array(values, dtype=dtype)
+    return tables
+
+
+def save_atomically(path: Path, save):
+    """Writes to a temporary file first, so that readers never see partially written files"""
+    file_descriptor, temp_path = tempfile.mkstemp(dir=path.parent, suffix=path.suffix)
+    try:
+        with os.fdopen(file_descriptor, "wb") as temp_file:
+            save(temp_file)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def write_patient_shard(store_path: Path, patient: str, graphs: Dict[str, nx.Graph]):
+    shard_path = store_path / "shards" / f"{patient}.npz"
+    shard_path.parent.mkdir(parents=True, exist_ok=True)
+    tables = get_tables(patient, graphs)
+    tables["version"] = np.array(COHORT_STORE_FORMAT_VERSION)
+    save_atomically(shard_path, lambda file: np.savez(file, **tables))
+
+
+def add_graphs_to_cohort_store(patient_stage_path: Path, graphs: Dict[str, nx.Graph]):
+    """Called by stages which just wrote the given graphs, so the cohort stages do not need to parse them again
+
+    The graph names are the file names without ending and patient, e.g. {"tree": ..., "lobe-2": ...}.
+    """
+    patient_stage_path = Path(patient_stage_path)
+    store_path = get_cohort_store_path(patient_stage_path.parent)
+    write_patient_shard(store_path, patient_stage_path.name, graphs)
+
+
+def _get_graphml_paths(patient_dir: Path) -> Dict[str, Path]:
+    return {get_graph_name(path, patient_dir.name): path for path in sorted(patient_dir.glob("*.graphml"))}
+
+
+def _is_shard_up_to_date(shard_path: Path, graphml_paths: Dict[str, Path]) -> bool:
+    if not shard_path.exists():
+        return False
+    if shard_path.stat().st_mtime < max(path.stat().st_mtime for path in graphml_paths.values()):
+        return False
+    try:
+        with np.load(shard_path) as shard:
+            return (
+                int(shard["version"]) == COHORT_STORE_FORMAT_VERSION
+                and set(shard["graphs.graph"].tolist()) == set(graphml_paths)
+            )
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def _is_entry_up_to_date(entry: Dict, shard_path: Path, graphml_paths: Dict[str, Path]) -> bool:
+    """Whether the rows of the patient in the columns belong to the shard and the shard to the GraphML files"""
+    if not shard_path.exists() or shard_path.stat().st_mtime != entry["shard_mtime"]:
+        return False
+    return entry["graphs"] == sorted(graphml_paths) and entry["shard_mtime"] >= max(
+        path.stat().st_mtime for path in graphml_paths.values()
+    )
+
+
+def read_json_lines(path: Path) -> Optional[List[Dict]]:
+    """Returns the entries of an append-only log, None if it is missing or an entry was not written completely"""
+    try:
+        with path.open("r") as file:
+            return [json.loads(line) for line in file]
+    except (OSError, ValueError):
+        return None
+
+
+def append_json_lines(path: Path, entries: Iterable[Dict]):
+    with path.open("a") as file:
+        file.write("".join(json.dumps(entry) + "\n" for entry in entries))
+
+
+def save_json_lines(path: Path, entries: Iterable[Dict]):
+    lines = "".join(json.dumps(entry) + "\n" for entry in entries)
+    save_atomically(path, lambda file: file.write(lines.encode()))
+
+
+def _read_store_log(store_path: Path) -> Optional[Dict]:
+    """Replays the log of the store, returns None if it is missing or outdated
+
+    The first entry names the directory and dtypes of the columns, every further entry either adds the rows of a
+    patient's shard (replacing its previous rows) or removes the patient.
+    """
+    entries = read_json_lines(store_path / "log.jsonl")
+    if not entries or entries[0].get("version") != COHORT_STORE_FORMAT_VERSION:
+        return None
+    state = {**entries[0], "patients": {}, "row_counts": {table: 0 for table in TABLES}}
+    for entry in entries[1:]:
+        if entry.get("removed"):
+            state["patients"].pop(entry["patient"], None)
+            continue
+        state["patients"][entry["patient"]] = entry
+        for table, (_, stop) in entry["rows"].items():
+            state["row_counts"][table] = max(state["row_counts"][table], stop)
+    return state
+
+
+def _get_column_path(store_path: Path, state: Dict, key: str) -> Path:
+    return store_path / state["columns"] / f"{key}.bin"
+
+
+def _get_stale_row_count(state: Dict) -> int:
+    """Number of node rows of patients which were changed or removed since the columns were created"""
+    live_row_count = sum(
+        stop - start for start, stop in (entry["rows"]["nodes"] for entry in state["patients"].values())
+    )
+    return state["row_counts"]["nodes"] - live_row_count
+
+
+def _append_shards(store_path: Path, state: Dict, patients: List[str], removed_patients: Iterable[str]) -> bool:
+    """Appends the rows of the shards of the given patients to the columns, this only reads and writes their rows
+
+    The previous rows of the patients (and the rows of the removed patients) stay in the columns, they are just no
+    longer referenced by the log. Returns False if the columns need to be created again instead, because a value
+    does not fit into its column or most rows would be unreferenced.
+    """
+    entries = [{"patient": patient, "removed": True} for patient in sorted(removed_patients)]
+    row_counts = dict(state["row_counts"])
+    columns = {key: [] for key in state["dtypes"]}
+    for patient in patients:
+        with np.load(store_path / "shards" / f"{patient}.npz") as shard:
+            rows = {}
+            for table in TABLES:
+                count = len(shard[f"{table}.patient"])
+                rows[table] = [row_counts[table], row_counts[table] + count]
+            for key in columns:
+                values = shard[key]
+                if key in ["graphs.node_start", "graphs.node_stop", "graphs.edge_start", "graphs.edge_stop"]:
+                    # Row ranges are relative to the shard, make them relative to the columns
+                    values = values + row_counts["nodes" if ".node_" in key else "edges"]
+                columns[key].append(values)
+            row_counts = {table: stop for table, (_, stop) in rows.items()}
+        shard_mtime = (store_path / "shards" / f"{patient}.npz").stat().st_mtime
+        graphs = sorted(columns["graphs.graph"][-1].tolist())
+        entries.append({"patient": patient, "shard_mtime": shard_mtime, "graphs": graphs, "rows": rows})
+
+    new_state = {**state, "patients": dict(state["patients"]), "row_counts": row_counts}
+    for entry in entries:
+        new_state["patients"].pop(entry["patient"], None)
+        if not entry.get("removed"):
+            new_state["patients"][entry["patient"]] = entry
+    if _get_stale_row_count(new_state) > row_counts["nodes"] // 2:
+        return False
+    for key, values in columns.items():
+        dtype = np.dtype(state["dtypes"][key])
+        if values and any(value.dtype.kind != dtype.kind or not np.can_cast(value.dtype, dtype) for value in values):
+            return False
+        column_path = _get_column_path(store_path, state, key)
+        table = key.split(".")[0]
+        if not column_path.exists() or column_path.stat().st_size < state["row_counts"][table] * dtype.itemsize:
+            return False
+
+    for key, values in columns.items():
+        table = key.split(".")[0]
+        dtype = np.dtype(state["dtypes"][key])
+        with _get_column_path(store_path, state, key).open("r+b") as file:
+            # Rows of a run which did not finish are overwritten
+            file.truncate(state["row_counts"][table] * dtype.itemsize)
+            file.seek(0, os.SEEK_END)
+            for value in values:
+                value.astype(dtype).tofile(file)
+    # The log is written last, so the new rows are only used once they were written completely
+    append_json_lines(store_path / "log.jsonl", entries)
+    return True
+
+
+def _get_column_dtype(values: np.ndarray) -> np.dtype:
+    """Strings get twice the width needed, so later patients with longer strings can usually be appended"""
+    if values.dtype.kind == "U":
+        return np.dtype(f"{values.dtype.byteorder}U{2 * max(values.dtype.itemsize // 4, 4)}")
+    return values.dtype
+
+
+def _create_columns(store_path: Path, patients: List[str]):
+    """Concatenates the shards of all patients into a new directory of columns and starts a new log"""
+    columns_path = Path(tempfile.mkdtemp(dir=store_path, prefix="columns-"))
+    shards = [np.load(store_path / "shards" / f"{patient}.npz") for patient in patients]
+    counts = {table: [len(shard[f"{table}.patient"]) for shard in shards] for table in TABLES}
+    offsets = {table: np.cumsum([0] + table_counts).tolist() for table, table_counts in counts.items()}
+    dtypes = {}
+    for table, columns in TABLES.items():
+        for column in columns:
+            key = f"{table}.{column}"
+            values = [shard[key] for shard in shards]
+            if key in ["graphs.node_start", "graphs.node_stop", "graphs.edge_start", "graphs.edge_stop"]:
+                # Row ranges are relative to the shard, make them relative to the columns
+                row_table = "nodes" if "node" in column else "edges"
+                values = [value + offset for value, offset in zip(values, offsets[row_table])]
+            array = np.concatenate(values) if values else np.array([], dtype=np.int32)
+            dtypes[key] = _get_column_dtype(array).str
+            array.astype(dtypes[key]).tofile(str(columns_path / f"{key}.bin"))
+    entries = [{"version": COHORT_STORE_FORMAT_VERSION, "columns": columns_path.name, "dtypes": dtypes}]
+    for index, (patient, shard) in enumerate(zip(patients, shards)):
+        rows = {table: [offsets[table][index], offsets[table][index + 1]] for table in TABLES}
+        shard_mtime = (store_path / "shards" / f"{patient}.npz").stat().st_mtime
+        entries.append(
+            {
+                "patient": patient,
+                "shard_mtime": shard_mtime,
+                "graphs": sorted(shard["graphs.graph"].tolist()),
+                "rows": rows,
+            }
+        )
+        shard.close()
+    save_json_lines(store_path / "log.jsonl", entries)
+    for path in store_path.glob("columns-*"):
+        if path != columns_path:
+            shutil.rmtree(path)
+
+
+def update_cohort_store(stage_path: Path) -> Path:
+    """Creates missing or outdated shards from the GraphML files and appends their rows to the columns
+
+    Only the shards of new or changed patients are read, so adding a patient does not depend on the cohort size.
+    The columns are created from all shards again if the log is missing or outdated, a string does not fit into its
+    column or most rows belong to changed or removed patients.
+    """
+    stage_path = Path(stage_path)
+    store_path = get_cohort_store_path(stage_path)
+    shards_path = store_path / "shards"
+    shards_path.mkdir(parents=True, exist_ok=True)
+    state = _read_store_log(store_path)
+    entries = state["patients"] if state is not None else {}
+
+    changed_patients = []
+    patients = []
+    for patient_dir in sorted(stage_path.glob("*")):
+        graphml_paths = _get_graphml_paths(patient_dir) if patient_dir.is_dir() else {}
+        if not graphml_paths:
+            continue
+        patient = patient_dir.name
+        patients.append(patient)
+        shard_path = shards_path / f"{patient}.npz"
+        if patient in entries and _is_entry_up_to_date(entries[patient], shard_path, graphml_paths):
+            continue
+        if not _is_shard_up_to_date(shard_path, graphml_paths):
+            print(f"Adding {patient} to cohort store {store_path}")
+            graphs = {name: nx.read_graphml(path) for name, path in graphml_paths.items()}
+            write_patient_shard(store_path, patient, graphs)
+        changed_patients.append(patient)
+    removed_patients = set(entries) - set(patients)
+    for shard_path in shards_path.glob("*.npz"):
+        if shard_path.stem not in patients:
+            shard_path.unlink()
+
+    if state is None or (
+        (changed_patients or removed_patients)
+        and not _append_shards(store_path, state, changed_patients, removed_patients)
+    ):
+        _create_columns(store_path, patients)
+    return store_path
+
+
+def _load_column(path: Path, dtype: np.dtype, count: int) -> np.ndarray:
+    if count == 0:
+        # Empty files cannot be memory mapped
+        return np.array([], dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+class CohortStore:
+    """Node, edge and graph tables of all patients of a stage
+
+    nodes, edges and graphs map column names to (memory mapped) arrays of equal length, so they can be queried
+    with vectorized filters, e.g. store.nodes["lobe"][store.select_nodes(graph="tree")]. Rows of a single graph
+    are contiguous, get_rows() returns their slices. The columns can also contain the previous rows of changed or
+    removed patients, live_nodes marks the node rows which are not outdated.
+    """
+
+    def __init__(self, store_path: Path):
+        self.path = Path(store_path)
+        state = _read_store_log(self.path)
+        assert state is not None, f"Cohort store {self.path} is missing or outdated, use load_cohort_store()"
+
+        def load_table(table):
+            return {
+                column: _load_column(
+                    _get_column_path(self.path, state, f"{table}.{column}"),
+                    np.dtype(state["dtypes"][f"{table}.{column}"]),
+                    state["row_counts"][table],
+                )
+                for column in TABLES[table]
+            }
+
+        self.nodes = load_table("nodes")
+        self.edges = load_table("edges")
+        self.graphs = load_table("graphs")
+        self._graph_rows: Dict[Tuple[str, str], int] = {}
+        self.live_nodes = np.zeros(state["row_counts"]["nodes"], dtype=bool)
+        for patient, entry in state["patients"].items():
+            start, stop = entry["rows"]["graphs"]
+            for row, graph in enumerate(self.graphs["graph"][start:stop].tolist(), start):
+                self._graph_rows[(patient, graph)] = row
+            self.live_nodes[slice(*entry["rows"]["nodes"])] = True
+        self.patients: List[str] = sorted(state["patients"])
+        self.shard_mtimes: Dict[str, float] = {
+            patient: entry["shard_mtime"] for patient, entry in state["patients"].items()
+        }
+
+    def get_graph_names(self, patient: str) -> List[str]:
+        return sorted(graph for curr_patient, graph in self._graph_rows if curr_patient == patient)
+
+    def has_graph(self, patient: str, graph: str = "tree") -> bool:
+        return (patient, graph) in self._graph_rows
+
+    def get_rows(self, patient: str, graph: str = "tree") -> Tuple[slice, slice]:
+        """Returns the slices of the node and edge rows of the given graph"""
+        row = self._graph_rows[(patient, graph)]
+        node_rows = slice(int(self.graphs["node_start"][row]), int(self.graphs["node_stop"][row]))
+        edge_rows = slice(int(self.graphs["edge_start"][row]), int(self.graphs["edge_stop"][row]))
+        return node_rows, edge_rows
+
+    def select_nodes(self, graph: str = "tree", **equals) -> np.ndarray:
+        """Boolean mask of all live nodes in graphs with the given name and attributes, e.g. select_nodes(lobe=2)"""
+        mask = (self.nodes["graph"] == graph) & self.live_nodes
+        for column, value in equals.items():
+            mask &= self.nodes[column] == value
+        return mask
+
+    def get_graph(self, patient: str, graph: str = "tree") -> nx.Graph:
+        """Rebuilds the networkx graph with the attributes of the GraphML file, missing attributes are left out"""
+        row = self._graph_rows[(patient, graph)]
+        node_rows, edge_rows = self.get_rows(patient, graph)
+        nx_graph = nx.Graph(**json.loads(str(self.graphs["attributes"][row])))
+        nx_graph.graph.setdefault("patient", patient)
+
+        def get_attributes(table, columns, rows) -> Iterable[Dict]:
+            values = [(column, table[column][rows].tolist(), missing) for column, (_, missing) in columns.items()]
+            other_attributes = table["attributes"][rows].tolist()
+            for index in range(rows.stop - rows.start):
+                attributes = {
+                    column: column_values[index]
+                    for column, column_values, missing in values
+                    if not _is_missing(column_values[index], missing)
+                }
+                if other_attributes[index]:
+                    attributes.update(json.loads(other_attributes[index]))
+                yield attributes
+
+        node_ids = map(str, self.nodes["node_id"][node_rows].tolist())
+        nx_graph.add_nodes_from(zip(node_ids, get_attributes(self.nodes, NODE_COLUMNS, node_rows)))
+        sources = map(str, self.edges["source"][edge_rows].tolist())
+        targets = map(str, self.edges["target"][edge_rows].tolist())
+        nx_graph.add_edges_from(zip(sources, targets, get_attributes(self.edges, EDGE_COLUMNS, edge_rows)))
+        return nx_graph
+
+    def get_graphs(self, graph: str = "tree", ignored_patients: Iterable[str] = ()) -> List[nx.Graph]:
+        ignored_patients = set(ignored_patients)
+        return [
+            self.get_graph(patient, graph)
+            for patient in self.patients
+            if patient not in ignored_patients and self.has_graph(patient, graph)
+        ]
+
+
+def load_cohort_store(stage_path: Path) -> CohortStore:
+    """Updates the store of the given stage and loads it"""
+    return CohortStore(update_cohort_store(stage_path))
@@ -6,6 +6,7 @@ PACKAGE_PATH = Path(__file__).parents[2]
 # Configs path
 CONFIGS_PATH = PACKAGE_PATH / "airway" / "configs"
 LOGS_PATH = PACKAGE_PATH / "logs"
+CACHE_PATH = PACKAGE_PATH / ".cache"
 
 # Actual files
 STAGE_CONFIGS_PATH = CONFIGS_PATH / "stage_configs.yaml"
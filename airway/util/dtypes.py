@@ -0,0 +1,72 @@
+"""Storage dtypes of the full volumes saved by the stages
+
+All values in the volumes (model encodings, BFS distances, color ids) are small non-negative integers, so instead of
+numpy's defaults (int64/float64, 8 bytes per voxel) each artifact is kept in the smallest of uint8, uint16 and int32
+which can hold it. Writers allocate or convert their volumes with the functions below, readers convert what they load
+with to_volume_dtype() so that volumes written by older versions end up with the same dtype. Values which do not fit
+into the dtype raise an OverflowError instead of wrapping around.
+"""
+from typing import Optional, Sequence
+
+import numpy as np
+
+# Candidates, smallest first
+COMPACT_DTYPES = (np.dtype(np.uint8), np.dtype(np.uint16), np.dtype(np.int32))
+
+# Artifacts with a fixed dtype, all others get the smallest dtype for their largest value
+FIXED_VOLUME_DTYPES = {
+    # Encodings of array_encoding.yaml
+    "model": np.dtype(np.uint8),
+    # BFS distance of each voxel to the start of the skeleton
+    "distance_mask": np.dtype(np.uint16),
+}
+
+
+def get_smallest_dtype(max_value: int, min_value: int = 0) -> np.dtype:
+    """Returns the smallest dtype of COMPACT_DTYPES which can hold all values between min_value and max_value"""
+    for dtype in COMPACT_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= min_value and max_value <= info.max:
+            return dtype
+    raise OverflowError(f"Values between {min_value} and {max_value} do not fit into any of {COMPACT_DTYPES}")
+
+
+def get_volume_dtype(artifact: str, max_value: Optional[int] = None, min_value: int = 0) -> np.dtype:
+    """Returns the storage dtype of the artifact, max_value is required for artifacts without a fixed dtype"""
+    if artifact not in FIXED_VOLUME_DTYPES:
+        if max_value is None:
+            raise ValueError(f"The dtype of {artifact} depends on its largest value, but none was given")
+        return get_smallest_dtype(max_value, min_value)
+    dtype = FIXED_VOLUME_DTYPES[artifact]
+    if max_value is not None:
+        info = np.iinfo(dtype)
+        if not info.min <= min_value or not max_value <= info.max:
+            raise OverflowError(f"Values between {min_value} and {max_value} do not fit into {artifact} ({dtype})")
+    return dtype
+
+
+def allocate_volume(artifact: str, shape: Sequence[int], max_value: Optional[int] = None) -> np.ndarray:
+    """Returns an empty volume of the artifact which can hold values up to max_value"""
+    return np.zeros(shape, dtype=get_volume_dtype(artifact, max_value))
+
+
+def to_volume_dtype(artifact: str, volume: np.ndarray) -> np.ndarray:
+    """Returns the volume converted to the storage dtype of the artifact (without copying if it already has it)
+
+    Raises an OverflowError if any value does not fit into the dtype, and a ValueError if a floating point volume
+    contains values which are not integers.
+    """
+    if volume.size == 0:
+        return volume.astype(get_volume_dtype(artifact, max_value=0), copy=False)
+    if volume.dtype == FIXED_VOLUME_DTYPES.get(artifact):
+        # Every value fits, so the (possibly memory mapped) values do not have to be read
+        return volume
+    min_value, max_value = volume.min(), volume.max()
+    if not np.isfinite(min_value) or not np.isfinite(max_value):
+        raise OverflowError(f"{artifact} contains values which are not finite")
+    dtype = get_volume_dtype(artifact, max_value=int(max_value), min_value=int(min_value))
+    if dtype == volume.dtype:
+        return volume
+    if np.issubdtype(volume.dtype, np.floating) and not np.array_equal(volume, np.trunc(volume)):
+        raise ValueError(f"{artifact} contains values which are not integers, it can not be stored as {dtype}")
+    return volume.astype(dtype)
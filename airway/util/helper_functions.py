@@ -1,8 +1,11 @@
 import math
-from typing import Set
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Set
 from typing import Tuple
 
 import numpy as np
+from scipy.spatial import cKDTree
+from skimage.morphology import skeletonize
 
 
 def _adjacent(coord, moore_neighborhood=False):
@@ -64,18 +67,24 @@ def get_coords_in_sphere_at_point(radius, point, hollow=False):
     return sphere_around_point
 
 
-def find_radius_via_sphere(at_point: Tuple[int, int, int], allowed_types: Set[int], model: np.ndarray):
+def find_radius_via_sphere(
+    at_point: Tuple[int, int, int], allowed_types: Set[int], model: np.ndarray, offset: Tuple[int, int, int] = (0, 0, 0)
+):
     """Returns the maximum radius of a sphere which fits into the model at the given point
 
     This only considers voxels in the model which have a value in allowed_types (e.g. 1)
     and views everything else as empty.
+
+    offset is the offset of the model in the volume the point refers to (e.g. of the bronchus region of interest in
+    the reduced model), it is subtracted after rounding the coordinates.
     """
+    ox, oy, oz = offset
     max_radius = 50
     for radius in range(1, max_radius):
         sphere_around_point = get_coords_in_sphere_at_point(radius + 0.5, at_point, hollow=True)
         for x, y, z in zip(*sphere_around_point):
             try:
-                if model[round(x), round(y), round(z)] not in allowed_types:
+                if model[round(x) - ox, round(y) - oy, round(z) - oz] not in allowed_types:
                     return radius
             except IndexError:
                 pass
@@ -95,3 +104,113 @@ def adjacent_euclidean(coord, dist=2):
         np.array([x, y, z]) for x in d for y in d for z in d if condition(np.sqrt(np.sum(np.power([x, y, z], 2))))
     ]
     return [coord + direction for direction in directions]
+
+
+class NearestNonzeroIndex:
+    """Nearest (euclidean) non-zero voxel of a mask for any number of points, built once per mask
+
+    Only the coordinates of the non-zero voxels are kept in a k-d tree, so building and querying it is independent
+    of the size of the volume.
+    """
+
+    def __init__(self, mask: np.ndarray):
+        assert np.any(mask), "Mask does not contain any non-zero voxels"
+        self.nonzero_coords = np.argwhere(mask)
+        self.kd_tree = cKDTree(self.nonzero_coords)
+
+    def snap(self, points: np.ndarray) -> np.ndarray:
+        """Returns the coordinates of the non-zero voxel nearest to each of the (rounded) points, shape (n, 3)"""
+        voxels = np.rint(np.reshape(points, (-1, self.nonzero_coords.shape[1])))
+        _, nearest = self.kd_tree.query(voxels)
+        return self.nonzero_coords[nearest]
+
+
+def _skeletonize_tile(tile: np.ndarray) -> np.ndarray:
+    return skeletonize(tile.astype(np.uint8), method="lee") != 0
+
+
+def skeletonize_volume(
+    mask: np.ndarray, tile_size: Optional[int] = None, halo: int = 16, workers: int = 1
+) -> np.ndarray:
+    """Returns the 3D skeleton of the mask as boolean volume, computed on the bounding box of the mask only
+
+    With a tile_size the bounding box is split into slabs of tile_size layers along the first axis, each of which is
+    skeletonized with halo extra layers on both sides (in a process pool if workers > 1), only its own layers are
+    kept. Thinning is not strictly local, so the stitched skeleton is checked for consistency: each tile has to agree
+    with its neighbours on the halo // 2 layers next to the seams between them. Otherwise the bounding box is
+    skeletonized as a whole.
+    """
+    skeleton = np.zeros(mask.shape, dtype=bool)
+    nonzero_coords = np.argwhere(mask)
+    if len(nonzero_coords) == 0:
+        return skeleton
+    # One layer of zeros around the mask, so that the result is the same as for the whole volume
+    lower = np.maximum(nonzero_coords.min(axis=0) - 1, 0)
+    upper = nonzero_coords.max(axis=0) + 2
+    bounding_box = tuple(slice(low, up) for low, up in zip(lower, upper))
+    cropped_mask = mask[bounding_box] != 0
+    num_layers = len(cropped_mask)
+
+    if tile_size is None or tile_size <= 0 or tile_size >= num_layers:
+        skeleton[bounding_box] = _skeletonize_tile(cropped_mask)
+        return skeleton
+
+    assert halo >= 2, "Tiles need a halo of at least 2 layers to check their seams"
+    tile_starts = range(0, num_layers, tile_size)
+    tiles = [cropped_mask[max(start - halo, 0) : start + tile_size + halo] for start in tile_starts]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            tile_skeletons = list(executor.map(_skeletonize_tile, tiles))
+    else:
+        tile_skeletons = list(map(_skeletonize_tile, tiles))
+    cropped_skeleton = np.concatenate(
+        [
+            tile_skeleton[start - max(start - halo, 0) :][:tile_size]
+            for start, tile_skeleton in zip(tile_starts, tile_skeletons)
+        ]
+    )
+
+    seam_width = halo // 2
+    for start, tile_skeleton in zip(tile_starts, tile_skeletons):
+        first_layer = max(start - halo, 0)
+        lower, upper = max(start - seam_width, 0), min(start + tile_size + seam_width, num_layers)
+        if not np.array_equal(tile_skeleton[lower - first_layer : upper - first_layer], cropped_skeleton[lower:upper]):
+            print("WARNING: Tiles of the skeleton do not agree at their seams, skeletonizing the whole volume instead")
+            cropped_skeleton = _skeletonize_tile(cropped_mask)
+            break
+    skeleton[bounding_box] = cropped_skeleton
+    return skeleton
+
+
+def get_outer_shell(mask: np.ndarray) -> np.ndarray:
+    """Returns the voxels of the mask which have at least one of their 6 neighbours outside of it as boolean volume
+
+    Voxels outside of the volume are not in the mask, so voxels of the mask at the border of the volume are always in
+    the shell. Equivalent to mask & ~binary_erosion(mask) with a 6-connectivity structure, but computed with shifted
+    slices of a single boolean buffer instead of copies of the volume.
+    """
+    mask = mask.astype(bool, copy=False)
+    interior = mask.copy()
+    for axis in range(mask.ndim):
+        lower = (slice(None),) * axis + (slice(None, -1),)
+        upper = (slice(None),) * axis + (slice(1, None),)
+        interior[lower] &= mask[upper]
+        interior[upper] &= mask[lower]
+        interior[(slice(None),) * axis + (0,)] = False
+        interior[(slice(None),) * axis + (-1,)] = False
+    # Shell voxels are in the mask but not in its interior
+    return np.greater(mask, interior, out=interior)
+
+
+def get_labelled_coords(volume: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Returns the coordinates of the voxels of the mask and their value in the volume, shape (4, n) as uint16
+
+    The rows are the coordinates along the three axes and the value (label) of each voxel.
+    """
+    if max(volume.shape) > np.iinfo(np.uint16).max + 1:
+        raise OverflowError(f"Coordinates of a volume with shape {volume.shape} do not fit into uint16")
+    coords = np.nonzero(mask)
+    labelled_coords = np.empty((volume.ndim + 1, len(coords[0])), dtype=np.uint16)
+    labelled_coords[: volume.ndim] = coords
+    labelled_coords[volume.ndim] = volume[coords]
+    return labelled_coords
@@ -0,0 +1,66 @@
+"""Boolean masks packed into bits along their last axis (np.packbits), 8 times smaller than a boolean volume
+
+The operations (and, or, not and counting the voxels) work on the packed bytes directly, the padding bits at the end
+of each row are always 0. unpack() returns the whole mask or only a region of it as boolean volume, so the packed
+bytes can be memory mapped and only the rows of the region are read.
+"""
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+# Number of set bits of each byte
+POPCOUNT_TABLE = np.array([bin(value).count("1") for value in range(256)], dtype=np.int64)
+
+
+class PackedMask:
+    """Boolean mask with the given shape, packed into bytes along its last axis"""
+
+    def __init__(self, packed: np.ndarray, shape: Sequence[int]):
+        self.packed = packed
+        self.shape = tuple(int(size) for size in shape)
+        assert packed.dtype == np.uint8, f"Packed mask has dtype {packed.dtype}, expected uint8"
+        packed_shape = self.shape[:-1] + (-(-self.shape[-1] // 8),)
+        assert packed.shape == packed_shape, f"Packed mask with shape {packed.shape} does not belong to {self.shape}"
+
+    @classmethod
+    def pack(cls, mask: np.ndarray) -> "PackedMask":
+        return cls(np.packbits(mask != 0, axis=-1), mask.shape)
+
+    @property
+    def nbytes(self) -> int:
+        return self.packed.nbytes
+
+    def unpack(self, region: Optional[Tuple[slice, ...]] = None) -> np.ndarray:
+        """Returns the mask as boolean volume, only the region (slices without step) of it if given"""
+        if region is None:
+            return np.unpackbits(self.packed, axis=-1, count=self.shape[-1]).view(bool)
+        region = tuple(region) + (slice(None),) * (len(self.shape) - len(region))
+        start, stop, step = region[-1].indices(self.shape[-1])
+        assert step == 1, "Regions of packed masks can not have a step"
+        stop = max(start, stop)
+        # Only the bytes of the region along the last axis are unpacked
+        packed = self.packed[region[:-1] + (slice(start // 8, -(-stop // 8)),)]
+        return np.unpackbits(packed, axis=-1)[..., start % 8 : start % 8 + stop - start].view(bool)
+
+    def count(self) -> int:
+        """Returns the number of voxels in the mask, counted with a table of the set bits of each byte value"""
+        return int(np.bincount(self.packed.reshape(-1), minlength=256) @ POPCOUNT_TABLE)
+
+    def _check_shape(self, other: "PackedMask"):
+        assert self.shape == other.shape, f"Packed masks have different shapes {self.shape} and {other.shape}"
+
+    def __and__(self, other: "PackedMask") -> "PackedMask":
+        self._check_shape(other)
+        return PackedMask(np.bitwise_and(self.packed, other.packed), self.shape)
+
+    def __or__(self, other: "PackedMask") -> "PackedMask":
+        self._check_shape(other)
+        return PackedMask(np.bitwise_or(self.packed, other.packed), self.shape)
+
+    def __invert__(self) -> "PackedMask":
+        packed = np.invert(self.packed)
+        # The padding bits of the last byte of each row have to stay 0
+        padding = -self.shape[-1] % 8
+        if padding:
+            packed[..., -1] &= np.uint8((0xFF << padding) & 0xFF)
+        return PackedMask(packed, self.shape)
@@ -0,0 +1,80 @@
+"""Skeleton of the bronchus, computed once by stage-03 and reused by later stages
+
+3D skeletonization is one of the most expensive steps of the pipeline, so stage-03 saves the skeleton as the flat
+indices (uint32) of its voxels in skeleton.npz. Along with them it saves the shape, a hash of the skeletonized mask
+and the parameters used, load_skeleton() only returns the skeleton if all of them match, so a skeleton of an older
+model or computed differently is never reused silently.
+"""
+import hashlib
+import json
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import skimage
+
+from airway.util.helper_functions import skeletonize_volume
+
+SKELETON_FILE_NAME = "skeleton.npz"
+
+# Everything the skeleton depends on besides the model, change the version whenever compute_skeleton() changes
+SKELETON_PARAMETERS = {"version": 1, "labels": [1], "method": "lee", "skimage": skimage.__version__}
+
+
+def get_skeleton_mask(model: np.ndarray) -> np.ndarray:
+    """Returns the mask which is skeletonized, i.e. the bronchus without lobes, veins and arteries"""
+    return model == 1
+
+
+def get_mask_hash(mask: np.ndarray) -> str:
+    return hashlib.sha1(np.packbits(mask).tobytes() + str(mask.shape).encode()).hexdigest()
+
+
+def compute_skeleton(model: np.ndarray, tile_size: Optional[int] = None, workers: int = 1) -> np.ndarray:
+    """Returns the skeleton of the bronchus of the model as boolean volume, see skeletonize_volume() for tiling"""
+    return skeletonize_volume(get_skeleton_mask(model), tile_size=tile_size, workers=workers)
+
+
+def save_skeleton(path: Path, skeleton: np.ndarray, model: np.ndarray, tile_size: Optional[int] = None):
+    """Saves the skeleton computed by compute_skeleton() for the model in the directory path
+
+    The tile size is saved along with the parameters, but tiled skeletons are reused like whole ones since they are
+    checked while stitching.
+    """
+    if skeleton.size > np.iinfo(np.uint32).max:
+        raise OverflowError(f"Flat indices of a volume with shape {skeleton.shape} do not fit into uint32")
+    np.savez_compressed(
+        Path(path) / SKELETON_FILE_NAME,
+        indices=np.flatnonzero(skeleton).astype(np.uint32),
+        shape=np.array(skeleton.shape),
+        mask_hash=get_mask_hash(get_skeleton_mask(model)),
+        parameters=json.dumps({**SKELETON_PARAMETERS, "tile_size": tile_size}, sort_keys=True),
+    )
+
+
+def load_skeleton(path: Path, model: np.ndarray) -> Optional[np.ndarray]:
+    """Returns the skeleton saved in the directory path, or None if there is none for this model and parameters"""
+    try:
+        skeleton_npz = np.load(Path(path) / SKELETON_FILE_NAME)
+    except FileNotFoundError:
+        return None
+    with skeleton_npz:
+        parameters = json.loads(str(skeleton_npz["parameters"]))
+        if (
+            tuple(skeleton_npz["shape"]) != model.shape
+            or any(parameters.get(key) != value for key, value in SKELETON_PARAMETERS.items())
+            or str(skeleton_npz["mask_hash"]) != get_mask_hash(get_skeleton_mask(model))
+        ):
+            return None
+        skeleton = np.zeros(model.shape, dtype=bool)
+        skeleton.reshape(-1)[skeleton_npz["indices"]] = True
+    return skeleton
+
+
+def get_skeleton(path: Path, model: np.ndarray) -> np.ndarray:
+    """Returns the skeleton saved in the directory path, computing it again if it does not belong to the model"""
+    skeleton = load_skeleton(path, model)
+    if skeleton is None:
+        print(f"WARNING: No skeleton of this model in {path}, running skeletonize on model")
+        skeleton = compute_skeleton(model)
+    return skeleton
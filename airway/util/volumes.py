@@ -0,0 +1,256 @@
+"""Saving and loading the full volumes of the stages (e.g. reduced_model) in one of the volume formats
+
+npz: compressed with np.savez_compressed as arr_0, small on disk, but every reader has to decompress the whole volume.
+npy: uncompressed .npy file, readers memory map it, so only the pages which are actually accessed are read and no
+     time is spent decompressing. Volumes read by many stages (like reduced_model) should be saved in this format.
+
+The mapping is copy-on-write, readers may change the loaded volume without changing the file.
+
+Metadata of a volume (e.g. its crop offset) is saved next to it as name.json, regardless of the format. Along with
+it the stages save the statistics of their volumes (see get_volume_statistics()), so that later stages can look up
+which labels a volume contains, how often and where, instead of scanning the whole volume again.
+
+Stage-02 also saves the bronchus region of interest, a tight box around the bronchus (label 1) of the reduced model
+with only the bronchus in it, the tree extraction stages work in this smaller box (see load_bronchus_roi()).
+
+Optionally the mask of each label is saved bit-packed as name_mask_label (see save_label_masks()), stages which only
+need the mask of one label load it with load_label_mask() instead of the whole volume.
+"""
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy import ndimage
+
+from airway.util.dtypes import get_volume_dtype, to_volume_dtype
+from airway.util.packed_masks import PackedMask
+
+VOLUME_FORMATS = ("npz", "npy")
+
+BRONCHUS_ROI_NAME = "bronchus_model"
+
+
+def get_volume_path(path: Path, name: str) -> Path:
+    """Returns the path of the volume with the given name in the directory path, in whichever format it was saved"""
+    npy_path = Path(path) / f"{name}.npy"
+    return npy_path if npy_path.exists() else Path(path) / f"{name}.npz"
+
+
+def save_volume(path: Path, name: str, volume: np.ndarray, volume_format: str = "npz"):
+    """Saves the volume as name in the directory path, removing the volume if it was saved in another format"""
+    assert volume_format in VOLUME_FORMATS, f"Unknown volume format {volume_format}, expected one of {VOLUME_FORMATS}"
+    if volume_format == "npy":
+        np.save(Path(path) / f"{name}.npy", volume)
+    else:
+        np.savez_compressed(Path(path) / f"{name}.npz", volume)
+    for other_format in set(VOLUME_FORMATS) - {volume_format}:
+        other_path = Path(path) / f"{name}.{other_format}"
+        if other_path.exists():
+            other_path.unlink()
+
+
+def load_volume(path: Path, name: str, artifact: Optional[str] = None) -> np.ndarray:
+    """Loads the volume saved as name in the directory path, memory mapped if saved as .npy
+
+    With artifact the volume is converted to the storage dtype of the artifact, see to_volume_dtype()
+    """
+    volume_path = get_volume_path(path, name)
+    if volume_path.suffix == ".npy":
+        try:
+            volume = np.load(volume_path, mmap_mode="c")
+        except ValueError:
+            # Empty arrays cannot be memory mapped
+            volume = np.load(volume_path)
+    else:
+        with np.load(volume_path) as npz:
+            volume = npz["arr_0"]
+    if artifact is not None:
+        volume = to_volume_dtype(artifact, volume)
+    return volume
+
+
+def save_volume_metadata(path: Path, name: str, **metadata):
+    """Saves the metadata of the volume saved as name in the directory path, keeping other saved metadata"""
+    all_metadata = {**load_volume_metadata(path, name), **metadata}
+    with (Path(path) / f"{name}.json").open("w") as file:
+        json.dump(all_metadata, file, indent=2)
+
+
+def load_volume_metadata(path: Path, name: str) -> Dict[str, Any]:
+    """Returns the metadata of the volume saved as name in the directory path, which is empty if none was saved"""
+    try:
+        with (Path(path) / f"{name}.json").open("r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def get_bounding_box(volume: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the lower (inclusive) and upper (exclusive) corner of the non-zero voxels plus one layer of zeros
+
+    The first and second axis are found with a single np.any projection over the whole volume, the third with a
+    projection over the box spanned by the first two only.
+    """
+    assert np.any(volume), "Volume does not contain any non-zero voxels"
+    lower, upper = [], []
+
+    def add_axis(projection):
+        non_zero = np.flatnonzero(projection)
+        lower.append(max(non_zero[0] - 1, 0))
+        upper.append(min(non_zero[-1] + 2, len(projection)))
+
+    projection = np.any(volume, axis=2)
+    add_axis(np.any(projection, axis=1))
+    add_axis(np.any(projection, axis=0))
+    add_axis(np.any(volume[lower[0] : upper[0], lower[1] : upper[1]], axis=(0, 1)))
+    return np.array(lower), np.array(upper)
+
+
+def load_bronchus_roi(path: Path) -> Tuple[np.ndarray, np.ndarray, Tuple[int, ...]]:
+    """Returns the bronchus region of interest saved by stage-02 in the directory path, its offset inside the
+    reduced model and the shape of the reduced model
+
+    Coordinates in the region of interest plus the offset are coordinates in the reduced model. If stage-02 did not
+    save it, the region of interest is cropped from the reduced model.
+    """
+    if get_volume_path(path, BRONCHUS_ROI_NAME).exists():
+        metadata = load_volume_metadata(path, BRONCHUS_ROI_NAME)
+        roi = load_volume(path, BRONCHUS_ROI_NAME, "model")
+        return roi, np.array(metadata["offset"]), tuple(metadata["original_shape"])
+    bronchus_box = load_bounding_box(path, "reduced_model", 1, margin=1)
+    if bronchus_box is None:
+        bronchus = load_label_mask(path, "reduced_model", 1)
+        lower, upper = get_bounding_box(bronchus)
+        reduced_shape = bronchus.shape
+        roi = bronchus[tuple(slice(low, up) for low, up in zip(lower, upper))]
+    else:
+        lower, upper = bronchus_box
+        reduced_shape = tuple(load_volume_metadata(path, "reduced_model")["shape"])
+        roi = load_label_mask(path, "reduced_model", 1, tuple(slice(low, up) for low, up in zip(lower, upper)))
+    return roi.astype(get_volume_dtype("model")), lower, reduced_shape
+
+
+def make_volume_statistics(
+    shape: Sequence[int],
+    dtype: np.dtype,
+    histogram: np.ndarray,
+    bounding_boxes: Dict[int, Tuple[Sequence[int], Sequence[int]]],
+) -> Dict[str, Any]:
+    """Returns the statistics of a volume in the format saved as its metadata, see get_volume_statistics()"""
+    return {
+        "shape": [int(size) for size in shape],
+        "dtype": np.dtype(dtype).name,
+        "label_counts": {str(label): int(histogram[label]) for label in np.flatnonzero(histogram)},
+        "bounding_boxes": {
+            str(label): [[int(low) for low in lower], [int(up) for up in upper]]
+            for label, (lower, upper) in sorted(bounding_boxes.items())
+        },
+    }
+
+
+def get_volume_statistics(volume: np.ndarray) -> Dict[str, Any]:
+    """Returns the shape, dtype, the number of voxels of each label and the bounding box of each non-zero label
+
+    Bounding boxes are the lower (inclusive) and upper (exclusive) corner of the voxels with that label. Labels
+    (and the keys of label_counts and bounding_boxes) are strings, since they are saved as JSON.
+    """
+    if volume.dtype == bool:
+        volume = volume.view(np.uint8)
+    bounding_boxes = {
+        label: ([box.start for box in boxes], [box.stop for box in boxes])
+        for label, boxes in enumerate(ndimage.find_objects(volume), start=1)
+        if boxes is not None
+    }
+    return make_volume_statistics(volume.shape, volume.dtype, np.bincount(volume.reshape(-1)), bounding_boxes)
+
+
+def save_volume_statistics(path: Path, name: str, volume: np.ndarray, **metadata) -> Dict[str, Any]:
+    """Saves the statistics of the volume (and the given metadata) as metadata of the volume and returns them"""
+    statistics = get_volume_statistics(volume)
+    save_volume_metadata(path, name, **statistics, **metadata)
+    return statistics
+
+
+def load_label_counts(path: Path, name: str, volume: Optional[np.ndarray] = None) -> Dict[int, int]:
+    """Returns the number of voxels of each label of the volume saved as name from its statistics
+
+    If no statistics were saved the labels of the given volume are counted, without a volume the result is empty.
+    """
+    label_counts = load_volume_metadata(path, name).get("label_counts")
+    if label_counts is not None:
+        return {int(label): count for label, count in label_counts.items()}
+    if volume is None:
+        return {}
+    histogram = np.bincount(volume.reshape(-1))
+    return {int(label): int(histogram[label]) for label in np.flatnonzero(histogram)}
+
+
+def load_bounding_box(
+    path: Path, name: str, label: Optional[int] = None, margin: int = 0
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """Returns the bounding box of the label (all non-zero labels if None) in the volume saved as name from its
+    statistics, None if there are no statistics or the label does not occur
+
+    The box is grown by margin layers on each side (within the volume), with margin=1 it is the box which
+    get_bounding_box() returns.
+    """
+    statistics = load_volume_metadata(path, name)
+    bounding_boxes = statistics.get("bounding_boxes")
+    if bounding_boxes is None:
+        return None
+    boxes = list(bounding_boxes.values()) if label is None else [bounding_boxes.get(str(label))]
+    boxes = np.array([box for box in boxes if box is not None])
+    if len(boxes) == 0:
+        return None
+    lower, upper = boxes[:, 0].min(axis=0), boxes[:, 1].max(axis=0)
+    return np.maximum(lower - margin, 0), np.minimum(upper + margin, statistics["shape"])
+
+
+def get_mask_name(name: str, label: int) -> str:
+    return f"{name}_mask_{label}"
+
+
+def save_label_masks(
+    path: Path, name: str, volume: np.ndarray, labels: Optional[Iterable[int]] = None, volume_format: str = "npz"
+) -> List[int]:
+    """Saves the bit-packed mask of each label (all non-zero labels of the volume if None) of the volume saved as name,
+    each as a volume of its own, and returns the labels
+
+    The labels are saved in the metadata of the volume, its statistics (at least its shape) have to be saved too.
+    """
+    if labels is None:
+        labels = [label for label in load_label_counts(path, name, volume) if label != 0]
+    labels = sorted(int(label) for label in labels)
+    for label in labels:
+        save_volume(path, get_mask_name(name, label), PackedMask.pack(volume == label).packed, volume_format)
+    save_volume_metadata(path, name, packed_masks=labels)
+    return labels
+
+
+def load_packed_mask(path: Path, name: str, label: int) -> Optional[PackedMask]:
+    """Returns the packed mask of the label of the volume saved as name, None if it was not saved"""
+    metadata = load_volume_metadata(path, name)
+    if label not in metadata.get("packed_masks", []):
+        return None
+    return PackedMask(load_volume(path, get_mask_name(name, label)), metadata["shape"])
+
+
+def load_label_mask(
+    path: Path,
+    name: str,
+    label: int,
+    region: Optional[Tuple[slice, ...]] = None,
+    volume: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Returns the mask of the label (only the region of it if given) of the volume saved as name as boolean volume
+
+    The mask is unpacked from the packed mask if it was saved, otherwise it is compared in the volume (which is loaded
+    if None).
+    """
+    packed_mask = load_packed_mask(path, name, label)
+    if packed_mask is not None:
+        return packed_mask.unpack(region)
+    if volume is None:
+        volume = load_volume(path, name)
+    return (volume if region is None else volume[region]) == label
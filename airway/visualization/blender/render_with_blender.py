@@ -50,9 +50,29 @@ def hide(obj, viewport=False, selection=False, render=False):
     obj.hide_select = selection
 
 
+def load_glb(path, name):
+    """Loads .glb file (binary glTF) and returns the object, which is renamed to name"""
+    bpy.ops.object.select_all(action="DESELECT")
+    try:
+        # Vertices on the border of two materials are split by the importer otherwise
+        bpy.ops.import_scene.gltf(filepath=str(path), merge_vertices=True)
+    except TypeError:
+        bpy.ops.import_scene.gltf(filepath=str(path))
+    obj = bpy.context.selected_objects[0]
+    obj.name = name
+    return obj
+
+
 def load_obj(path):
-    """Loads .obj file and returns the object"""
+    """Loads .obj file and returns the object
+
+    If a .glb file with the same name exists next to it, that is loaded instead, as it loads a lot faster (only
+    possible from Blender 2.80 on, which ships with the glTF importer)
+    """
     name = Path(path).name.replace(".obj", "")
+    glb_path = Path(path).with_suffix(".glb")
+    if not is_blender279 and glb_path.exists():
+        return load_glb(glb_path, name)
     try:
         bpy.ops.import_scene.obj(filepath=path)
     except FileNotFoundError:
@@ -97,8 +117,7 @@ for object_name in ["Cube", "Lamp", "Light"]:
         bpy.data.objects.remove(current_object)
 
 # Import bronchus
-bpy.ops.import_scene.obj(filepath=bronchus_path)
-bronchus = bpy.data.objects["bronchus"]
+bronchus = load_obj(bronchus_path)
 make_obj_smooth(bronchus)  # Smooth before hiding select, as otherwise it doesn't work?
 hide(bronchus, selection=True)
 
@@ -211,7 +230,8 @@ def normalize(vertices, center=True):
 
     vertices = np.array(vertices)
     if np_model is None:
-        np_model = np.load(model_path)["arr_0"]
+        # Saved as .npy or .npz (see volumes.py), only the shape is needed
+        np_model = np.load(model_path, mmap_mode="r") if model_path.endswith(".npy") else np.load(model_path)["arr_0"]
     reference_shape = np.array(np_model.shape)
     rot_mat = np.array([[0, 0, -1], [0, -1, 0], [-1, 0, 0]])
     # Shift to middle of the space
@@ -4,6 +4,7 @@ from pathlib import Path
 
 from airway.util.config_parsers import parse_defaults
 from airway.util.util import get_data_paths_from_args
+from airway.util.volumes import get_volume_path
 
 print("\n".join(sys.argv))
 (
@@ -53,7 +54,7 @@ command.extend(
         bronchus_input_data_path / "skeleton.obj",
         splits_input_data_path / "splits.obj",
         tree_input_data_path / "tree.graphml",
-        model_input_data_path / "reduced_model.npz",
+        get_volume_path(model_input_data_path, "reduced_model"),
     ]
 )
 print(command)
@@ -13,8 +13,6 @@ prerequisites:
 import sys
 import os
 import shutil
-import platform
-import subprocess
 from pathlib import Path
 from hashlib import sha256
 
@@ -237,39 +235,13 @@ def create_object_archive(object_download_name, obj_path):
 
 def simplify_object_files():
     """
-    Using the external tool obj-simplify to erase redundancies from obj-model files.
-    It is a precompiled binary for Linux, therefore it only works on Linux based systems.
+    Copies the obj-model files to the website.
 
-    With the use of obj-simplify the obj-files will be 20+% less in space consumption.
+    These used to be simplified with the external x86 Linux binary obj-simplify to erase redundancies. The obj-files
+    of gen_obj.py contain no duplicate vertices anyway, for fewer faces create them with the greedy surface there.
     """
 
-    objs_path = str(base_path) + "/website/bin/obj-simplify"
-
-    if platform.machine() == "x86_64" and platform.system() == "Linux":
-        obj_files = list(obj_path.glob("*on*.obj"))
-        for obj in obj_files:
-            arguments = [
-                str(objs_path),
-                "-no-duplicates",
-                "-in",
-                str(obj),
-                "-out",
-                str(target_path) + "/" + str(obj.name),
-                "-quiet",
-                "-no-progress",
-                "-workers",
-                "4",
-            ]
-            try:
-                ret_val = subprocess.run(arguments, check=True, capture_output=True, encoding="utf-8")
-                print(ret_val.stdout)
-                sys.stderr.write(ret_val.stderr)
-            except subprocess.CalledProcessError:
-                print("\nobj-simplify could not be executed, copying files instead\n")
-                copy_files(obj_path, target_path, glob="*on*.obj")
-    else:
-        print("\nNon Linux or not a 64 bit machine, just copying obj files\n")
-        copy_files(obj_path, target_path, glob="*on*.obj")
+    copy_files(obj_path, target_path, glob="*on*.obj")
 
 
 def copy_js(dst_dir, js_dir=base_path + "/website/js/"):
@@ -2,10 +2,10 @@ import sys
 
 import numpy as np
 import matplotlib.pyplot as plt
-import networkx as nx
 
 # plt.rcParams.update({'font.size': 6})
 
+from airway.util.cohort_store import load_cohort_store
 from airway.util.util import get_data_paths_from_args
 
 # |>--><-><-><-><-><->-<|
@@ -33,19 +33,20 @@ ax1 = fig.add_subplot(111)
 root_children_count = {}
 weights = []
 names = []
-for index, patient in enumerate(sorted(input_data_path.glob("*"))):
-    graphml_path = input_data_path / patient / "tree.graphml"
-    if graphml_path.exists():
-        graph = nx.read_graphml(graphml_path)
+store = load_cohort_store(input_data_path)
+for index, patient in enumerate(store.patients):
+    if store.has_graph(patient, "tree"):
+        _, edge_rows = store.get_rows(patient, "tree")
+        sources = store.edges["source"][edge_rows]
+        targets = store.edges["target"][edge_rows]
         # assert len(graph["0"]) <= 1, "ERROR: More than 1 edge from root node"
-        l = len(graph["0"])
+        root_edges = (sources == 0) | (targets == 0)
+        l = int(np.count_nonzero(root_edges))
         if l not in root_children_count:
             root_children_count[l] = 0
         root_children_count[l] += 1
 
-        # print(patient, end=', ')
-        # print(list(graph["0"]), end=', ')
-        weights.append(max([graph["0"][adj]["weight"] for adj in graph["0"]]) / 2)
+        weights.append(np.max(store.edges["weight"][edge_rows][root_edges]) / 2)
         names.append(f"{index + 1}. {patient}")
 
 ind = np.arange(len(weights))
@@ -7,7 +7,8 @@ from airway.util.util import get_data_paths_from_args
 
 output_data_path, input_data_path, stage4 = get_data_paths_from_args(inputs=2)
 
-arr = np.load(input_data_path / "bronchus_coords_outer_shell.npz")["arr_0"]
+# Saved as uint16, which can not be negated
+arr = np.load(input_data_path / "bronchus_coords_outer_shell.npz")["arr_0"].astype(int)
 
 fig = plt.figure()
 ax = fig.add_subplot(111, projection="3d")
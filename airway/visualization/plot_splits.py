@@ -64,7 +64,8 @@ nodes_per_axis = []
 # |>- Potentially draw bronchus -<|
 # |>-><-><-><-><-><-><-><-><-><--<|
 
-arr = np.load(bronchus_shell_data_path / "bronchus_coords_outer_shell.npz")["arr_0"]
+# Saved as uint16, which can not be negated
+arr = np.load(bronchus_shell_data_path / "bronchus_coords_outer_shell.npz")["arr_0"].astype(int)
 
 xs = arr[1]
 ys = arr[2]
@@ -46,3 +46,103 @@ def test_no_left_lung_segments_in_right_lung_and_vice_versa(classification_confi
         for child in config.get("children", []):
             if classification[0] in "RL" and child[0] in "RL":
                 assert classification[0] == child[0], f"Child {child} in {classification[0]} lung!"
+
+
+@pytest.fixture
+def classification_rules(classification_config):
+    from airway.util.classification_rules import ClassificationRules, compile_classification_rules
+
+    return ClassificationRules(compile_classification_rules(classification_config))
+
+
+def test_compiled_rules_match_config(classification_config, classification_rules):
+    compiled_config = classification_rules.to_classification_config()
+    assert list(compiled_config) == list(classification_config)
+    for classification, config in classification_config.items():
+        compiled = compiled_config[classification]
+        assert compiled["children"] == config.get("children", [])
+        assert set(compiled["descendants"]) == set(config.get("descendants", []))
+        assert compiled["take_best"] == config.get("take_best", False)
+        assert compiled["descendant_bits"] == classification_rules.get_bits(config.get("descendants", []))
+        if "vector" in config:
+            assert list(compiled["vector"]) == config["vector"]
+
+
+def test_compiled_deep_descendants_are_subtree_bits(classification_rules):
+    compiled_config = classification_rules.to_classification_config()
+    for classification, compiled in compiled_config.items():
+        assert compiled["subtree_bits"] & compiled["label_bit"]
+        assert compiled["subtree_bits"] & compiled["descendant_bits"] == compiled["descendant_bits"]
+
+
+def test_subtree_hashes_ignore_child_order_and_end_at_clustering_end_nodes(classification_config):
+    import networkx as nx
+
+    from airway.classification.split_classification import add_subtree_hashes_in_tree
+
+    def get_hashes(classifications):
+        tree = nx.Graph()
+        for node_id, classification in enumerate(classifications):
+            tree.add_node(str(node_id), split_classification=classification)
+        successors = {"0": ["1", "2"], "1": ["3"]}
+        add_subtree_hashes_in_tree(tree, successors, classification_config)
+        return [tree.nodes[node_id].get("subtree_hash") for node_id in tree.nodes]
+
+    hashes = get_hashes(["LUpperLobe", "LB1+2", "LB3", "LB1"])
+    swapped_hashes = get_hashes(["LUpperLobe", "LB3", "LB1+2", "LB1"])
+    assert hashes[0] == swapped_hashes[0]
+    assert classification_config["LB1+2"].get("clustering_endnode", False)
+    assert hashes[0] == get_hashes(["LUpperLobe", "LB1+2", "LB3", "c3"])[0]
+    assert hashes[0] != get_hashes(["LUpperLobe", "LB1+2", "LB4", "LB1"])[0]
+
+
+def test_patients_with_same_structure_are_found_by_subtree_hash(classification_config):
+    import tempfile
+
+    import networkx as nx
+
+    from airway.classification.clustering import find_patients_with_same_structure
+    from airway.classification.split_classification import add_subtree_hashes_in_tree
+    from airway.util.cohort_store import load_cohort_store
+
+    stage_path = Path(tempfile.mkdtemp(prefix="airway-tests-clustering-")) / "stage-10"
+    trees = {
+        "a": ["LUpperLobe", "LB1+2+3", "LB1+2", "LB3", "LB1"],
+        "b": ["LUpperLobe", "LB1+2+3", "LB3", "LB1+2", "LB2"],
+        "c": ["LUpperLobe", "LB1+2+3", "LB1", "LB2", "LB3"],
+    }
+    for patient, classifications in trees.items():
+        tree = nx.Graph()
+        for node_id, classification in enumerate(classifications):
+            tree.add_node(str(node_id), level=node_id, split_classification=classification)
+        successors = {"0": ["1"], "1": ["2", "3"], "2": ["4"]}
+        tree.add_edges_from((parent, child) for parent, children in successors.items() for child in children)
+        add_subtree_hashes_in_tree(tree, successors, classification_config)
+        (stage_path / patient).mkdir(parents=True)
+        nx.write_graphml(tree, stage_path / patient / "tree.graphml")
+
+    store = load_cohort_store(stage_path)
+    # LB1+2 is a clustering end node, so its children do not change the structure
+    assert find_patients_with_same_structure(store, "a", "LB1+2+3") == ["a", "b"]
+    assert find_patients_with_same_structure(store, "c", "LB1+2+3") == ["c"]
+    assert find_patients_with_same_structure(store, "c", "LUpperLobe") == ["c"]
+    assert find_patients_with_same_structure(store, "a", "Lingula") == []
+
+
+def test_referenced_but_undefined_descendants_can_be_satisfied(classification_config):
+    import networkx as nx
+
+    from airway.classification.split_classification import is_valid_tree
+    from airway.util.classification_rules import ClassificationRules, compile_classification_rules
+
+    assert "LB3a" in classification_config["LB3"]["children"] and "LB3a" not in classification_config
+    classification_config = {**classification_config, "LB3": {**classification_config["LB3"], "descendants": ["LB3a"]}}
+    rules = ClassificationRules(compile_classification_rules(classification_config))
+    compiled_config = rules.to_classification_config()
+
+    tree = nx.Graph()
+    tree.add_node("0", split_classification="LB3")
+    tree.add_node("1", split_classification="LB3a")
+    assert is_valid_tree(tree, compiled_config, {"0": ["1"]}, rules=rules)
+    tree.nodes["1"]["split_classification"] = "LB3b"
+    assert not is_valid_tree(tree, compiled_config, {"0": ["1"]}, rules=rules)
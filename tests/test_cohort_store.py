@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import networkx as nx
+
+from airway.util.cohort_aggregation import add_contribution, aggregate_cohort
+from airway.util.cohort_store import get_cohort_store_path, load_cohort_store
+
+
+def write_tree(stage_path: Path, patient: str, node_count: int):
+    tree = nx.Graph(patient=patient)
+    for index in range(node_count):
+        tree.add_node(str(index), x=float(index), y=0.0, z=0.0, level=index, split_classification=f"{patient}{index}")
+        if index:
+            tree.add_edge(str(index - 1), str(index), weight=1.0)
+    (stage_path / patient).mkdir(parents=True, exist_ok=True)
+    path = stage_path / patient / "tree.graphml"
+    nx.write_graphml(tree, path)
+    # Newer than the shard of the previous tree, even if the file system has a coarse timestamp resolution
+    shard_path = get_cohort_store_path(stage_path) / "shards" / f"{patient}.npz"
+    if shard_path.exists():
+        os.utime(path, (shard_path.stat().st_mtime + 1,) * 2)
+
+
+def test_graphs_are_restored_from_cohort_store():
+    stage_path = Path(tempfile.mkdtemp(prefix="airway-tests-cohort-store-")) / "stage-10"
+    trees = {}
+    for patient, classification in [("a", "LUpperLobe"), ("b", "RUpperLobe")]:
+        tree = nx.Graph(patient=patient)
+        tree.add_node("0", x=1.0, y=2.0, z=3.0, lobe=0, level=1, split_classification="Trachea")
+        tree.add_node("1", x=2.0, y=2.0, z=5.0, lobe=3, level=2, split_classification=classification, cost=0.5)
+        tree.add_edge("0", "1", weight=2.5)
+        (stage_path / patient).mkdir(parents=True)
+        nx.write_graphml(tree, stage_path / patient / "tree.graphml")
+        trees[patient] = tree
+
+    store = load_cohort_store(stage_path)
+    assert store.patients == ["a", "b"]
+    for patient, tree in trees.items():
+        restored = store.get_graph(patient)
+        assert restored.graph["patient"] == patient
+        assert dict(restored.nodes(data=True)) == dict(tree.nodes(data=True))
+        assert dict(restored.edges) == dict(tree.edges)
+    assert store.nodes["parent"].tolist() == [-1, 0, -1, 0]
+    assert store.nodes["patient"][store.select_nodes(split_classification="LUpperLobe")].tolist() == ["a"]
+
+
+def test_attributes_without_column_are_restored_from_cohort_store():
+    stage_path = Path(tempfile.mkdtemp(prefix="airway-tests-cohort-store-")) / "stage-05"
+    tree = nx.Graph(patient="a")
+    tree.add_node("0", x=1.0, y=2.0, z=3.0, lobe=-1, level=0, group_sizes="[1, 2]")
+    tree.add_node("1", x=1.0, y=2.0, z=5.0, lobe=3, level=1, group="left", group_sizes="[3]")
+    tree.add_edge("0", "1", weight=2.5, length=1.5)
+    (stage_path / "a").mkdir(parents=True)
+    nx.write_graphml(tree, stage_path / "a" / "tree.graphml")
+
+    store = load_cohort_store(stage_path)
+    restored = store.get_graph("a")
+    assert dict(restored.nodes(data=True)) == dict(tree.nodes(data=True))
+    assert restored.edges["0", "1"] == tree.edges["0", "1"]
+    # Values which do not fit their column look like missing values in it
+    assert store.nodes["lobe"].tolist() == [-1, 3]
+    assert store.nodes["group"].tolist() == [-1, -1]
+
+
+def test_changed_patients_are_appended_to_cohort_store():
+    stage_path = Path(tempfile.mkdtemp(prefix="airway-tests-cohort-store-")) / "stage-10"
+    for patient in "abcd":
+        write_tree(stage_path, patient, 2)
+    columns_path = next(load_cohort_store(stage_path).path.glob("columns-*"))
+
+    write_tree(stage_path, "a", 3)
+    write_tree(stage_path, "e", 1)
+    shutil.rmtree(stage_path / "b")
+    store = load_cohort_store(stage_path)
+    # The rows of a and e were appended, the previous rows of a and b are no longer live
+    assert list(store.path.glob("columns-*")) == [columns_path]
+    assert store.nodes["patient"].tolist() == list("aabbccdd") + list("aaae")
+    assert store.patients == ["a", "c", "d", "e"]
+    assert store.nodes["node_id"][store.select_nodes(patient="a")].tolist() == [0, 1, 2]
+    assert store.get_graph("a").number_of_nodes() == 3
+    assert store.get_graph("e").number_of_edges() == 0
+
+
+def test_only_changed_patients_are_aggregated():
+    stage_path = Path(tempfile.mkdtemp(prefix="airway-tests-cohort-store-")) / "stage-10"
+    for patient in "abc":
+        write_tree(stage_path, patient, 2)
+    contributed = []
+
+    def contribute(store, patient):
+        contributed.append(patient)
+        node_rows, _ = store.get_rows(patient)
+        return {"count": node_rows.stop - node_rows.start, "patients": {patient: 1}}
+
+    aggregation = aggregate_cohort(load_cohort_store(stage_path), "nodes", contribute)
+    assert contributed == ["a", "b", "c"] and aggregation.total["count"] == 6
+
+    write_tree(stage_path, "b", 4)
+    shutil.rmtree(stage_path / "c")
+    contributed.clear()
+    aggregation = aggregate_cohort(load_cohort_store(stage_path), "nodes", contribute)
+    assert contributed == ["b"]
+    assert aggregation.total == {"count": 6, "patients": {"a": 1, "b": 1}}
+    assert aggregation.get_contribution("b") == {"count": 4, "patients": {"b": 1}}
+    assert aggregation.get_total(excluded_patients=["a"]) == {"count": 4, "patients": {"b": 1}}
+
+
+def test_contributions_can_be_removed_from_total():
+    total = {}
+    add_contribution(total, {"clusters": {"LB1": {"a": 1}}, "sum": [1.0, 2.0], "count": 1})
+    add_contribution(total, {"clusters": {"LB1": {"b": 1}}, "sum": [3.0, 4.0], "count": 1})
+    assert total == {"clusters": {"LB1": {"a": 1, "b": 1}}, "sum": [4.0, 6.0], "count": 2}
+    add_contribution(total, {"clusters": {"LB1": {"a": 1}}, "sum": [1.0, 2.0], "count": 1}, sign=-1)
+    assert total == {"clusters": {"LB1": {"b": 1}}, "sum": [3.0, 4.0], "count": 1}
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from airway.util.dtypes import allocate_volume, get_smallest_dtype, to_volume_dtype
+
+
+def test_smallest_dtype_is_picked_and_overflow_raises():
+    assert get_smallest_dtype(255) == np.uint8
+    assert get_smallest_dtype(256) == np.uint16
+    assert get_smallest_dtype(70000) == np.int32
+    assert get_smallest_dtype(5, min_value=-1) == np.int32
+    with pytest.raises(OverflowError):
+        get_smallest_dtype(2**31)
+
+    assert allocate_volume("color_mask", (2, 2, 2), max_value=300).dtype == np.uint16
+    assert to_volume_dtype("distance_mask", np.array([0.0, 500.0])).dtype == np.uint16
+    with pytest.raises(OverflowError):
+        to_volume_dtype("model", np.array([0, 256]))
+    with pytest.raises(ValueError):
+        to_volume_dtype("distance_mask", np.array([0.5]))
@@ -0,0 +1,84 @@
+import json
+import struct
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from airway.obj_generation.gen_obj import MeshOutput, generate_obj, generate_objs, get_boundary_faces
+from airway.obj_generation.glb import quads_to_triangles, write_glb
+
+
+def test_boundary_faces_share_vertices():
+    model = np.zeros((4, 3, 3), dtype=np.uint8)
+    model[1:3, 1, 1] = 1
+    color_mask = np.zeros(model.shape, dtype=np.uint8)
+    color_mask[2, 1, 1] = 5
+    vertices, faces, face_materials = get_boundary_faces(model, color_mask)
+    # Two voxels on top of each other: 12 corners, 10 faces (the two touching faces are not on the surface)
+    assert vertices.shape == (12, 3)
+    assert faces.shape == (10, 4)
+    assert len(np.unique(faces)) == 12
+    assert sorted(face_materials.tolist()) == [0] * 5 + [5] * 5
+    assert vertices.min(axis=0).tolist() == [1, 1, 1] and vertices.max(axis=0).tolist() == [5, 3, 3]
+
+
+def test_greedy_faces_merge_coplanar_faces_of_the_same_material():
+    model = np.zeros((5, 6, 4), dtype=np.uint8)
+    model[1:4, 1:5, 1:3] = 1
+    color_mask = np.ones(model.shape, dtype=np.uint8)
+    color_mask[1:4, 1:3, 1:3] = 2
+    vertices, faces, face_materials = get_boundary_faces(model, color_mask, greedy=True)
+    # Each side of the box is a single rectangle, except for the 4 sides crossing the border of the two materials
+    assert len(faces) == 2 + 4 * 2
+    assert sorted(face_materials.tolist()) == [1] * 5 + [2] * 5
+    assert vertices.min(axis=0).tolist() == [1, 1, 1] and vertices.max(axis=0).tolist() == [7, 9, 5]
+
+
+def test_meshes_generated_together_match_separately_generated_meshes():
+    model = np.zeros((6, 5, 5), dtype=np.uint8)
+    model[1:4, 1:4, 1:4] = 1
+    model[3:5, 2, 2] = 7
+    color_mask = np.arange(model.size).reshape(model.shape) % 3
+    # Random colors are seeded with the patient, i.e. the name of the output directory
+    together_path, separate_path = [
+        Path(tempfile.mkdtemp(prefix="airway-tests-gen-obj-")) / "patient" for _ in range(2)
+    ]
+    together_path.mkdir()
+    separate_path.mkdir()
+    outputs = [
+        MeshOutput(together_path / "bronchus.obj", {1}, color_mask),
+        MeshOutput(together_path / "veins.obj", {7}),
+        MeshOutput(together_path / "all.obj", set()),
+        MeshOutput(together_path / "arteries.obj", {8}),
+    ]
+    generate_objs(model, outputs, workers=2)
+    for output in outputs:
+        generate_obj(separate_path / output.output_data_path.name, output.accepted_types, model, output.color_mask)
+
+    # Arteries do not occur in the model, so they are not written
+    assert sorted(path.name for path in together_path.iterdir()) == [
+        f"{name}.{suffix}" for name in ["all", "bronchus", "veins"] for suffix in ["mtl", "obj"]
+    ]
+    for path in together_path.iterdir():
+        assert path.read_text() == (separate_path / path.name).read_text()
+
+
+def test_glb_contains_a_primitive_per_material():
+    vertices = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0], [2, 0, 0], [2, 1, 0]], dtype=float)
+    primitives = [
+        ("mat1", (1.0, 0.0, 0.0), quads_to_triangles(np.array([[0, 1, 2, 3]]))),
+        ("mat2", (0.0, 0.0, 1.0), quads_to_triangles(np.array([[1, 4, 5, 2]]))),
+    ]
+    path = Path(tempfile.mkdtemp(prefix="airway-tests-glb-")) / "mesh.glb"
+    write_glb(path, "mesh", vertices, primitives, vertex_colors=np.ones((6, 3)))
+
+    data = path.read_bytes()
+    magic, version, length = struct.unpack("<4sII", data[:12])
+    assert (magic, version, length) == (b"glTF", 2, len(data))
+    json_length, json_type = struct.unpack("<I4s", data[12:20])
+    assert json_type == b"JSON"
+    gltf = json.loads(data[20 : 20 + json_length])
+    assert gltf["nodes"][0]["name"] == "mesh"
+    assert [material["name"] for material in gltf["materials"]] == ["mat1", "mat2"]
+    assert [gltf["accessors"][primitive["indices"]]["count"] for primitive in gltf["meshes"][0]["primitives"]] == [6, 6]
@@ -0,0 +1,48 @@
+import numpy as np
+from scipy import ndimage
+from skimage.morphology import skeletonize
+
+from airway.util.helper_functions import (
+    NearestNonzeroIndex,
+    get_labelled_coords,
+    get_outer_shell,
+    skeletonize_volume,
+)
+
+
+def test_points_are_snapped_to_nearest_nonzero_voxel():
+    mask = np.zeros((5, 6, 7), dtype=np.uint16)
+    mask[1, 1, 1] = 3
+    mask[4, 5, 6] = 1
+    nearest_index = NearestNonzeroIndex(mask)
+    points = np.array([[1.0, 1.0, 1.0], [0.6, 2.2, 0.0], [3.9, 4.5, 5.0], [9.0, 9.0, 9.0]])
+    assert nearest_index.snap(points).tolist() == [[1, 1, 1], [1, 1, 1], [4, 5, 6], [4, 5, 6]]
+
+
+def test_tiled_skeleton_matches_whole_volume_skeleton(capsys):
+    mask = np.zeros((40, 20, 20), dtype=np.uint8)
+    mask[3:30, 8:12, 8:12] = 1
+    mask[28:32, 2:18, 8:12] = 1
+    mask[20:35, 14:17, 3:6] = 1
+    whole = skeletonize(mask, method="lee") != 0
+    assert np.array_equal(skeletonize_volume(mask), whole)
+    assert np.array_equal(skeletonize_volume(mask, tile_size=8, halo=6, workers=2), whole)
+    assert "WARNING" not in capsys.readouterr().out
+    # Tiles with a halo much thinner than the branches do not agree at their seams, the whole volume is used instead
+    assert np.array_equal(skeletonize_volume(mask, tile_size=2, halo=2), whole)
+    assert "WARNING" in capsys.readouterr().out
+
+
+def test_outer_shell_does_not_wrap_around_the_border():
+    volume = np.zeros((6, 5, 5), dtype=np.uint8)
+    volume[:, 1:4, 1:4] = 1
+    volume[2, 2, 2] = 3
+    shell = get_outer_shell(volume == 1)
+    structure = ndimage.generate_binary_structure(3, 1)
+    assert np.array_equal(shell, (volume == 1) & ~ndimage.binary_erosion(volume == 1, structure, border_value=0))
+    # The first and last layer touch the border of the volume and the voxel next to label 3 touches another label,
+    # so they are in the shell
+    assert shell[0, 2, 2] and shell[-1, 2, 2] and shell[3, 2, 2] and not shell[4, 2, 2]
+
+    coords = get_labelled_coords(volume, volume == 3)
+    assert coords.dtype == np.uint16 and coords.tolist() == [[2], [2], [2], [3]]
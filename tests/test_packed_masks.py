@@ -0,0 +1,36 @@
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from airway.util.packed_masks import PackedMask
+from airway.util.volumes import load_label_mask, load_packed_mask, save_label_masks, save_volume_statistics
+
+
+def test_packed_masks_match_boolean_masks():
+    rng = np.random.default_rng(0)
+    first, second = rng.random((2, 4, 5, 13)) < 0.4
+    packed_first, packed_second = PackedMask.pack(first), PackedMask.pack(second)
+    assert packed_first.nbytes == 4 * 5 * 2
+    assert np.array_equal(packed_first.unpack(), first)
+    region = (slice(1, 3), slice(None), slice(3, 11))
+    assert np.array_equal(packed_first.unpack(region), first[region])
+    assert np.array_equal((packed_first & packed_second).unpack(), first & second)
+    assert np.array_equal((packed_first | ~packed_second).unpack(), first | ~second)
+    # The padding bits stay 0, so they are not counted
+    assert (~packed_first).count() == np.count_nonzero(~first)
+
+
+def test_label_masks_are_loaded_from_the_packed_masks():
+    path = Path(tempfile.mkdtemp(prefix="airway-tests-packed-masks-"))
+    volume = np.zeros((3, 4, 10), dtype=np.uint8)
+    volume[1, 1:3, 2:9] = 1
+    volume[2, 3, 9] = 7
+    save_volume_statistics(path, "reduced_model", volume)
+    assert load_packed_mask(path, "reduced_model", 1) is None
+    assert np.array_equal(load_label_mask(path, "reduced_model", 7, volume=volume), volume == 7)
+
+    assert save_label_masks(path, "reduced_model", volume) == [1, 7]
+    assert load_packed_mask(path, "reduced_model", 7).count() == 1
+    region = (slice(1, 2), slice(0, 4), slice(5, 10))
+    assert np.array_equal(load_label_mask(path, "reduced_model", 1, region), volume[region] == 1)
@@ -0,0 +1,24 @@
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from airway.util.skeleton import compute_skeleton, load_skeleton, save_skeleton
+
+
+def test_skeleton_is_only_reused_for_the_same_model():
+    model = np.zeros((12, 7, 7), dtype=np.uint8)
+    model[1:11, 2:5, 2:5] = 1
+    model[5, 5, 5] = 7
+    path = Path(tempfile.mkdtemp(prefix="airway-tests-skeleton-"))
+    assert load_skeleton(path, model) is None
+
+    skeleton = compute_skeleton(model)
+    save_skeleton(path, skeleton, model)
+    assert np.array_equal(load_skeleton(path, model), skeleton)
+    # Labels other than the bronchus are not skeletonized, so changing them does not matter
+    model[5, 5, 5] = 8
+    assert np.array_equal(load_skeleton(path, model), skeleton)
+
+    model[10, 3, 3] = 0
+    assert load_skeleton(path, model) is None
@@ -0,0 +1,92 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import networkx as nx
+import numpy as np
+
+from airway.classification.split_classification import (
+    SearchBudget,
+    SearchStatistics,
+    add_cost_by_level_in_tree,
+    add_default_split_classification_id_to_tree,
+    classify_tree,
+    select_classified_tree,
+)
+from airway.util.classification_rules import load_classification_rules
+
+# Classifications the nodes are placed for, the nodes are unclassified before the search
+TREE_STRUCTURE = {
+    "Bronchus": {
+        "LBronchus": {"LUpperLobe": {"LB1+2": {}, "LB3": {}}, "LLowerLobe": {"LB6": {}}},
+        "RBronchus": {"RUpperLobe": {"RB1": {}, "RB2": {}}, "RB6": {}},
+    }
+}
+
+
+def get_tree(rules):
+    """Returns a tree whose split vectors are the vectors of TREE_STRUCTURE (slightly perturbed) and its successors"""
+    classification_config = rules.to_classification_config()
+    rng = np.random.default_rng(0)
+    tree = nx.Graph()
+    tree.add_node("0", x=0.0, y=0.0, z=0.0)
+
+    def add_children(parent_id, children):
+        for classification, grand_children in children.items():
+            node_id = str(len(tree))
+            vector = classification_config.get(classification, {}).get("vector", rng.normal(size=3) * 20)
+            point = [tree.nodes[parent_id][axis] for axis in "xyz"] + np.asarray(vector) + rng.normal(size=3)
+            tree.add_node(node_id, **dict(zip("xyz", map(float, point))))
+            tree.add_edge(parent_id, node_id)
+            add_children(node_id, grand_children)
+
+    add_children("0", TREE_STRUCTURE)
+    successors = dict(nx.bfs_successors(tree, "0"))
+    add_default_split_classification_id_to_tree(tree)
+    add_cost_by_level_in_tree(tree, successors)
+    return tree, successors
+
+
+def test_exhausted_budget_returns_best_tree_found():
+    rules = load_classification_rules()
+    classification_config = rules.to_classification_config()
+    tree, successors = get_tree(rules)
+    statistics = SearchStatistics()
+    all_trees = classify_tree(
+        tree,
+        successors,
+        classification_config,
+        rules=rules,
+        budget=SearchBudget(max_expansions=1),
+        statistics=statistics,
+    )
+    assert statistics.budget_exhausted and statistics.expansions == 1
+
+    classified_tree = select_classified_tree(all_trees, classification_config, successors, statistics)
+    assert classified_tree.graph["search_result"] in ["partial", "best_found"]
+    assert classified_tree.graph["search_expansions"] == 1
+    assert classified_tree.graph["search_budget_exhausted"]
+    assert {"search_queue_peak", "search_trees_thrown_out"} <= set(classified_tree.graph)
+    # The remaining nodes were classified greedily
+    assert all(classified_tree.nodes[node_id]["split_classification"][0] != "c" for node_id in successors["1"])
+
+
+def test_parallel_classification_of_subtrees_matches_sequential():
+    rules = load_classification_rules()
+    classification_config = rules.to_classification_config()
+    tree, successors = get_tree(rules)
+    sequential_cost, sequential_tree = classify_tree(tree.copy(), successors, classification_config, rules=rules)[0]
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        parallel_cost, parallel_tree = classify_tree(
+            tree.copy(), successors, classification_config, rules=rules, executor=executor
+        )[0]
+
+    # The costs only differ by the tiny amounts which are added to break ties in the queue
+    assert abs(parallel_cost - sequential_cost) < 1e-3
+    for node_id in tree.nodes:
+        sequential_node, parallel_node = sequential_tree.nodes[node_id], parallel_tree.nodes[node_id]
+        assert parallel_node["split_classification"] == sequential_node["split_classification"]
+        assert parallel_node["cost"] == sequential_node["cost"]
+    # Both lungs are classified in the workers
+    assert {parallel_tree.nodes[node_id]["split_classification"] for node_id in successors["1"]} == {
+        "LBronchus",
+        "RBronchus",
+    }
@@ -0,0 +1,62 @@
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from airway.util.volumes import (
+    get_bounding_box,
+    load_bounding_box,
+    load_label_counts,
+    load_volume,
+    load_volume_metadata,
+    save_volume,
+    save_volume_metadata,
+    save_volume_statistics,
+)
+
+
+def test_volumes_are_loaded_in_the_format_they_were_saved_in():
+    path = Path(tempfile.mkdtemp(prefix="airway-tests-volumes-"))
+    volume = np.arange(24, dtype=np.int64).reshape((2, 3, 4))
+    save_volume(path, "reduced_model", volume)
+    assert np.array_equal(load_volume(path, "reduced_model"), volume)
+
+    save_volume(path, "reduced_model", volume, "npy")
+    assert sorted(file.name for file in path.iterdir()) == ["reduced_model.npy"]
+    loaded = load_volume(path, "reduced_model", "model")
+    assert loaded.dtype == np.uint8 and np.array_equal(loaded, volume)
+
+    save_volume(path, "reduced_model", volume.astype(np.uint8), "npy")
+    mapped = load_volume(path, "reduced_model", "model")
+    assert isinstance(mapped, np.memmap)
+    # Changes to the loaded volume are not written back
+    mapped[0] = 0
+    assert np.array_equal(load_volume(path, "reduced_model"), volume)
+
+
+def test_volume_metadata_is_merged():
+    path = Path(tempfile.mkdtemp(prefix="airway-tests-volumes-"))
+    assert load_volume_metadata(path, "reduced_model") == {}
+    save_volume_metadata(path, "reduced_model", offset=[0, 44, 41], shape=[5, 6, 7])
+    save_volume_metadata(path, "reduced_model", shape=[5, 6, 8])
+    assert load_volume_metadata(path, "reduced_model") == {"offset": [0, 44, 41], "shape": [5, 6, 8]}
+
+
+def test_volume_statistics_are_used_instead_of_the_volume():
+    path = Path(tempfile.mkdtemp(prefix="airway-tests-volumes-"))
+    volume = np.zeros((6, 7, 8), dtype=np.uint8)
+    volume[1:3, 2:5, 3] = 1
+    volume[4, 6, 7] = 7
+    assert load_bounding_box(path, "model") is None
+    assert load_label_counts(path, "model", volume) == {0: 329, 1: 6, 7: 1}
+
+    save_volume_statistics(path, "model", volume, offset=[0, 1, 2])
+    assert load_volume_metadata(path, "model")["offset"] == [0, 1, 2]
+    assert load_label_counts(path, "model") == {0: 329, 1: 6, 7: 1}
+    lower, upper = load_bounding_box(path, "model", 1)
+    assert lower.tolist() == [1, 2, 3] and upper.tolist() == [3, 5, 4]
+    assert load_bounding_box(path, "model", 2) is None
+    for label, mask in [(1, volume == 1), (None, volume)]:
+        lower, upper = load_bounding_box(path, "model", label, margin=1)
+        expected_lower, expected_upper = get_bounding_box(mask)
+        assert lower.tolist() == expected_lower.tolist() and upper.tolist() == expected_upper.tolist()